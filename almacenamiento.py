@@ -0,0 +1,747 @@
+# === ALMACENAMIENTO: backends de persistencia de la DB de usuarios ===
+# Todos exponen la misma interfaz, usada por AlmacenUsuarios en main.py:
+#   cargar() -> {"usuarios": {...}}        lectura completa al arrancar; ValueError si
+#                                          la DB existe pero no se puede leer
+#   registrar(usuarios, ids)               persistir sólo los usuarios `ids`
+#   guardar_todo(datos)                    reescribir la DB entera; ValueError si `datos`
+#                                          viene vacío y la DB tiene usuarios
+#   compactar(obtener_datos)               mantenimiento; obtener_datos() arma la DB
+#                                          completa sólo si hace falta
+#   empezar_compactacion(obtener_datos)    lo mismo sin frenar al llamador: devuelve
+#     -> (escribir, terminar)              escribir() para correr en otro hilo (o None)
+#                                          y terminar() para llamar después en este
+#   tamano() -> bytes                      tamaño de la DB en disco
+#   tamano_diario() -> bytes               lo pendiente de compactar
+#   cerrar()
+import os
+import json
+import time
+import zlib
+import sqlite3
+import threading
+
+
+def _tamano_archivo(ruta):
+    try:
+        return os.path.getsize(ruta)
+    except OSError:
+        return 0
+
+
+def _fsync_directorio(ruta):
+    # que el os.replace/os.link sobreviva a un corte de luz
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(ruta)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _copiar_usuario(user):
+    # para serializar en otro hilo: copiar los contenedores (inventario, daily...)
+    # para que el event loop pueda seguir modificando el usuario
+    return {
+        campo: dict(valor) if isinstance(valor, dict) else list(valor) if isinstance(valor, list) else valor
+        for campo, valor in user.items()
+    }
+
+
+def _rechazar_vacio(datos, previos, donde):
+    # una carga fallida no debe terminar pisando la DB buena con una vacía
+    if not datos.get("usuarios") and previos:
+        raise ValueError(f"Se rechaza guardar una DB vacía sobre {donde}, que tiene {previos} usuarios")
+
+
+class AlmacenJSON:
+    """Persistencia en un snapshot JSON completo más un diario append-only.
+
+    `registrar()` agrega al diario sólo los campos de cada usuario que
+    cambiaron desde la última escritura (un fsync por lote). `compactar()`
+    vuelca todo en un snapshot nuevo y vacía el diario. `cargar()` lee el
+    snapshot y le reaplica el diario. Con `empezar_compactacion()` el
+    snapshot se escribe en otro hilo mientras `registrar()` sigue agregando
+    al diario; al terminar se quita del diario sólo lo que ya quedó en el
+    snapshot.
+
+    Cada snapshot empieza con una línea de cabecera (generación, usuarios,
+    bytes y crc32 del resto del archivo). Al escribir uno nuevo el actual se
+    conserva como <archivo>.gen-<n>, hasta `generaciones` anteriores. Si el
+    snapshot más nuevo no pasa el checksum, `cargar()` usa el siguiente
+    válido (un .tmp que quedó sin renombrar o una generación anterior); si
+    ninguno sirve, falla en vez de arrancar vacío.
+    """
+
+    def __init__(self, archivo, diario, generaciones=3):
+        self.archivo = archivo
+        self.diario = diario
+        self.generaciones = generaciones
+        self.generacion = None  # la del snapshot más nuevo en disco, válido o no
+        self._usuarios = None   # cuántos había en disco en la última carga/escritura
+        # user_id -> {campo: json} de lo último escrito al diario; sólo usuarios
+        # tocados desde la última compactación (los demás están en el snapshot)
+        self._escrito = {}
+        # un snapshot a la vez (el de fondo y el del apagado)
+        self._snapshot = threading.Lock()
+
+    # --- snapshots ---
+    def _ruta_generacion(self, n):
+        return f"{self.archivo}.gen-{n:06d}"
+
+    def _generaciones_guardadas(self):
+        """[(n, ruta)] de las generaciones anteriores, de la más nueva a la más vieja."""
+        directorio = os.path.dirname(self.archivo)
+        prefijo = os.path.basename(self.archivo) + ".gen-"
+        guardadas = [
+            (int(nombre[len(prefijo):]), os.path.join(directorio, nombre))
+            for nombre in os.listdir(directorio or ".")
+            if nombre.startswith(prefijo) and nombre[len(prefijo):].isdigit()
+        ]
+        return sorted(guardadas, reverse=True)
+
+    @staticmethod
+    def _leer_cabecera(ruta):
+        # snapshots de antes de las generaciones: JSON puro, sin cabecera (generación 0)
+        with open(ruta, "rb") as f:
+            primera = f.readline()
+        try:
+            cabecera = json.loads(primera)
+        except ValueError:
+            return None
+        return cabecera if isinstance(cabecera, dict) and "crc32" in cabecera else None
+
+    def _candidatos(self):
+        """Snapshots en disco, del más nuevo al más viejo: [(generación, ruta)]."""
+        candidatos = []
+        rutas = [(self.archivo, 2), (self.archivo + ".tmp", 1)]
+        rutas += [(ruta, 0) for _, ruta in self._generaciones_guardadas()]
+        for ruta, prioridad in rutas:
+            try:
+                cabecera = self._leer_cabecera(ruta)
+            except FileNotFoundError:
+                continue
+            except OSError:
+                cabecera = None
+            # un .tmp sin cabecera es una escritura cortada, no un snapshot viejo
+            if cabecera is None and prioridad == 1:
+                continue
+            candidatos.append((cabecera["generacion"] if cabecera else 0, prioridad, ruta))
+        candidatos.sort(reverse=True)
+        return [(generacion, ruta) for generacion, _, ruta in candidatos]
+
+    @staticmethod
+    def _leer_verificado(ruta):
+        with open(ruta, "rb") as f:
+            contenido = f.read()
+        primera, _, cuerpo = contenido.partition(b"\n")
+        try:
+            cabecera = json.loads(primera)
+        except ValueError:
+            cabecera = None
+        if not isinstance(cabecera, dict) or "crc32" not in cabecera:
+            return json.loads(contenido)
+        if len(cuerpo) != cabecera["bytes"] or zlib.crc32(cuerpo) != cabecera["crc32"]:
+            raise ValueError("el checksum no coincide")
+        return json.loads(cuerpo)
+
+    # --- lectura ---
+    def _leer_snapshot(self):
+        candidatos = self._candidatos()
+        self.generacion = candidatos[0][0] if candidatos else 0
+        fallidos = []
+        for generacion, ruta in candidatos:
+            try:
+                datos = self._leer_verificado(ruta)
+            except (OSError, ValueError) as e:
+                print(f"⚠️ Snapshot {ruta} inválido: {e}")
+                fallidos.append(ruta)
+                continue
+            if fallidos:
+                print(
+                    f"♻️ Restaurado desde {ruta} (generación {generacion}); "
+                    f"se pierde lo escrito sólo en {', '.join(fallidos)}"
+                )
+            return datos
+        if fallidos:
+            raise ValueError(f"Ningún snapshot válido de {self.archivo}: {', '.join(fallidos)}")
+        return {"usuarios": {}}
+
+    def _leer_diario(self):
+        if not os.path.exists(self.diario):
+            return
+        with open(self.diario, "r") as f:
+            for linea in f:
+                linea = linea.strip()
+                if not linea:
+                    continue
+                try:
+                    yield json.loads(linea)
+                except ValueError:
+                    # última línea a medio escribir (corte de luz): se descarta
+                    break
+
+    def cargar(self):
+        datos = self._leer_snapshot()
+        usuarios = datos.setdefault("usuarios", {})
+        for cambio in self._leer_diario():
+            user = usuarios.setdefault(cambio["u"], {})
+            user.update(cambio.get("c", {}))
+            for campo in cambio.get("d", ()):
+                user.pop(campo, None)
+        self._usuarios = len(usuarios)
+        return datos
+
+    # --- escritura ---
+    def registrar(self, usuarios, ids):
+        """Escribe al diario los campos modificados de `ids`. Devuelve bytes escritos."""
+        lineas = []
+        escritos = {}
+        for user_id in ids:
+            user = usuarios.get(user_id)
+            if user is None:
+                continue
+            previo = self._escrito.get(user_id, {})
+            actual = {campo: json.dumps(valor, sort_keys=True) for campo, valor in user.items()}
+            cambios = {campo: user[campo] for campo, v in actual.items() if previo.get(campo) != v}
+            borrados = [campo for campo in previo if campo not in actual]
+            escritos[user_id] = actual
+            if not cambios and not borrados:
+                continue
+            registro = {"u": user_id, "c": cambios}
+            if borrados:
+                registro["d"] = borrados
+            lineas.append(json.dumps(registro))
+
+        if not lineas:
+            return 0
+        bloque = ("\n".join(lineas) + "\n").encode()
+        fd = os.open(self.diario, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            inicio = os.lseek(fd, 0, os.SEEK_END)
+            try:
+                escrito = 0
+                while escrito < len(bloque):
+                    escrito += os.write(fd, bloque[escrito:])
+                os.fsync(fd)
+            except OSError:
+                # sin media línea al final: cargar() se detiene en la primera línea rota
+                try:
+                    os.ftruncate(fd, inicio)
+                except OSError:
+                    pass
+                raise
+        finally:
+            os.close(fd)
+        # sólo ahora: si la escritura falla, el próximo intento vuelve a mandar todo
+        self._escrito.update(escritos)
+        return len(bloque)
+
+    def _escribir_snapshot(self, datos):
+        """Escribe `datos` como snapshot nuevo sin tocar el diario; devuelve su generación."""
+        with self._snapshot:
+            _rechazar_vacio(datos, self._usuarios, self.archivo)
+            cuerpo = json.dumps(datos, separators=(",", ":")).encode()
+            generacion = self.generacion + 1
+            cabecera = {
+                "generacion": generacion,
+                "usuarios": len(datos.get("usuarios", {})),
+                "bytes": len(cuerpo),
+                "crc32": zlib.crc32(cuerpo),
+            }
+            # escribir en temporal y renombrar; un error aquí deja el snapshot anterior intacto
+            tmp = self.archivo + ".tmp"
+            with open(tmp, "wb") as f:
+                f.write(json.dumps(cabecera).encode() + b"\n" + cuerpo)
+                f.flush()
+                os.fsync(f.fileno())
+            if os.path.exists(self.archivo):
+                # el actual queda como generación anterior (un enlace: no se copia)
+                anterior = self._ruta_generacion(self.generacion)
+                if os.path.exists(anterior):
+                    os.remove(anterior)
+                try:
+                    os.link(self.archivo, anterior)
+                except OSError:
+                    # sin enlaces duros: moverlo; mientras tanto cargar() encuentra el .tmp
+                    os.replace(self.archivo, anterior)
+            os.replace(tmp, self.archivo)
+            _fsync_directorio(self.archivo)
+            self.generacion = generacion
+            self._usuarios = cabecera["usuarios"]
+            for _, ruta in self._generaciones_guardadas()[self.generaciones:]:
+                os.remove(ruta)
+            return generacion
+
+    def _recortar_diario(self, desde):
+        """Deja en el diario sólo lo escrito a partir del byte `desde`."""
+        with open(self.diario, "rb") as f:
+            f.seek(desde)
+            resto = f.read()
+        tmp = self.diario + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(resto)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.diario)
+        _fsync_directorio(self.diario)
+
+    def guardar_todo(self, datos):
+        if self._usuarios is None:
+            # nunca se cargó: ver qué hay en disco antes de reemplazarlo
+            self.cargar()
+        self._escribir_snapshot(datos)
+        # el snapshot ya incluye todo lo del diario; si se corta aquí, reaplicar
+        # el diario sobre el snapshot nuevo da el mismo resultado
+        open(self.diario, "w").close()
+        self._escrito.clear()
+
+    def compactar(self, obtener_datos):
+        self.guardar_todo(obtener_datos())
+
+    def empezar_compactacion(self, obtener_datos):
+        if self._usuarios is None:
+            self.cargar()
+        # copia de ahora: lo que se registre mientras tanto va al diario después de `hasta`
+        datos = {"usuarios": {
+            user_id: _copiar_usuario(user) for user_id, user in obtener_datos()["usuarios"].items()
+        }}
+        hasta = _tamano_archivo(self.diario)
+        self._escrito.clear()  # lo próximo que se registre va completo, sobre el snapshot nuevo
+        escrito = {}
+
+        def escribir():
+            escrito["generacion"] = self._escribir_snapshot(datos)
+
+        def terminar():
+            # si falló no se toca el diario; si otro snapshot más nuevo ya lo vació, tampoco
+            if escrito.get("generacion") == self.generacion:
+                # igual que en guardar_todo: un corte antes de recortar sólo reaplica de más
+                self._recortar_diario(hasta)
+
+        return escribir, terminar
+
+    def tamano(self):
+        return _tamano_archivo(self.archivo)
+
+    def tamano_diario(self):
+        return _tamano_archivo(self.diario)
+
+    def cerrar(self):
+        pass
+
+
+# === SQLITE (modo WAL, tablas normalizadas) ===
+# columnas propias de la tabla usuarios; el resto de campos escalares va en `extra` (JSON)
+COLUMNAS_USUARIO = ("nombre", "xp", "monedas", "codigo", "energia", "ultimo_checkin", "ultimo_rango")
+# acciones contadas en user["daily"] = {"date": fecha, accion: veces}
+ACCIONES_DIARIAS = ("alimentar", "jugar")
+# historial viejo {fecha: veces}: sólo se lee, para que la migración v1 lo pase a "daily";
+# al volver a guardar el usuario esas filas se borran
+CONTADORES_VIEJOS = ("veces_alimento", "veces_juego")
+
+ESQUEMA_SQLITE = """
+CREATE TABLE IF NOT EXISTS usuarios (
+    id TEXT PRIMARY KEY,
+    nombre TEXT,
+    xp INTEGER,
+    monedas INTEGER,
+    codigo TEXT,
+    energia INTEGER,
+    ultimo_checkin TEXT,
+    ultimo_rango INTEGER,
+    extra TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_usuarios_xp ON usuarios(xp);
+CREATE INDEX IF NOT EXISTS idx_usuarios_codigo ON usuarios(codigo);
+CREATE TABLE IF NOT EXISTS inventario (
+    user_id TEXT NOT NULL,
+    item TEXT NOT NULL,
+    cantidad INTEGER NOT NULL,
+    PRIMARY KEY (user_id, item)
+);
+CREATE TABLE IF NOT EXISTS contadores_diarios (
+    user_id TEXT NOT NULL,
+    contador TEXT NOT NULL,
+    fecha TEXT NOT NULL,
+    veces INTEGER NOT NULL,
+    PRIMARY KEY (user_id, contador, fecha)
+);
+CREATE TABLE IF NOT EXISTS referidos (
+    user_id TEXT NOT NULL,
+    referido_id TEXT NOT NULL,
+    PRIMARY KEY (user_id, referido_id)
+);
+-- códigos de referido reservados (modo multiproceso): uno por código entre todos los procesos
+CREATE TABLE IF NOT EXISTS codigos (
+    codigo TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL
+);
+-- cambios para usuarios de otro proceso (modo multiproceso); los aplica su dueño
+CREATE TABLE IF NOT EXISTS buzon (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    cambio TEXT NOT NULL
+);
+"""
+
+
+class AlmacenSQLite:
+    """Persistencia en SQLite; cada usuario sucio se reescribe en sus filas.
+
+    Un lote de `registrar()` es una sola transacción, así que el costo de
+    guardar depende de cuántos usuarios cambiaron, no del tamaño de la DB.
+
+    Con `propios=(i, n)` varios procesos comparten el archivo (WAL): este
+    carga sólo los usuarios con fragmento_de(user_id, n) == i, que son los
+    únicos que escribe. Lo de los demás se consulta con top(), posicion(),
+    buscar_codigo() y leer_usuario(), y se modifica dejando el cambio en el
+    buzón de su dueño (enviar_cambio / tomar_cambios). Los códigos de
+    referido se reservan en la tabla `codigos` (reservar_codigos), así dos
+    procesos no pueden dar el mismo. La conexión es del hilo que la crea;
+    cada proceso abre la suya.
+    """
+
+    def __init__(self, archivo, propios=None):
+        self.archivo = archivo
+        self.propios = propios
+        # timeout: esperar el lock de escritura si otro proceso está escribiendo
+        self.conn = sqlite3.connect(archivo, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(ESQUEMA_SQLITE)
+        self.conn.create_function("fragmento", 2, fragmento_de, deterministic=True)
+
+    # --- lectura ---
+    def cargar(self):
+        if self.propios is None:
+            return {"usuarios": self._leer()}
+        return {"usuarios": self._leer("fragmento({col}, ?) = ?", (self.propios[1], self.propios[0]))}
+
+    def leer_usuario(self, user_id):
+        """Lo último que guardó el dueño de `user_id` (o None)."""
+        return self._leer("{col} = ?", (user_id,)).get(user_id)
+
+    def _leer(self, donde="", params=()):
+        # `donde` filtra por usuario en cada tabla; {col} es su columna de user_id
+        def filtro(col, y=False):
+            if not donde:
+                return ""
+            return f" {'AND' if y else 'WHERE'} " + donde.format(col=col)
+
+        usuarios = {}
+        cur = self.conn.execute(
+            f"SELECT id, {', '.join(COLUMNAS_USUARIO)}, extra FROM usuarios" + filtro("id"), params
+        )
+        for fila in cur:
+            user = json.loads(fila[-1]) if fila[-1] else {}
+            for campo, valor in zip(COLUMNAS_USUARIO, fila[1:-1]):
+                if valor is not None:
+                    user[campo] = valor
+            # en DBs creadas antes del esquema v2 la columna es TEXT y el índice vuelve como "3"
+            if isinstance(user.get("ultimo_rango"), str) and user["ultimo_rango"].isdigit():
+                user["ultimo_rango"] = int(user["ultimo_rango"])
+            user["inventario"] = {}
+            user["referidos"] = []
+            usuarios[fila[0]] = user
+
+        for user_id, item, cantidad in self.conn.execute(
+            "SELECT user_id, item, cantidad FROM inventario" + filtro("user_id"), params
+        ):
+            if user_id in usuarios:
+                usuarios[user_id]["inventario"][item] = cantidad
+        for user_id, contador, fecha, veces in self.conn.execute(
+            "SELECT user_id, contador, fecha, veces FROM contadores_diarios" + filtro("user_id"), params
+        ):
+            if user_id not in usuarios:
+                continue
+            if contador in ACCIONES_DIARIAS:
+                daily = usuarios[user_id].setdefault("daily", {"date": fecha, "alimentar": 0, "jugar": 0})
+                daily[contador] = veces
+            elif contador in CONTADORES_VIEJOS:
+                usuarios[user_id].setdefault(contador, {})[fecha] = veces
+        for user_id, referido_id in self.conn.execute(
+            "SELECT user_id, referido_id FROM referidos" + filtro("user_id") + " ORDER BY rowid", params
+        ):
+            if user_id in usuarios:
+                usuarios[user_id]["referidos"].append(referido_id)
+        return usuarios
+
+    # --- consultas sobre todos los procesos (lo que cada uno ya guardó) ---
+    def top(self, n):
+        return self.conn.execute(
+            "SELECT id, nombre, xp FROM usuarios ORDER BY xp DESC, id LIMIT ?", (n,)
+        ).fetchall()
+
+    def posicion(self, user_id, xp):
+        # mismo orden que top(): más xp primero y, a igual xp, por id
+        delante = self.conn.execute(
+            "SELECT COUNT(*) FROM usuarios WHERE xp > ? OR (xp = ? AND id < ?)", (xp, xp, user_id)
+        ).fetchone()[0]
+        return delante + 1
+
+    def contar(self):
+        return self.conn.execute("SELECT COUNT(*) FROM usuarios").fetchone()[0]
+
+    def buscar_codigo(self, codigo):
+        fila = self.conn.execute("SELECT user_id FROM codigos WHERE codigo = ?", (codigo,)).fetchone()
+        if fila is None:
+            # de un proceso que todavía no reservó los códigos de sus usuarios
+            fila = self.conn.execute("SELECT id FROM usuarios WHERE codigo = ?", (codigo,)).fetchone()
+        return fila[0] if fila else None
+
+    def reservar_codigos(self, codigos):
+        """Reserva {user_id: codigo}; devuelve los user_id cuyo código ya es de otro usuario."""
+        rechazados = set()
+        with self.conn:
+            for user_id, codigo in codigos.items():
+                self.conn.execute("INSERT OR IGNORE INTO codigos (codigo, user_id) VALUES (?, ?)", (codigo, user_id))
+                dueno = self.conn.execute("SELECT user_id FROM codigos WHERE codigo = ?", (codigo,)).fetchone()[0]
+                if dueno != user_id:
+                    rechazados.add(user_id)
+        return rechazados
+
+    # --- buzón entre procesos ---
+    def enviar_cambio(self, user_id, cambio):
+        with self.conn:
+            self.conn.execute("INSERT INTO buzon (user_id, cambio) VALUES (?, ?)", (user_id, json.dumps(cambio)))
+
+    def tomar_cambios(self):
+        """[(user_id, cambio)] pendientes para los usuarios propios; quedan borrados del buzón."""
+        donde, params = "", ()
+        if self.propios is not None:
+            donde, params = " WHERE fragmento(user_id, ?) = ?", (self.propios[1], self.propios[0])
+        filas = self.conn.execute(f"SELECT id, user_id, cambio FROM buzon{donde} ORDER BY id", params).fetchall()
+        if not filas:
+            return []
+        with self.conn:
+            self.conn.executemany("DELETE FROM buzon WHERE id = ?", [(fila[0],) for fila in filas])
+        return [(user_id, json.loads(cambio)) for _, user_id, cambio in filas]
+
+    # --- escritura ---
+    def _escribir_usuario(self, user_id, user):
+        extra = {
+            campo: valor for campo, valor in user.items()
+            if campo not in COLUMNAS_USUARIO and campo not in ("inventario", "referidos", "daily")
+        }
+        self.conn.execute(
+            f"INSERT OR REPLACE INTO usuarios (id, {', '.join(COLUMNAS_USUARIO)}, extra) "
+            f"VALUES (?, {', '.join('?' * len(COLUMNAS_USUARIO))}, ?)",
+            (user_id, *(user.get(campo) for campo in COLUMNAS_USUARIO), json.dumps(extra)),
+        )
+        self.conn.execute("DELETE FROM inventario WHERE user_id = ?", (user_id,))
+        self.conn.executemany(
+            "INSERT INTO inventario (user_id, item, cantidad) VALUES (?, ?, ?)",
+            [(user_id, item, cantidad) for item, cantidad in user.get("inventario", {}).items()],
+        )
+        daily = user.get("daily") or {}
+        filas = [
+            (user_id, accion, daily["date"], daily.get(accion, 0))
+            for accion in ACCIONES_DIARIAS if daily.get("date")
+        ]
+        self.conn.execute("DELETE FROM contadores_diarios WHERE user_id = ?", (user_id,))
+        self.conn.executemany(
+            "INSERT INTO contadores_diarios (user_id, contador, fecha, veces) VALUES (?, ?, ?, ?)",
+            filas,
+        )
+        self.conn.execute("DELETE FROM referidos WHERE user_id = ?", (user_id,))
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO referidos (user_id, referido_id) VALUES (?, ?)",
+            [(user_id, str(referido)) for referido in user.get("referidos", [])],
+        )
+
+    def registrar(self, usuarios, ids):
+        escritos = 0
+        with self.conn:
+            for user_id in ids:
+                user = usuarios.get(user_id)
+                if user is not None:
+                    self._escribir_usuario(user_id, user)
+                    escritos += 1
+        return escritos
+
+    def guardar_todo(self, datos):
+        if self.propios is not None:
+            raise ValueError("guardar_todo() borraría los usuarios de los otros procesos")
+        _rechazar_vacio(datos, self.contar(), self.archivo)
+        with self.conn:
+            for tabla in ("usuarios", "inventario", "contadores_diarios", "referidos"):
+                self.conn.execute(f"DELETE FROM {tabla}")
+            for user_id, user in datos["usuarios"].items():
+                self._escribir_usuario(user_id, user)
+
+    def compactar(self, obtener_datos):
+        # los datos ya están en la DB; sólo vaciar el WAL al archivo principal
+        self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def empezar_compactacion(self, obtener_datos):
+        # la conexión es de este hilo: el checkpoint va en terminar()
+        return None, lambda: self.compactar(obtener_datos)
+
+    def tamano(self):
+        return _tamano_archivo(self.archivo)
+
+    def tamano_diario(self):
+        return _tamano_archivo(self.archivo + "-wal")
+
+    def cerrar(self):
+        self.conn.close()
+
+
+# === FRAGMENTOS: usuarios repartidos en N archivos JSON, escritos por un hilo aparte ===
+def fragmento_de(user_id, fragmentos):
+    # crc32 y no hash(): tiene que dar lo mismo en cada arranque
+    return zlib.crc32(str(user_id).encode()) % fragmentos
+
+
+class AlmacenFragmentado:
+    """Persistencia en `fragmentos` archivos JSON según crc32(user_id).
+
+    Cada escritura reserializa sólo los fragmentos que tienen usuarios sucios.
+    La serialización, el fsync y el os.replace corren en un hilo escritor, así
+    que `registrar()` no bloquea el event loop; `compactar()` y `cerrar()`
+    esperan a que el hilo termine lo pendiente. El número de fragmentos queda
+    en MANIFIESTO; para cambiarlo usar fragmentar_db.py.
+    """
+
+    MANIFIESTO = "fragmentos.json"
+
+    def __init__(self, directorio, fragmentos=16):
+        self.directorio = directorio
+        os.makedirs(directorio, exist_ok=True)
+        manifiesto = os.path.join(directorio, self.MANIFIESTO)
+        if os.path.exists(manifiesto):
+            with open(manifiesto, "r") as f:
+                guardados = json.load(f)["fragmentos"]
+            if guardados != fragmentos:
+                raise ValueError(
+                    f"{directorio} tiene {guardados} fragmentos, no {fragmentos}; "
+                    f"usa fragmentar_db.py para cambiarlo"
+                )
+        else:
+            with open(manifiesto, "w") as f:
+                json.dump({"fragmentos": fragmentos}, f)
+        self.fragmentos = fragmentos
+        # copia de lo que hay que escribir por fragmento; el hilo sólo lee de aquí
+        self._datos = [{} for _ in range(fragmentos)]
+        self._sucios = set()
+        self._cond = threading.Condition()
+        self._escribiendo = False
+        self._cerrado = False
+        self._hilo = threading.Thread(target=self._escritor, name="almacen-fragmentos", daemon=True)
+        self._hilo.start()
+
+    def _ruta(self, i):
+        return os.path.join(self.directorio, f"fragmento_{i:03d}.json")
+
+    # --- lectura ---
+    def cargar(self):
+        usuarios = {}
+        for i in range(self.fragmentos):
+            try:
+                with open(self._ruta(i), "r") as f:
+                    self._datos[i] = json.load(f).get("usuarios", {})
+            except FileNotFoundError:
+                self._datos[i] = {}
+            usuarios.update(self._datos[i])
+        return {"usuarios": usuarios}
+
+    # --- escritura ---
+    def registrar(self, usuarios, ids):
+        tocados = set()
+        with self._cond:
+            for user_id in ids:
+                user = usuarios.get(user_id)
+                if user is None:
+                    continue
+                i = fragmento_de(user_id, self.fragmentos)
+                self._datos[i][user_id] = _copiar_usuario(user)
+                tocados.add(i)
+            self._sucios |= tocados
+            self._cond.notify()
+        return len(tocados)
+
+    def guardar_todo(self, datos):
+        with self._cond:
+            _rechazar_vacio(datos, sum(len(d) for d in self._datos), self.directorio)
+            self._datos = [{} for _ in range(self.fragmentos)]
+            for user_id, user in datos["usuarios"].items():
+                self._datos[fragmento_de(user_id, self.fragmentos)][user_id] = _copiar_usuario(user)
+            self._sucios = set(range(self.fragmentos))
+            self._cond.notify()
+        self.esperar()
+
+    def _escribir_fragmento(self, i, usuarios):
+        tmp = self._ruta(i) + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"usuarios": usuarios}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._ruta(i))
+
+    def _escritor(self):
+        while True:
+            with self._cond:
+                while not self._sucios and not self._cerrado:
+                    self._cond.wait()
+                if not self._sucios:
+                    return
+                sucios, self._sucios = self._sucios, set()
+                # copia superficial: registrar() reemplaza usuarios, no los modifica
+                lote = {i: dict(self._datos[i]) for i in sucios}
+                self._escribiendo = True
+            for i, usuarios in lote.items():
+                try:
+                    self._escribir_fragmento(i, usuarios)
+                except OSError as e:
+                    print(f"⚠️ No se pudo escribir el fragmento {i}: {e}; se reintenta")
+                    with self._cond:
+                        self._sucios.add(i)
+                    time.sleep(1)
+            with self._cond:
+                self._escribiendo = False
+                self._cond.notify_all()
+
+    def esperar(self):
+        """Bloquea hasta que el hilo escritor no tenga nada pendiente."""
+        with self._cond:
+            while self._sucios or self._escribiendo:
+                self._cond.wait()
+
+    def compactar(self, obtener_datos):
+        # no hay diario: sólo asegurar que lo registrado ya está en disco
+        self.esperar()
+
+    def empezar_compactacion(self, obtener_datos):
+        # el hilo escritor ya escribe por su cuenta
+        return None, lambda: None
+
+    def tamano(self):
+        return sum(_tamano_archivo(self._ruta(i)) for i in range(self.fragmentos))
+
+    def tamano_diario(self):
+        # sin diario que compactar; lo pendiente lo escribe el hilo por su cuenta
+        return 0
+
+    def cerrar(self):
+        self.esperar()
+        with self._cond:
+            self._cerrado = True
+            self._cond.notify_all()
+        self._hilo.join()
+
+
+def crear_backend(tipo, archivo_json, diario_json, archivo_sqlite, directorio_fragmentos=None, fragmentos=16,
+                  generaciones=3, propios=None):
+    if propios is not None and tipo != "sqlite":
+        raise ValueError("El modo multiproceso necesita DB_BACKEND=sqlite")
+    if tipo == "json":
+        return AlmacenJSON(archivo_json, diario_json, generaciones)
+    if tipo == "sqlite":
+        return AlmacenSQLite(archivo_sqlite, propios)
+    if tipo == "fragmentos":
+        return AlmacenFragmentado(directorio_fragmentos, fragmentos)
+    raise ValueError(f"DB_BACKEND desconocido: {tipo!r} (usa 'json', 'sqlite' o 'fragmentos')")
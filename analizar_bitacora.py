@@ -0,0 +1,124 @@
+# === ANALÍTICAS: resumen por día de la bitácora de eventos (ver bitacora.py) ===
+# Uso: python analizar_bitacora.py [directorio] [--desde YYYY-MM-DD] [--hasta YYYY-MM-DD] [--json]
+# Lee los archivos en streaming, evento por evento: la memoria no crece con el
+# tamaño de la bitácora, sólo con los usuarios distintos de un día (para el DAU).
+import os
+import sys
+import json
+import argparse
+import itertools
+from collections import Counter
+
+DIRECTORIO = "eventos"
+
+
+def archivos(directorio, desde=None, hasta=None):
+    # eventos-<día>[-p<proceso>]-<nnn>.jsonl: ordenados quedan juntos los de cada día
+    for nombre in sorted(os.listdir(directorio)):
+        if not (nombre.startswith("eventos-") and nombre.endswith(".jsonl")):
+            continue
+        dia = nombre[len("eventos-"):len("eventos-") + 10]
+        if (desde and dia < desde) or (hasta and dia > hasta):
+            continue
+        yield os.path.join(directorio, nombre)
+
+
+def leer_eventos(rutas):
+    for ruta in rutas:
+        with open(ruta, "r", encoding="utf-8") as f:
+            for linea in f:
+                try:
+                    yield json.loads(linea)
+                except json.JSONDecodeError:
+                    # última línea cortada por un apagado brusco
+                    continue
+
+
+def resumir_dia(dia, eventos):
+    usuarios = set()
+    comandos = Counter()
+    resultados = Counter()   # (comando, resultado) de lo que no salió "ok"
+    limite_diario = {"alimentar": set(), "jugar": set()}
+    articulos = Counter()
+    monedas_ganadas = monedas_gastadas = gasto_tienda = xp = 0
+    ms_total = 0.0
+
+    for e in eventos:
+        usuarios.add(e["usuario"])
+        comando = e["comando"]
+        comandos[comando] += 1
+        ms_total += e.get("ms", 0)
+        resultado = e.get("resultado")
+        if resultado:
+            resultados[(comando, resultado)] += 1
+            if resultado == "limite_diario" and comando in limite_diario:
+                limite_diario[comando].add(e["usuario"])
+        monedas = e.get("monedas", 0)
+        if monedas > 0:
+            monedas_ganadas += monedas
+        else:
+            monedas_gastadas -= monedas
+            if comando == "comprar":
+                gasto_tienda -= monedas
+        monedas_ganadas += e.get("monedas_referente", 0)
+        xp += e.get("xp", 0)
+        if comando == "comprar" and resultado is None and "articulo" in e:
+            articulos[e["articulo"]] += e.get("cantidad", 1)
+
+    total = sum(comandos.values())
+    return {
+        "dia": dia,
+        "dau": len(usuarios),
+        "eventos": total,
+        "ms_promedio": round(ms_total / total, 2) if total else 0.0,
+        "monedas_ganadas": monedas_ganadas,
+        "monedas_gastadas": monedas_gastadas,
+        "gasto_tienda": gasto_tienda,
+        "xp_ganada": xp,
+        "usuarios_en_limite": {comando: len(ids) for comando, ids in limite_diario.items()},
+        "comandos": dict(comandos.most_common()),
+        "resultados": {f"{comando}:{resultado}": n for (comando, resultado), n in resultados.most_common()},
+        "articulos": dict(articulos.most_common()),
+    }
+
+
+def resumir(eventos):
+    """Un resumen por día; cada archivo es de un solo día y vienen agrupados por día."""
+    for dia, del_dia in itertools.groupby(eventos, key=lambda e: e["dia"]):
+        yield resumir_dia(dia, del_dia)
+
+
+def imprimir(resumen):
+    print(f"📅 {resumen['dia']}: {resumen['dau']} usuarios activos, {resumen['eventos']} comandos "
+          f"({resumen['ms_promedio']} ms promedio)")
+    print(f"  💰 +{resumen['monedas_ganadas']} / -{resumen['monedas_gastadas']} monedas "
+          f"(tienda: {resumen['gasto_tienda']}) · ⭐ +{resumen['xp_ganada']} XP")
+    limite = resumen["usuarios_en_limite"]
+    print(f"  🚫 Llegaron al límite diario: alimentar {limite['alimentar']}, jugar {limite['jugar']}")
+    print("  📋 " + ", ".join(f"{c} {n}" for c, n in resumen["comandos"].items()))
+    if resumen["resultados"]:
+        print("  ⚠️ " + ", ".join(f"{r} {n}" for r, n in resumen["resultados"].items()))
+    if resumen["articulos"]:
+        print("  🛒 " + ", ".join(f"{a} {n}" for a, n in resumen["articulos"].items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Resumen diario de la bitácora de eventos")
+    parser.add_argument("directorio", nargs="?", default=DIRECTORIO)
+    parser.add_argument("--desde", help="primer día (YYYY-MM-DD)")
+    parser.add_argument("--hasta", help="último día (YYYY-MM-DD)")
+    parser.add_argument("--json", action="store_true", help="un JSON por día en vez de texto")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.directorio):
+        raise SystemExit(f"❌ No existe {args.directorio}")
+    for resumen in resumir(leer_eventos(archivos(args.directorio, args.desde, args.hasta))):
+        if args.json:
+            print(json.dumps(resumen, ensure_ascii=False))
+        else:
+            imprimir(resumen)
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,384 @@
+# === BENCHMARK: la Application real contra una Bot API falsa en memoria ===
+# Uso: python bench.py [--usuarios 1000,10000,100000] [--comandos 5] [--backend json|sqlite|fragmentos]
+#                      [--latencia-api 0.02] [--limites-telegram] [--procesos 4] [--dias 3]
+# Cada escala corre en un subproceso propio (DB vacía en un directorio temporal,
+# RSS pico independiente). Reporta updates/s, latencia de los handlers
+# (p50/p95/p99), bytes escritos a la DB por comando y RSS pico.
+# Con --procesos N corren N subprocesos a la vez como los trabajadores del modo
+# multiproceso (PROCESO/PROCESOS, SQLite compartida), cada uno con los usuarios
+# que le tocan; se suman updates, bytes y RSS y cuenta el más lento.
+# El bot corre con un RelojFalso: con --dias N las acciones se reparten en N días
+# simulados (contadores diarios, check-in, sueño) sin esperar de verdad.
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import itertools
+import resource
+import subprocess
+import tempfile
+import threading
+
+from telegram.request import BaseRequest
+
+from reloj import RelojFalso
+
+RAIZ = os.path.dirname(os.path.abspath(__file__))
+COMANDOS = ("/alimentar", "/jugar", "/dormir", "/checkin", "/estado", "/tienda")
+COMPRAS = ("buy_mosca", "buy_mosquito", "buy_araña", "buy_paseo", "buy_polillas", "buy_pocion")
+# PNG mínimo: el contenido da igual, sólo se sube una vez por imagen
+PNG = b"\x89PNG\r\n\x1a\n" + bytes(64)
+
+
+class BotAPIFalsa(BaseRequest):
+    """Responde en memoria lo mínimo que usan los handlers, con `latencia` segundos por llamada."""
+
+    def __init__(self, latencia=0.0):
+        self.latencia = latencia
+        self.llamadas = 0
+        self._ids = itertools.count(1)
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        self.llamadas += 1
+        metodo = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        if self.latencia and metodo != "getUpdates":
+            await asyncio.sleep(self.latencia)
+        if metodo == "getMe":
+            resultado = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif metodo == "getUpdates":
+            # el benchmark mete los updates directo en la cola; esto sólo no debe girar en vacío
+            await asyncio.sleep(1)
+            resultado = []
+        elif metodo in ("sendMessage", "sendPhoto", "editMessageText", "editMessageCaption"):
+            message_id = next(self._ids)
+            resultado = {
+                "message_id": message_id,
+                "date": 0,
+                "chat": {"id": int(params.get("chat_id", 1)), "type": "private"},
+                "text": params.get("text") or params.get("caption") or "",
+            }
+            if metodo == "sendPhoto":
+                resultado["photo"] = [{"file_id": f"F{message_id}", "file_unique_id": "u", "width": 1, "height": 1}]
+        else:
+            resultado = True
+        return 200, json.dumps({"ok": True, "result": resultado}).encode()
+
+
+# --- updates sintéticos ---
+_update_ids = itertools.count(1)
+
+def update_comando(user_id, texto):
+    n = next(_update_ids)
+    comando = texto.split()[0]
+    return {
+        "update_id": n,
+        "message": {
+            "message_id": n,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"U{user_id}"},
+            "text": texto,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(comando)}],
+        },
+    }
+
+def update_callback(user_id, data):
+    n = next(_update_ids)
+    return {
+        "update_id": n,
+        "callback_query": {
+            "id": f"cb{n}",
+            "chat_instance": "bench",
+            "data": data,
+            "from": {"id": user_id, "is_bot": False, "first_name": f"U{user_id}"},
+            "message": {"message_id": n, "date": 0, "chat": {"id": user_id, "type": "private"}, "text": "🛒"},
+        },
+    }
+
+def generar_updates(usuarios, comandos, semilla=1):
+    """Un /start por usuario y luego `comandos` acciones por usuario, intercaladas al azar."""
+    azar = random.Random(semilla)
+    ids = range(100_000_000, 100_000_000 + usuarios)
+    inicio = [update_comando(user_id, "/start") for user_id in ids]
+    acciones = []
+    for user_id in ids:
+        for _ in range(comandos):
+            if azar.random() < 0.15:
+                acciones.append(update_callback(user_id, azar.choice(COMPRAS)))
+            else:
+                acciones.append(update_comando(user_id, azar.choice(COMANDOS)))
+    azar.shuffle(acciones)
+    return inicio, acciones
+
+
+# --- medición ---
+def bytes_escritos():
+    # wchar del hilo actual: bytes pasados a write(); None si no hay /proc (no Linux)
+    try:
+        with open("/proc/thread-self/io") as f:
+            for linea in f:
+                if linea.startswith("wchar:"):
+                    return int(linea.split()[1])
+    except OSError:
+        return None
+
+def medir_escrituras(main):
+    """Envuelve los métodos de escritura del backend y suma los bytes que escriben."""
+    total = {"bytes": 0}
+    dentro = threading.local()  # compactar -> guardar_todo -> _escribir_snapshot: contar una vez
+    # _escribir_fragmento corre en el hilo escritor de AlmacenFragmentado y
+    # _escribir_snapshot en el de la compactación de fondo
+    for nombre in ("registrar", "guardar_todo", "compactar", "_escribir_snapshot", "_recortar_diario",
+                   "_escribir_fragmento"):
+        original = getattr(main.backend, nombre, None)
+        if original is None:
+            continue
+
+        def envuelto(*args, _original=original, **kwargs):
+            if getattr(dentro, "si", False):
+                return _original(*args, **kwargs)
+            dentro.si = True
+            antes = bytes_escritos()
+            try:
+                return _original(*args, **kwargs)
+            finally:
+                dentro.si = False
+                if antes is not None:
+                    total["bytes"] += bytes_escritos() - antes
+
+        setattr(main.backend, nombre, envuelto)
+    return total
+
+def percentil(valores, p):
+    if not valores:
+        return 0.0
+    return valores[min(len(valores) - 1, int(len(valores) * p / 100))]
+
+
+def esperar_a_todos(directorio, proceso, procesos):
+    # barrera entre los trabajadores: que las acciones se midan corriendo todos a la vez
+    open(os.path.join(directorio, f"listo.{proceso}"), "w").close()
+    while sum(os.path.exists(os.path.join(directorio, f"listo.{i}")) for i in range(procesos)) < procesos:
+        time.sleep(0.01)
+
+def del_usuario(datos):
+    return (datos.get("message") or datos["callback_query"])["from"]["id"]
+
+async def correr_escala(usuarios, comandos, latencia, limites_telegram, dias=1):
+    import main
+    from telegram import Update
+    from telegram.ext import TypeHandler
+
+    if not limites_telegram:
+        # medir los handlers, no los límites de Telegram
+        main.ENVIO_CHAT_POR_SEG = main.ENVIO_CHAT_RAFAGA = 10 ** 9
+        main.despachador._global = main.Cubeta(10 ** 9, 10 ** 9)
+    escrito = medir_escrituras(main)
+    reloj = main.reloj = RelojFalso(main.TZ)
+
+    api = BotAPIFalsa(latencia)
+    app = main.crear_app("1:bench", api)
+    inicio = {}
+    latencias = []
+    en_vuelo = asyncio.Semaphore(main.WORKERS * 4)
+
+    async def marcar_inicio(update, context):
+        inicio[update.update_id] = time.perf_counter()
+
+    async def marcar_fin(update, context):
+        latencias.append(time.perf_counter() - inicio.pop(update.update_id))
+        en_vuelo.release()
+
+    app.add_handler(TypeHandler(Update, marcar_inicio), group=-100)
+    app.add_handler(TypeHandler(Update, marcar_fin), group=99)
+
+    async def alimentar_cola(datos):
+        for d in datos:
+            await en_vuelo.acquire()
+            await app.update_queue.put(Update.de_json(d, app.bot))
+        # esperar a que termine lo que sigue en vuelo
+        for _ in range(main.WORKERS * 4):
+            await en_vuelo.acquire()
+        for _ in range(main.WORKERS * 4):
+            en_vuelo.release()
+
+    registros, acciones = generar_updates(usuarios, comandos)
+    if main.PROCESO is not None:
+        registros = [d for d in registros if main.es_propio(del_usuario(d))]
+        acciones = [d for d in acciones if main.es_propio(del_usuario(d))]
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+    try:
+        await alimentar_cola(registros)
+        if main.PROCESO is not None:
+            main.almacen.guardar()
+            esperar_a_todos(os.getcwd(), main.PROCESO, main.PROCESOS)
+        latencias.clear()
+        escrito["bytes"] = 0
+        t0 = time.perf_counter()
+        por_dia = -(-len(acciones) // dias)
+        for i in range(0, len(acciones), por_dia):
+            if i:
+                reloj.pasar_al_dia_siguiente()
+            await alimentar_cola(acciones[i:i + por_dia])
+        segundos = time.perf_counter() - t0
+        # lo pendiente cuenta; la compactación al apagar (proporcional a la DB) no
+        main.almacen.guardar()
+        await main.almacen.esperar_compactacion()
+        if hasattr(main.backend, "esperar"):
+            main.backend.esperar()
+        bytes_db = escrito["bytes"]
+    finally:
+        await app.stop()
+        await app.post_shutdown(app)
+        await app.shutdown()
+
+    latencias.sort()
+    return {
+        "usuarios": usuarios,
+        "updates": len(acciones),
+        "segundos": round(segundos, 2),
+        "updates_por_seg": round(len(acciones) / segundos, 1),
+        "p50_ms": round(percentil(latencias, 50) * 1000, 2),
+        "p95_ms": round(percentil(latencias, 95) * 1000, 2),
+        "p99_ms": round(percentil(latencias, 99) * 1000, 2),
+        "bytes_db_por_comando": round(bytes_db / len(acciones), 1),
+        "llamadas_api": api.llamadas,
+        # ru_maxrss viene en KB en Linux
+        "rss_pico_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+def preparar_directorio():
+    # DB, cache de imágenes y bandeja de salida nuevas en un directorio temporal
+    directorio = tempfile.mkdtemp(prefix="pepegotchi_bench_")
+    # sin agenda.json: sin eventos, el resultado no depende de la fecha ni de la agenda real
+    for datos in ("rangos.json", "tienda.json"):
+        shutil.copy(os.path.join(RAIZ, datos), directorio)
+    os.makedirs(os.path.join(directorio, "images"))
+    with open(os.path.join(RAIZ, "rangos.json"), encoding="utf-8") as f:
+        for rango in json.load(f):
+            with open(os.path.join(directorio, "images", rango["imagen"]), "wb") as imagen:
+                imagen.write(PNG)
+    return directorio
+
+def una_escala(args):
+    # con --proceso el directorio es compartido y lo borra quien lo creó
+    directorio = args.directorio or preparar_directorio()
+    try:
+        os.chdir(directorio)
+        os.environ["DB_BACKEND"] = args.backend
+        os.environ["METRICAS_PORT"] = "0"
+        # los usuarios simulados mandan todo de golpe; medir los handlers, no el limitador
+        os.environ["LIMITE_POR_SEG"] = "0"
+        if args.proceso is not None:
+            os.environ["PROCESOS"] = str(args.procesos)
+            os.environ["PROCESO"] = str(args.proceso)
+        sys.path.insert(0, RAIZ)
+        resultado = asyncio.run(
+            correr_escala(args.una, args.comandos, args.latencia_api, args.limites_telegram, args.dias)
+        )
+        print(json.dumps(resultado))
+    finally:
+        if not args.directorio:
+            shutil.rmtree(directorio, ignore_errors=True)
+
+def varios_procesos(usuarios, args):
+    """Corre los N trabajadores a la vez sobre un mismo directorio y junta sus resultados."""
+    directorio = preparar_directorio()
+    try:
+        hijos = [
+            subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), "--una", str(usuarios), *sys.argv[1:],
+                 "--proceso", str(i), "--directorio", directorio],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+            )
+            for i in range(args.procesos)
+        ]
+        resultados = []
+        for hijo in hijos:
+            salida, errores = hijo.communicate()
+            lineas = salida.strip().splitlines()
+            if hijo.returncode or not lineas:
+                return None, errores
+            resultados.append(json.loads(lineas[-1]))
+    finally:
+        shutil.rmtree(directorio, ignore_errors=True)
+
+    updates = sum(r["updates"] for r in resultados)
+    segundos = max(r["segundos"] for r in resultados)
+    return {
+        "usuarios": usuarios,
+        "updates": updates,
+        "segundos": segundos,
+        "updates_por_seg": round(updates / segundos, 1),
+        # percentiles: los del proceso que peor anduvo
+        "p50_ms": max(r["p50_ms"] for r in resultados),
+        "p95_ms": max(r["p95_ms"] for r in resultados),
+        "p99_ms": max(r["p99_ms"] for r in resultados),
+        "bytes_db_por_comando": round(sum(r["bytes_db_por_comando"] * r["updates"] for r in resultados) / updates, 1),
+        "llamadas_api": sum(r["llamadas_api"] for r in resultados),
+        "rss_pico_mb": round(sum(r["rss_pico_mb"] for r in resultados), 1),
+    }, ""
+
+def main_bench():
+    parser = argparse.ArgumentParser(description="Benchmark de los handlers contra una Bot API falsa")
+    parser.add_argument("--usuarios", default="1000,10000,100000", help="escalas separadas por comas")
+    parser.add_argument("--comandos", type=int, default=5, help="acciones por usuario después del /start")
+    parser.add_argument("--backend", default="json", choices=("json", "sqlite", "fragmentos"))
+    parser.add_argument("--latencia-api", type=float, default=0.0, help="segundos por llamada a la API falsa")
+    parser.add_argument("--limites-telegram", action="store_true", help="respetar los límites de envío reales")
+    parser.add_argument("--dias", type=int, default=1, help="días simulados en los que se reparten las acciones")
+    parser.add_argument("--procesos", type=int, default=1, help="trabajadores del modo multiproceso (usa sqlite)")
+    parser.add_argument("--una", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--proceso", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--directorio", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.procesos > 1:
+        args.backend = "sqlite"
+
+    if args.una:
+        una_escala(args)
+        return
+
+    columnas = ("usuarios", "updates", "segundos", "updates_por_seg", "p50_ms", "p95_ms", "p99_ms",
+                "bytes_db_por_comando", "rss_pico_mb")
+    print("  ".join(f"{c:>20}" for c in columnas))
+    for usuarios in (int(u) for u in args.usuarios.split(",")):
+        if args.procesos > 1:
+            resultado, errores = varios_procesos(usuarios, args)
+            if resultado is None:
+                print(f"❌ {usuarios} usuarios: falló\n{errores[-2000:]}")
+            else:
+                print("  ".join(f"{resultado[c]:>20}" for c in columnas))
+            continue
+        hijo = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--una", str(usuarios), *sys.argv[1:]],
+            capture_output=True, text=True,
+        )
+        lineas = hijo.stdout.strip().splitlines()
+        if hijo.returncode or not lineas:
+            print(f"❌ {usuarios} usuarios: falló\n{hijo.stderr[-2000:]}")
+            continue
+        resultado = json.loads(lineas[-1])
+        print("  ".join(f"{resultado[c]:>20}" for c in columnas))
+
+
+if __name__ == "__main__":
+    main_bench()
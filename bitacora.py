@@ -0,0 +1,120 @@
+# === BITÁCORA: un evento JSONL por comando, escrito por lotes en un hilo ===
+# Cada handler deja un dict (usuario, comando, deltas de xp/monedas, ms...) con
+# registrar(); el hilo escritor los serializa y los agrega a
+# <directorio>/eventos-<día><sufijo>-<nnn>.jsonl, con un archivo nuevo por día
+# local y cada vez que el actual pasa de max_bytes. Con varios procesos cada uno
+# usa su `sufijo`. Para analizarlos offline ver analizar_bitacora.py.
+import os
+import json
+import time
+import threading
+
+
+class Bitacora:
+    """Buffer de eventos en memoria + hilo que los escribe cada `lote` eventos
+    o cada `intervalo` segundos, lo que pase primero.
+
+    registrar() sólo agrega a una lista: no serializa ni toca disco en el
+    event loop. Si el disco no da abasto y se juntan más de `max_pendientes`
+    eventos, los nuevos se descartan y se cuentan en `descartados`.
+    """
+
+    def __init__(self, directorio, max_bytes=64 * 1024 * 1024, lote=1000, intervalo=2.0, max_pendientes=100_000,
+                 sufijo=""):
+        self.directorio = directorio
+        self.sufijo = sufijo
+        os.makedirs(directorio, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.lote = lote
+        self.intervalo = intervalo
+        self.max_pendientes = max_pendientes
+        self.descartados = 0
+        self.escritos = 0
+        self._pendientes = []
+        self._escribiendo = False
+        self._cerrado = False
+        self._actual = {}  # día -> (número de archivo, bytes escritos en él)
+        self._cond = threading.Condition()
+        self._hilo = threading.Thread(target=self._escritor, name="bitacora", daemon=True)
+        self._hilo.start()
+
+    @property
+    def pendientes(self):
+        return len(self._pendientes)
+
+    def registrar(self, evento):
+        """`evento` debe traer "dia" (YYYY-MM-DD local): decide en qué archivo va."""
+        with self._cond:
+            if len(self._pendientes) >= self.max_pendientes:
+                self.descartados += 1
+                return
+            self._pendientes.append(evento)
+            if len(self._pendientes) >= self.lote:
+                self._cond.notify()
+
+    # --- archivos ---
+    def _ruta(self, dia, n):
+        return os.path.join(self.directorio, f"eventos-{dia}{self.sufijo}-{n:03d}.jsonl")
+
+    def _archivo_de(self, dia):
+        # al arrancar, seguir en el último archivo que ya haya de ese día
+        if dia not in self._actual:
+            if len(self._actual) > 1:
+                # sólo interesan hoy y, alrededor de medianoche, ayer
+                self._actual = {d: v for d, v in self._actual.items() if d >= dia}
+            n = 0
+            while os.path.exists(self._ruta(dia, n + 1)):
+                n += 1
+            ruta = self._ruta(dia, n)
+            self._actual[dia] = (n, os.path.getsize(ruta) if os.path.exists(ruta) else 0)
+        return self._actual[dia]
+
+    def _escribir(self, eventos):
+        por_dia = {}
+        for evento in eventos:
+            por_dia.setdefault(evento["dia"], []).append(json.dumps(evento, ensure_ascii=False) + "\n")
+        for dia, lineas in por_dia.items():
+            n, tamano = self._archivo_de(dia)
+            if tamano >= self.max_bytes:
+                n, tamano = n + 1, 0
+            datos = "".join(lineas).encode()
+            with open(self._ruta(dia, n), "ab") as f:
+                f.write(datos)
+            self._actual[dia] = (n, tamano + len(datos))
+
+    def _escritor(self):
+        while True:
+            with self._cond:
+                if len(self._pendientes) < self.lote and not self._cerrado:
+                    self._cond.wait(self.intervalo)
+                if not self._pendientes:
+                    if self._cerrado:
+                        return
+                    continue
+                eventos, self._pendientes = self._pendientes, []
+                self._escribiendo = True
+            try:
+                self._escribir(eventos)
+                self.escritos += len(eventos)
+            except OSError as e:
+                # son analíticas: mejor perder un lote que frenar al bot
+                self.descartados += len(eventos)
+                print(f"⚠️ No se pudo escribir la bitácora: {e}")
+                time.sleep(1)
+            with self._cond:
+                self._escribiendo = False
+                self._cond.notify_all()
+
+    def esperar(self):
+        """Fuerza la escritura de lo pendiente y bloquea hasta que esté en disco."""
+        with self._cond:
+            while self._pendientes or self._escribiendo:
+                # despertar al hilo aunque no haya juntado un lote completo
+                self._cond.notify_all()
+                self._cond.wait()
+
+    def cerrar(self):
+        with self._cond:
+            self._cerrado = True
+            self._cond.notify_all()
+        self._hilo.join()
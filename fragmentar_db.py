@@ -0,0 +1,64 @@
+# === FRAGMENTADOR: pepegotchi_db.json (+ diario) <-> directorio de fragmentos ===
+# Uso: python fragmentar_db.py dividir [origen.json] [directorio] [fragmentos]
+#      python fragmentar_db.py unir [directorio] [destino.json]
+# Para cambiar el número de fragmentos: unir y volver a dividir.
+# Después arrancar el bot con DB_BACKEND=fragmentos (y DB_FRAGMENTOS si no son 16).
+import os
+import sys
+import json
+
+from almacenamiento import AlmacenFragmentado, AlmacenJSON
+
+ORIGEN = "pepegotchi_db.json"
+DIARIO = "pepegotchi_db.journal.jsonl"
+DIRECTORIO = "pepegotchi_fragmentos"
+FRAGMENTOS = 16
+
+
+def fragmentos_guardados(directorio):
+    try:
+        with open(os.path.join(directorio, AlmacenFragmentado.MANIFIESTO), "r") as f:
+            return json.load(f)["fragmentos"]
+    except FileNotFoundError:
+        return None
+
+
+def dividir(origen=ORIGEN, directorio=DIRECTORIO, fragmentos=FRAGMENTOS, diario=DIARIO):
+    fragmentos = int(fragmentos)
+    if not os.path.exists(origen):
+        raise SystemExit(f"❌ No existe {origen}")
+    if fragmentos_guardados(directorio) is not None:
+        raise SystemExit(f"❌ {directorio} ya tiene fragmentos; bórralo para dividir de nuevo.")
+    datos = AlmacenJSON(origen, diario).cargar()
+
+    almacen = AlmacenFragmentado(directorio, fragmentos)
+    almacen.guardar_todo(datos)
+    divididos = almacen.cargar()["usuarios"]
+    almacen.cerrar()
+    if set(divididos) != set(datos["usuarios"]):
+        raise SystemExit("❌ Los fragmentos no coinciden con el origen.")
+    print(f"✅ {len(divididos)} usuarios repartidos en {fragmentos} fragmentos en {directorio}")
+
+
+def unir(directorio=DIRECTORIO, destino=ORIGEN, diario=DIARIO):
+    fragmentos = fragmentos_guardados(directorio)
+    if fragmentos is None:
+        raise SystemExit(f"❌ {directorio} no tiene fragmentos")
+    almacen = AlmacenFragmentado(directorio, fragmentos)
+    datos = almacen.cargar()
+    almacen.cerrar()
+
+    json_destino = AlmacenJSON(destino, diario)
+    previos = len(json_destino.cargar()["usuarios"])
+    if previos:
+        raise SystemExit(f"❌ {destino} ya tiene {previos} usuarios; bórralo para unir de nuevo.")
+    json_destino.guardar_todo(datos)
+    if set(json_destino.cargar()["usuarios"]) != set(datos["usuarios"]):
+        raise SystemExit("❌ La unión no coincide con los fragmentos.")
+    print(f"✅ {len(datos['usuarios'])} usuarios de {fragmentos} fragmentos unidos en {destino}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in ("dividir", "unir"):
+        raise SystemExit("Uso: python fragmentar_db.py dividir|unir [...]")
+    {"dividir": dividir, "unir": unir}[sys.argv[1]](*sys.argv[2:])
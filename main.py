@@ -2,263 +2,1494 @@
 import os
 import json
 import asyncio
+import contextvars
+import bisect
+import functools
+import hashlib
+import heapq
+import multiprocessing
+import queue
+import random
+import secrets
+import signal
+import time
+import unicodedata
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field, fields
 from datetime import datetime, timedelta, time as dt_time
 import pytz
+try:
+    import numpy as np
+except ImportError:  # opcional: sin NumPy la simulación recorre los usuarios en Python
+    np = None
 from telegram import Update, InputFile
-from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+from telegram.helpers import escape_markdown
+from telegram.ext import (
+    ApplicationBuilder, BaseUpdateProcessor, CommandHandler, ContextTypes, TypeHandler,
+)
 from dotenv import load_dotenv
+from almacenamiento import crear_backend, fragmento_de
+from metricas import metricas
+from bitacora import Bitacora
+from reloj import Reloj
+import servidor_http
 
 # === CARGAR TOKEN DESDE .env ===
 load_dotenv()
 
 # === CONFIG ===
 DB_FILE = "pepegotchi_db.json"
+# Diario append-only de cambios por usuario; se compacta dentro de DB_FILE
+DB_JOURNAL = "pepegotchi_db.journal.jsonl"
+# Snapshots anteriores de DB_FILE que se conservan (DB_FILE.gen-<n>) por si el último se corrompe
+DB_GENERACIONES = 3
+# Backend de la DB: "json" (DB_FILE + diario), "sqlite" (DB_SQLITE, migrar con migrar_db.py)
+# o "fragmentos" (DB_FRAGMENTOS archivos en DB_FRAGMENTOS_DIR, ver fragmentar_db.py)
+DB_BACKEND = os.getenv("DB_BACKEND", "json")
+DB_SQLITE = "pepegotchi.db"
+DB_FRAGMENTOS_DIR = "pepegotchi_fragmentos"
+DB_FRAGMENTOS = int(os.getenv("DB_FRAGMENTOS", "16"))
 IMAGES_PATH = "images"
+# Tabla de rangos: umbral de xp, nombre, imagen y bono de monedas
+RANGOS_FILE = "rangos.json"
+# file_id de Telegram de cada imagen ya subida
+IMAGES_CACHE = "imagenes_cache.json"
+# Chat del admin; con PRECARGAR_IMAGENES=1 se le suben las imágenes de rango al arrancar
+ADMIN_CHAT_ID = os.getenv("ADMIN_CHAT_ID")
+PRECARGAR_IMAGENES = os.getenv("PRECARGAR_IMAGENES") == "1"
+# Límites de envío (Telegram: ~30 msg/s en total y ~1 msg/s por chat)
+ENVIO_GLOBAL_POR_SEG = 25
+ENVIO_CHAT_POR_SEG = 1
+ENVIO_CHAT_RAFAGA = 3
+ENVIO_EN_VUELO = 8
+ENVIO_MAX_INTENTOS = 5
+# Avisos de fondo (evolución, despertar, referidos) guardados hasta que Telegram los acepta
+OUTBOX_FILE = "pepegotchi_outbox.jsonl"
+# El mismo aviso a muchos usuarios (despertar, cansancio, eventos) entra a la bandeja de a este número por fsync
+LOTE_DIFUSION = 1000
+# Sin red: esperas exponenciales con jitter entre reintentos de envío y de polling
+RED_BACKOFF_BASE = 1
+RED_BACKOFF_MAX = 60
+POLL_TIMEOUT = 30
+# Métricas en formato Prometheus en http://METRICAS_HOST:METRICAS_PORT/metrics (0 = apagado)
+METRICAS_HOST = os.getenv("METRICAS_HOST", "127.0.0.1")
+METRICAS_PORT = int(os.getenv("METRICAS_PORT", "9108"))
+# Recepción de updates: "polling" o "webhook" (servidor HTTP local, ver atender_webhook)
+MODO = os.getenv("MODO", "polling")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "webhook")
+# URL pública (detrás del proxy); sin ella no se llama a setWebhook, útil para pruebas locales
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+# Cuerpos más grandes se rechazan con 413 sin leerlos (un Update queda muy por debajo)
+WEBHOOK_MAX_BYTES = 1024 * 1024
+# Updates procesados a la vez (los de un mismo usuario siempre en orden)
+WORKERS = int(os.getenv("WORKERS", "16"))
+# Con PROCESOS > 1 este proceso sólo recibe updates y los reparte por user_id entre
+# PROCESOS trabajadores (cada usuario vive en uno solo); comparten DB_SQLITE en modo WAL.
+# PROCESO (el índice del trabajador) lo pone el receptor al lanzarlos.
+PROCESOS = int(os.getenv("PROCESOS", "1"))
+PROCESO = int(os.environ["PROCESO"]) if os.getenv("PROCESO") else None
+# Cada cuánto el receptor revisa que los trabajadores sigan vivos (y relanza los caídos)
+PROCESOS_REVISAR = 5
+# Cuánto puede atrasarse el ranking global que arma un trabajador desde la DB compartida
+RANKING_TTL = 5
+# Comandos/callbacks por segundo por usuario (ráfagas de LIMITE_RAFAGA); 0 = sin límite
+LIMITE_POR_SEG = float(os.getenv("LIMITE_POR_SEG", "1"))
+LIMITE_RAFAGA = 5
+AVISO_LENTO = "🐢 ¡Más despacio! Tu Pepegotchi necesita un respiro."
+AVISO_LENTO_CADA = 10
 TZ = pytz.timezone("America/Tegucigalpa")
 # Frecuencia del bucle de fondo (segundos)
 BACKGROUND_SLEEP = 30
+# Duración del sueño y cuántas mascotas se despiertan por lote
+DURACION_SUEÑO = timedelta(hours=6)
+LOTE_DESPERTAR = 100
+# Simulación pasiva (puntos por hora): despierto baja energía y felicidad, dormido recupera energía
+ENERGIA_POR_HORA = -4
+ENERGIA_DORMIDO_POR_HORA = 12
+FELICIDAD_POR_HORA = -3
+# Por debajo se avisa (una vez por cruce) en el tick de la simulación, cada STATS_TICK segundos
+UMBRAL_CANSADO = 20
+UMBRAL_TRISTE = 20
+STATS_TICK = 300
+# Cada cuántos segundos se escriben a disco los usuarios modificados
+FLUSH_INTERVAL = 5
+# Compactación del diario cuando pase de COMPACT_PROPORCION veces el tamaño de la DB (y de
+# COMPACT_MIN_BYTES): lo que se reescribe queda proporcional a lo que cambió, no a la DB
+COMPACT_PROPORCION = 1.0
+COMPACT_MIN_BYTES = 1024 * 1024
+# Bitácora de eventos por comando (vacío = desactivada); ver analizar_bitacora.py
+EVENTOS_DIR = os.getenv("EVENTOS_DIR", "eventos")
+EVENTOS_MAX_BYTES = 64 * 1024 * 1024
+EVENTOS_LOTE = 1000
+EVENTOS_FLUSH = 2
+# Catálogo de la tienda; se revisa si cambió cada TIENDA_REVISAR segundos
+TIENDA_FILE = "tienda.json"
+TIENDA_REVISAR = 5
+# Compras seguidas en un mismo mensaje se muestran juntas en una edición tras esta espera
+TIENDA_AGRUPAR = 1.0
+# Eventos programados (multiplicadores, descuentos y artículos limitados); sin archivo no hay eventos.
+# Cada AGENDA_REVISAR segundos se recarga si cambió y se anuncian los que empiezan o terminan.
+# El formato de cada evento está en agenda.ejemplo.json (no se carga).
+AGENDA_FILE = "agenda.json"
+AGENDA_REVISAR = 60
+if PROCESO is not None:
+    # trabajador: archivos y puerto de métricas propios, y su parte del límite global de envíos
+    OUTBOX_FILE = f"pepegotchi_outbox.{PROCESO}.jsonl"
+    IMAGES_CACHE = f"imagenes_cache.{PROCESO}.json"
+    METRICAS_PORT = METRICAS_PORT + 1 + PROCESO if METRICAS_PORT else 0
+    ENVIO_GLOBAL_POR_SEG = max(1, ENVIO_GLOBAL_POR_SEG // PROCESOS)
 from telegram.ext import CallbackQueryHandler
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
-# === TIENDA PEPEGOTCHI ===
+# === TIENDA PEPEGOTCHI (catálogo en TIENDA_FILE, se recarga solo si cambia) ===
+def normalizar_item(texto):
+    # "Araña", "arana" y "ara ña" -> "arana"
+    sin_acentos = unicodedata.normalize("NFKD", texto.lower())
+    return "".join(c for c in sin_acentos if c.isalnum() and not unicodedata.combining(c))
+
+def validar_articulos(articulos, cantidades):
+    for clave, item in articulos.items():
+        if not isinstance(item, dict) or not isinstance(item.get("nombre"), str):
+            raise ValueError(f"{clave}: falta 'nombre'")
+        for campo, minimo in (("precio", 1), ("xp", 0), ("energia", 0)):
+            if not isinstance(item.get(campo), int) or item[campo] < minimo:
+                raise ValueError(f"{clave}: '{campo}' debe ser un entero >= {minimo}")
+        # límite de Telegram para callback_data
+        if len(f"buy_{clave}_{max(cantidades)}".encode()) > 64:
+            raise ValueError(f"{clave}: clave demasiado larga")
+
+def validar_catalogo(datos):
+    articulos = datos.get("articulos") if isinstance(datos, dict) else None
+    if not isinstance(articulos, dict) or not articulos:
+        raise ValueError("falta 'articulos'")
+    cantidades = datos.get("cantidades", [1])
+    if not isinstance(cantidades, list) or 1 not in cantidades or any(not isinstance(n, int) or n < 1 for n in cantidades):
+        raise ValueError("'cantidades' deben ser enteros positivos e incluir 1")
+    validar_articulos(articulos, cantidades)
+    return articulos, sorted(set(cantidades))
+
+class Catalogo:
+    """Artículos de la tienda y su teclado, construido una vez por versión
+    (y por tramo de eventos activos, que cambian precios y agregan artículos).
+
+    `actual()` revisa el archivo como mucho cada TIENDA_REVISAR segundos; si
+    cambió y es válido, pasa a una versión nueva. Si no es válido se sigue
+    con la anterior.
+    """
+
+    def __init__(self, archivo):
+        self.archivo = archivo
+        self.articulos = {}
+        self.cantidades = [1]
+        self.version = 0
+        self._firma = None
+        self._revisado = 0.0
+        self._alias = {}
+        self._teclados = {}  # versión de los Modificadores -> teclado
+
+    def cargar(self):
+        estado = os.stat(self.archivo)
+        with open(self.archivo, "r", encoding="utf-8") as f:
+            self.articulos, self.cantidades = validar_catalogo(json.load(f))
+        self._firma = (estado.st_mtime_ns, estado.st_size)
+        self._alias = {normalizar_item(clave): clave for clave in self.articulos}
+        self._teclados = {}
+        self.version += 1
+
+    def actual(self):
+        ahora = time.monotonic()
+        if ahora - self._revisado >= TIENDA_REVISAR:
+            self._revisado = ahora
+            try:
+                estado = os.stat(self.archivo)
+                firma = (estado.st_mtime_ns, estado.st_size)
+                if firma != self._firma:
+                    self.cargar()
+                    print(f"🛒 Catálogo recargado (versión {self.version}, {len(self.articulos)} artículos)")
+            except (OSError, ValueError) as e:
+                # no volver a avisar hasta que el archivo cambie otra vez
+                self._firma = firma if isinstance(e, ValueError) else self._firma
+                print(f"⚠️ {self.archivo} no válido, se mantiene la versión {self.version}: {e}")
+        return self
+
+    def buscar(self, texto):
+        return self._alias.get(normalizar_item(texto))
+
+    def teclado(self, mod=None):
+        """Teclado con los precios de `mod` (los eventos activos) y sus artículos limitados al final."""
+        mod = mod or SIN_EVENTOS
+        teclado = self._teclados.get(mod.version)
+        if teclado is None:
+            if len(self._teclados) >= 8:
+                self._teclados.clear()  # tramos viejos que ya no vuelven
+            articulos = dict(self.articulos)
+            for clave, item in mod.articulos.items():
+                articulos.setdefault(clave, item)
+            teclado = self._teclados[mod.version] = InlineKeyboardMarkup([
+                [
+                    InlineKeyboardButton(
+                        f"{item['nombre']} ({mod.precio(item['precio'])})" if n == 1
+                        else f"×{n} ({mod.precio(item['precio']) * n})",
+                        callback_data=f"buy_{clave}_{n}",
+                    )
+                    for n in self.cantidades
+                ]
+                for clave, item in articulos.items()
+            ])
+        return teclado
+
+catalogo = Catalogo(TIENDA_FILE)
+catalogo.cargar()
+
+# === EVENTOS PROGRAMADOS (agenda en AGENDA_FILE) ===
+# Cada evento tiene inicio y fin y puede multiplicar la XP y las monedas,
+# descontar la tienda y agregarle artículos limitados. Los handlers no
+# recorren la lista de eventos: piden agenda.activos(), que devuelve el efecto
+# combinado ya calculado del tramo actual.
+@dataclass(frozen=True, slots=True)
+class Evento:
+    id: str
+    nombre: str
+    inicio: float        # epoch
+    fin: float           # epoch, excluido
+    xp: float = 1.0      # multiplicadores
+    monedas: float = 1.0
+    descuento: float = 0.0   # 0.2 = 20 % menos en la tienda
+    articulos: dict = field(default_factory=dict)   # sólo se venden durante el evento
+    descripcion: str = ""
+
+@dataclass(frozen=True, slots=True)
+class Modificadores:
+    """Efecto combinado de los eventos activos: multiplicadores que se
+    multiplican, el mayor descuento y todos los artículos limitados."""
+    version: int
+    eventos: tuple = ()
+    xp: float = 1.0
+    monedas: float = 1.0
+    descuento: float = 0.0
+    articulos: dict = field(default_factory=dict)
+
+    def con_xp(self, xp):
+        return xp if self.xp == 1 else round(xp * self.xp)
+
+    def con_monedas(self, monedas):
+        return monedas if self.monedas == 1 else round(monedas * self.monedas)
+
+    def precio(self, precio):
+        return precio if not self.descuento else max(1, round(precio * (1 - self.descuento)))
+
+SIN_EVENTOS = Modificadores(version=0)
+
+def _instante(texto, donde):
+    try:
+        fecha = datetime.fromisoformat(texto)
+    except (TypeError, ValueError):
+        raise ValueError(f"{donde}: fecha no válida {texto!r}") from None
+    if fecha.tzinfo is None:
+        fecha = TZ.localize(fecha)  # sin offset: hora de Honduras
+    return fecha.timestamp()
+
+def validar_agenda(datos, cat):
+    lista = datos.get("eventos") if isinstance(datos, dict) else None
+    if not isinstance(lista, list):
+        raise ValueError("falta 'eventos'")
+    eventos = []
+    articulos = {}
+    for e in lista:
+        if not isinstance(e, dict) or not isinstance(e.get("id"), str) or not isinstance(e.get("nombre"), str):
+            raise ValueError("cada evento necesita 'id' y 'nombre'")
+        donde = e["id"]
+        inicio, fin = _instante(e.get("inicio"), donde), _instante(e.get("fin"), donde)
+        if fin <= inicio:
+            raise ValueError(f"{donde}: 'fin' debe ser posterior a 'inicio'")
+        for campo in ("xp", "monedas"):
+            if not isinstance(e.get(campo, 1), (int, float)) or e.get(campo, 1) <= 0:
+                raise ValueError(f"{donde}: '{campo}' debe ser un número > 0")
+        descuento = e.get("descuento", 0)
+        if not isinstance(descuento, (int, float)) or not 0 <= descuento < 1:
+            raise ValueError(f"{donde}: 'descuento' debe estar entre 0 y 1")
+        propios = e.get("articulos", {})
+        if not isinstance(propios, dict):
+            raise ValueError(f"{donde}: 'articulos' debe ser un objeto")
+        validar_articulos(propios, cat.cantidades)
+        for clave, item in propios.items():
+            # la clave va en el inventario: no puede significar otra cosa que en la tienda u otro evento
+            if clave in cat.articulos or articulos.get(clave, item) != item:
+                raise ValueError(f"{donde}: el artículo {clave} ya existe con otros datos")
+            articulos[clave] = item
+        eventos.append(Evento(
+            id=e["id"], nombre=e["nombre"], inicio=inicio, fin=fin,
+            xp=e.get("xp", 1), monedas=e.get("monedas", 1), descuento=descuento,
+            articulos=propios, descripcion=e.get("descripcion", ""),
+        ))
+    if len({e.id for e in eventos}) != len(eventos):
+        raise ValueError("hay 'id' de eventos repetidos")
+    eventos.sort(key=lambda e: e.inicio)
+    return eventos, articulos
+
+class AgendaEventos:
+    """Eventos de AGENDA_FILE e índice por intervalos de los activos.
+
+    Al cargar, los inicios y fines parten la línea de tiempo en tramos y se
+    arma una vez el Modificadores de cada tramo. `activos()` sólo compara la
+    hora con los bordes del tramo actual; al cruzar uno busca (bisect) el
+    siguiente. Sin archivo no hay eventos.
+    """
+
+    def __init__(self, archivo):
+        self.archivo = archivo
+        self.eventos = []
+        self.articulos = {}   # de todos los eventos, también los terminados (siguen en inventarios)
+        self.anunciados = {}  # id -> Evento activos ya anunciados
+        self._alias = {}
+        self._firma = None
+        self._version = 0
+        self._cortes = []
+        self._tramos = [SIN_EVENTOS]
+        self._desde, self._hasta = float("inf"), float("-inf")  # fuerza la búsqueda
+        self._actual = SIN_EVENTOS
+
+    def _leer(self):
+        try:
+            estado = os.stat(self.archivo)
+        except FileNotFoundError:
+            return None, [], {}
+        with open(self.archivo, "r", encoding="utf-8") as f:
+            eventos, articulos = validar_agenda(json.load(f), catalogo)
+        return (estado.st_mtime_ns, estado.st_size), eventos, articulos
+
+    def cargar(self):
+        self._firma, self.eventos, self.articulos = self._leer()
+        self._alias = {normalizar_item(clave): clave for clave in self.articulos}
+        self._cortes = sorted({e.inicio for e in self.eventos} | {e.fin for e in self.eventos})
+        # tramo i = [cortes[i-1], cortes[i]); el 0 es todo lo anterior al primer corte
+        self._tramos = [SIN_EVENTOS] + [self._combinar(t) for t in self._cortes]
+        self._desde, self._hasta = float("inf"), float("-inf")
+
+    def _combinar(self, t):
+        eventos = tuple(e for e in self.eventos if e.inicio <= t < e.fin)
+        if not eventos:
+            return SIN_EVENTOS
+        self._version += 1
+        xp = monedas = 1.0
+        articulos = {}
+        for e in eventos:
+            xp *= e.xp
+            monedas *= e.monedas
+            articulos.update(e.articulos)
+        return Modificadores(
+            version=self._version, eventos=eventos, xp=xp, monedas=monedas,
+            descuento=max(e.descuento for e in eventos), articulos=articulos,
+        )
 
-TIENDA = {
-    "mosca": {"precio": 50, "xp": 30, "energia": 0},
-    "mosquito": {"precio": 75, "xp": 50, "energia": 0},
-    "araña": {"precio": 100, "xp": 100, "energia": 0},
-    "paseo": {"precio": 100, "xp": 45, "energia": 0},
-    "polillas": {"precio": 125, "xp": 50, "energia": 0},
-    "pocion": {"precio": 300, "xp": 0, "energia": 100},
-}
+    def revisar(self):
+        """Recarga si el archivo cambió (o apareció/desapareció); si no es válido sigue la agenda anterior."""
+        try:
+            estado = os.stat(self.archivo)
+            firma = (estado.st_mtime_ns, estado.st_size)
+        except FileNotFoundError:
+            firma = None
+        if firma == self._firma:
+            return
+        try:
+            self.cargar()
+            print(f"🎉 Agenda recargada ({len(self.eventos)} eventos)")
+        except (OSError, ValueError) as e:
+            self._firma = firma  # no volver a avisar hasta que cambie otra vez
+            print(f"⚠️ {self.archivo} no válido, se mantiene la agenda anterior: {e}")
+
+    def activos(self, ahora=None):
+        ahora = reloj.ahora() if ahora is None else ahora
+        if not self._desde <= ahora < self._hasta:
+            i = bisect.bisect_right(self._cortes, ahora)
+            self._desde = self._cortes[i - 1] if i else float("-inf")
+            self._hasta = self._cortes[i] if i < len(self._cortes) else float("inf")
+            self._actual = self._tramos[i]
+        return self._actual
+
+    def proximos(self, ahora, n=3):
+        return [e for e in self.eventos if e.inicio > ahora][:n]
+
+    def buscar(self, texto):
+        return self._alias.get(normalizar_item(texto))
+
+agenda = AgendaEventos(AGENDA_FILE)
+agenda.cargar()
+
+def datos_articulo(clave, cat=None):
+    """Artículo de la tienda o de algún evento (aunque ya haya terminado), o None."""
+    return (cat or catalogo).articulos.get(clave) or agenda.articulos.get(clave)
 
 async def tienda(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
-    datos = cargar_datos()
+    usuario = almacen.usuario(user_id)
 
-    if user_id not in datos["usuarios"]:
-        await update.message.reply_text("Primero inicia tu Pepegotchi con /start")
+    if usuario is None:
+        await responder(update, "Primero inicia tu Pepegotchi con /start")
         return
 
-    usuario = datos["usuarios"][user_id]
-
-    texto = (
-        "🛒 *Tienda Pepegotchi*\n\n"
-        f"Tienes 💰 {usuario['monedas']} monedas\n\n"
-        "Elige un artículo abajo:"
-    )
-
-    # Botones
-    teclado = [
-        [InlineKeyboardButton("🪰 Mosca (50)", callback_data="buy_mosca")],
-        [InlineKeyboardButton("🦟 Mosquito (75)", callback_data="buy_mosquito")],
-        [InlineKeyboardButton("🕷 Araña (100)", callback_data="buy_araña")],
-        [InlineKeyboardButton("🌿 Paseo (100)", callback_data="buy_paseo")],
-        [InlineKeyboardButton("🦋 Polillas (125)", callback_data="buy_polillas")],
-        [InlineKeyboardButton("🧪 Poción (300)", callback_data="buy_pocion")],
-    ]
-    reply_markup = InlineKeyboardMarkup(teclado)
-
-    await update.message.reply_text(texto, parse_mode="Markdown", reply_markup=reply_markup)
+    mod = agenda.activos()
+    texto = "🛒 *Tienda Pepegotchi*\n\n"
+    if mod.descuento:
+        texto += f"🏷️ {mod.descuento:.0%} de descuento por evento (/evento)\n"
+    if mod.articulos:
+        texto += "🎉 Sólo durante el evento: " + ", ".join(i["nombre"] for i in mod.articulos.values()) + "\n"
+    texto += f"\nTienes 💰 {usuario.monedas} monedas\n\nElige un artículo abajo:"
+    await responder(update, texto, parse_mode="Markdown", reply_markup=catalogo.actual().teclado(mod))
 
+# compras de cada mensaje de la tienda que todavía no se mostraron:
+# (chat_id, message_id) -> {"user_id": ..., "update": ..., "items": {clave: cantidad}, "gastado": monedas}
+compras_pendientes = {}
 
 async def comprar_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
-
     user_id = str(query.from_user.id)
-    datos = cargar_datos()
 
-    if user_id not in datos["usuarios"]:
-        await query.edit_message_text("Primero inicia tu Pepegotchi con /start")
-        return
-
-    accion = query.data.replace("buy_", "")  # buy_mosca → mosca
-
-    if accion not in TIENDA:
-        await query.edit_message_text("Ese artículo no existe.")
-        return
-
-    usuario = datos["usuarios"][user_id]
-    item = TIENDA[accion]
-
-    # Validar dinero
-    if usuario["monedas"] < item["precio"]:
-        await query.edit_message_text("No tienes suficientes monedas 💸")
-        return
-
-    # Aplicar compra
-    usuario["monedas"] -= item["precio"]
-    usuario["xp"] += item["xp"]
-    usuario["energia"] = min(100, usuario["energia"] + item["energia"])
+    # buy_mosca_5 -> ("mosca", 5); los botones viejos (buy_mosca) compran 1
+    accion = query.data.removeprefix("buy_")
+    clave, _, n = accion.rpartition("_")
+    if not n.isdigit():
+        clave, n = accion, "1"
+    cantidad = int(n)
+    cat = catalogo.actual()
+    mod = agenda.activos()
+
+    async with almacen.bloqueo(user_id):
+        usuario = almacen.usuario(user_id)
+
+        if usuario is None:
+            await query.answer()
+            await editar(update, "Primero inicia tu Pepegotchi con /start")
+            return
 
-    guardar_datos(datos)
+        # los artículos de un evento sólo se venden mientras está activo
+        item = cat.articulos.get(clave) or mod.articulos.get(clave)
+        if item is None or cantidad not in cat.cantidades:
+            await query.answer("Ese artículo no existe o ya no está a la venta.", show_alert=True)
+            return
 
-    await query.edit_message_text(
-        f"🎉 Compraste *{accion}*!\n"
-        f"+{item['xp']} XP ✨\n"
-        f"+{item['energia']} ⚡ energía\n"
-        f"Monedas restantes: {usuario['monedas']} 💰",
-        parse_mode="Markdown"
+        # un solo débito por botón, sea de 1 o de N
+        total = mod.precio(item["precio"]) * cantidad
+        if usuario.monedas < total:
+            anotar(resultado="sin_monedas", articulo=clave, cantidad=cantidad)
+            await query.answer("No tienes suficientes monedas 💸", show_alert=True)
+            return
+        usuario.monedas -= total
+        usuario.inventario[clave] = usuario.inventario.get(clave, 0) + cantidad
+        almacen.marcar(user_id)
+        anotar(articulo=clave, cantidad=cantidad)
+
+    await query.answer(f"🛒 +{cantidad} {item['nombre']}")
+
+    # varias compras seguidas en el mismo mensaje -> una sola edición
+    mensaje = (query.message.chat.id, query.message.message_id)
+    pendiente = compras_pendientes.get(mensaje)
+    if pendiente is None:
+        pendiente = compras_pendientes[mensaje] = {"user_id": user_id, "update": update, "items": {}, "gastado": 0}
+        # un job y no una tarea suelta; lo que quede al apagar lo muestra al_apagar
+        context.job_queue.run_once(mostrar_compras, TIENDA_AGRUPAR, data=mensaje)
+    pendiente["items"][clave] = pendiente["items"].get(clave, 0) + cantidad
+    pendiente["gastado"] += total
+
+async def mostrar_compras(context: ContextTypes.DEFAULT_TYPE):
+    await _mostrar_compras(context.job.data)
+
+async def mostrar_compras_pendientes():
+    # al apagar el job_queue ya no corre: las ediciones que esperaban salen ya
+    for mensaje in list(compras_pendientes):
+        await _mostrar_compras(mensaje)
+
+async def _mostrar_compras(mensaje):
+    pendiente = compras_pendientes.pop(mensaje, None)
+    if pendiente is None:
+        return  # ya se mostró al apagar
+    usuario = almacen.usuario(pendiente["user_id"])
+    lineas = "\n".join(
+        f"• {cantidad}× {(datos_articulo(clave) or {'nombre': clave})['nombre']}"
+        for clave, cantidad in pendiente["items"].items()
     )
-# === UTIL: LOAD / SAVE DB (seguros y optimizados) ===
-def cargar_datos():
-    if not os.path.exists(DB_FILE):
-        return {"usuarios": {}}
-    try:
-        with open(DB_FILE, "r") as f:
-            return json.load(f)
-    except Exception:
-        # si falla al leer, devolver estructura vacía para no bloquear el bot
-        return {"usuarios": {}}
-
-def guardar_datos(data):
-    # write atomically: escribir en temporal y renombrar
-    tmp = DB_FILE + ".tmp"
     try:
+        await editar(
+            pendiente["update"],
+            f"🎉 *Compraste:*\n{lineas}\n\n"
+            f"💸 Gastaste {pendiente['gastado']} · te quedan {usuario.monedas} 💰\n"
+            "🎒 Usa /usar <ítem> para dárselo a tu Pepegotchi",
+            parse_mode="Markdown",
+            reply_markup=catalogo.teclado(agenda.activos()),
+        )
+    except TelegramError as e:
+        print(f"⚠️ No se pudo mostrar la compra de {pendiente['user_id']}: {e}")
+# === UTIL: LOAD / SAVE DB (ver almacenamiento.py) ===
+backend = crear_backend(
+    DB_BACKEND, DB_FILE, DB_JOURNAL, DB_SQLITE, DB_FRAGMENTOS_DIR, DB_FRAGMENTOS, DB_GENERACIONES,
+    propios=(PROCESO, PROCESOS) if PROCESO is not None else None,
+)
+
+@metricas.cronometrado("pepegotchi_db_segundos", operacion="cargar")
+def cargar_datos():
+    return backend.cargar()
+
+# === MODELO DE USUARIO + MIGRACIONES DE ESQUEMA ===
+# Cada registro guardado lleva "schema_version"; al cargarlo se le aplican en
+# orden las migraciones que le falten, una sola vez, y se vuelve a guardar.
+def _migrar_v1(user_id, d):
+    """Esquema original: unifica los campos duplicados y completa los que faltan."""
+    # primera versión de /dormir: is_sleeping + sleep_until -> durmiendo
+    if d.pop("is_sleeping", False) and d.get("sleep_until"):
+        d["durmiendo"] = True
+    if not d.get("durmiendo"):
+        d["sleep_until"] = None
+    elif not d.get("sleep_until") and d.get("hora_dormir"):
+        d["sleep_until"] = (datetime.fromisoformat(d["hora_dormir"]) + DURACION_SUEÑO).isoformat()
+
+    # veces_alimento/veces_juego {fecha: veces} y acciones_hoy -> daily del último día
+    alimento = d.pop("veces_alimento", None) or {}
+    juego = d.pop("veces_juego", None) or {}
+    d.pop("acciones_hoy", None)
+    daily = d.get("daily") or {}
+    ultimo_dia = max([*alimento, *juego], default=None)
+    if ultimo_dia and (daily.get("date") or "") < ultimo_dia:
+        daily = {"date": ultimo_dia, "alimentar": alimento.get(ultimo_dia, 0), "jugar": juego.get(ultimo_dia, 0)}
+    d["daily"] = {
+        "date": daily.get("date"),
+        "alimentar": daily.get("alimentar", 0),
+        "jugar": daily.get("jugar", 0),
+    }
+
+    # estado() mostraba felicidad y nivel, pero nadie los escribía
+    d.setdefault("felicidad", 100)
+    d.pop("nivel", None)
+    d.setdefault("codigo", user_id[-5:])
+    d.setdefault("ultimo_rango", obtener_rango(d.get("xp", 0)))
+
+def _migrar_v2(user_id, d):
+    """ultimo_rango pasa del nombre mostrado ("🐸 Bebé") a su índice en RANGOS."""
+    rango = d.get("ultimo_rango")
+    if isinstance(rango, str):
+        nombres = [r.nombre for r in RANGOS]
+        # un nombre que ya no está en la tabla cuenta como el rango de su xp (sin bono)
+        d["ultimo_rango"] = nombres.index(rango) if rango in nombres else indice_rango(d.get("xp", 0))
+
+MIGRACIONES = (_migrar_v1, _migrar_v2)
+ESQUEMA_VERSION = len(MIGRACIONES)
+
+@dataclass(slots=True)
+class Usuario:
+    nombre: str = "Jugador"
+    xp: int = 0
+    monedas: int = 50
+    energia: float = 100
+    felicidad: float = 100
+    codigo: str = ""
+    referidos: list = field(default_factory=list)
+    inventario: dict = field(default_factory=dict)
+    durmiendo: bool = False
+    hora_dormir: str | None = None
+    sleep_until: str | None = None
+    ultimo_sueno: str | None = None
+    ultimo_checkin: str | None = None
+    ultimo_rango: int | None = None  # índice en RANGOS; None = aún sin anunciar
+    referido_por: str | None = None
+    stats_ts: float | None = None  # cuándo se calcularon energia y felicidad (ver actualizar_stats)
+    daily: dict = field(default_factory=lambda: {"date": None, "alimentar": 0, "jugar": 0})
+    # campos que este código no conoce; se conservan tal cual al guardar
+    extra: dict | None = None
+
+    @classmethod
+    def desde_dict(cls, user_id, d):
+        version = d.get("schema_version", 0)
+        if version < ESQUEMA_VERSION:
+            d = dict(d)
+            for migracion in MIGRACIONES[version:]:
+                migracion(user_id, d)
+        conocidos = {}
+        extra = {}
+        for campo, valor in d.items():
+            if campo in CAMPOS_USUARIO:
+                conocidos[campo] = valor
+            elif campo != "schema_version":
+                extra[campo] = valor
+        return cls(**conocidos, extra=extra or None)
+
+    def a_dict(self):
+        d = {campo: getattr(self, campo) for campo in CAMPOS_USUARIO}
+        if self.extra:
+            d.update(self.extra)
+        d["schema_version"] = ESQUEMA_VERSION
+        return d
+
+CAMPOS_USUARIO = tuple(f.name for f in fields(Usuario) if f.name != "extra")
+
+# === ALMACÉN EN MEMORIA (una sola carga, guardado por lotes) ===
+class AlmacenUsuarios:
+    """DB residente en memoria, como objetos Usuario.
+
+    Los handlers modifican los usuarios dentro de `bloqueo(user_id)` y llaman
+    a `marcar(user_id)`; los cambios se escriben a disco agrupados cada
+    FLUSH_INTERVAL segundos a través del backend (ver almacenamiento.py), y
+    al apagar el bot se compacta.
+    """
+
+    def __init__(self):
+        self.usuarios = {}
+        self._bloqueos = {}
+        self._sucios = set()
+        self._tocados = set()  # modificados desde el último tick de la simulación
+        self._compactando = None  # tarea de la compactación de fondo en curso
+
+    def cargar(self):
+        self.usuarios = {}
+        for user_id, registro in cargar_datos().get("usuarios", {}).items():
+            self.usuarios[user_id] = Usuario.desde_dict(user_id, registro)
+            if registro.get("schema_version", 0) < ESQUEMA_VERSION:
+                # guardar ya migrado para no repetir la migración
+                self._sucios.add(user_id)
+
+    def bloqueo(self, user_id):
+        lock = self._bloqueos.get(user_id)
+        if lock is None:
+            lock = self._bloqueos[user_id] = asyncio.Lock()
+        return lock
+
+    def usuario(self, user_id):
+        return self.usuarios.get(user_id)
+
+    def marcar(self, user_id):
+        self._sucios.add(user_id)
+        self._tocados.add(user_id)
+
+    def tomar_tocados(self):
+        tocados, self._tocados = self._tocados, set()
+        return tocados
+
+    def a_datos(self):
+        return {"usuarios": {user_id: user.a_dict() for user_id, user in self.usuarios.items()}}
+
+    def guardar(self):
+        # persiste los cambios del lote; devuelve cuántos usuarios había sucios
+        if not self._sucios:
+            return 0
+        t = time.perf_counter()
+        sucios, self._sucios = self._sucios, set()
+        registros = {user_id: self.usuarios[user_id].a_dict() for user_id in sucios if user_id in self.usuarios}
+        try:
+            backend.registrar(registros, sucios)
+        except Exception:
+            # disco lleno, EIO...: siguen sucios y se reintentan en el próximo lote
+            self._sucios |= sucios
+            raise
+        metricas.observar("pepegotchi_db_segundos", time.perf_counter() - t, operacion="registrar")
+        metricas.contar("pepegotchi_db_usuarios_escritos_total", len(sucios))
+        return len(sucios)
+
+    @metricas.cronometrado("pepegotchi_db_segundos", operacion="compactar")
+    def compactar(self):
+        self.guardar()
+        backend.compactar(self.a_datos)
+
+    def compactar_de_fondo(self, app):
+        """Como compactar(), pero la serialización y el fsync del snapshot
+        corren en un hilo con una copia de los registros. Una a la vez."""
+        if self._compactando is None or self._compactando.done():
+            self._compactando = app.create_task(self._compactar_en_hilo())
+
+    async def _compactar_en_hilo(self):
+        t = time.perf_counter()
+        self.guardar()
+        escribir, terminar = backend.empezar_compactacion(self.a_datos)
+        if escribir is not None:
+            await asyncio.to_thread(escribir)
+        terminar()
+        metricas.observar("pepegotchi_db_segundos", time.perf_counter() - t, operacion="compactar")
+
+    async def esperar_compactacion(self):
+        if self._compactando is not None:
+            await asyncio.wait([self._compactando])
+
+almacen = AlmacenUsuarios()
+
+async def guardar_pendientes(context: ContextTypes.DEFAULT_TYPE):
+    if PROCESO is not None:
+        await aplicar_buzon()
+    almacen.guardar()
+    if backend.tamano_diario() > max(COMPACT_MIN_BYTES, COMPACT_PROPORCION * backend.tamano()):
+        almacen.compactar_de_fondo(context.application)
+
+# === AUX: obtener (o crear) el usuario ===
+def asegurar_usuario(user_id, nombre=None):
+    user = almacen.usuario(user_id)
+    if user is None:
+        user = almacen.usuarios[user_id] = Usuario(
+            nombre=nombre or "Jugador", codigo=nuevo_codigo(user_id), stats_ts=reloj.ahora()
+        )
+        indice_codigos[user.codigo] = user_id
+        almacen.marcar(user_id)
+        indice_xp.actualizar(user_id, user.xp)
+    else:
+        actualizar_stats(user)
+    return user
+
+# === DESPACHADOR DE MENSAJES: cola con límites de Telegram y reintentos ===
+class Cubeta:
+    """Token bucket: `tasa` envíos por segundo con ráfagas de hasta `capacidad`."""
+    __slots__ = ("tasa", "capacidad", "tokens", "t")
+
+    def __init__(self, tasa, capacidad):
+        self.tasa = tasa
+        self.capacidad = capacidad
+        self.tokens = capacidad
+        self.t = time.monotonic()
+
+    def espera(self, ahora):
+        # toma un token y devuelve 0, o devuelve cuántos segundos faltan para tener uno
+        self.tokens = min(self.capacidad, self.tokens + (ahora - self.t) * self.tasa)
+        self.t = ahora
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.tasa
+
+    def llena(self, ahora):
+        return self.tokens + (ahora - self.t) * self.tasa >= self.capacidad
+
+class Backoff:
+    """Esperas exponenciales (base·2^n, hasta `maximo`) con jitter: al azar entre la mitad y el total."""
+
+    def __init__(self, base, maximo):
+        self.base = base
+        self.maximo = maximo
+        self.fallos = 0
+
+    def siguiente(self):
+        espera = min(self.maximo, self.base * 2 ** self.fallos)
+        self.fallos += 1
+        return random.uniform(espera / 2, espera)
+
+    def reiniciar(self):
+        self.fallos = 0
+
+class BandejaSalida:
+    """Avisos de fondo persistidos en un JSONL hasta que Telegram los acepta.
+
+    Cada aviso es una línea {"id", "chat_id", "texto", "kw"}; al confirmarlo
+    se agrega {"ok": id}. Al arrancar se reenvía, en orden, lo no confirmado
+    (entrega al menos una vez). El archivo se vacía cuando no queda nada pendiente.
+    """
+
+    def __init__(self, archivo):
+        self.archivo = archivo
+        self.pendientes = {}  # id -> aviso, en orden de llegada
+        self._siguiente = 1
+
+    def cargar(self):
+        self.pendientes = {}
+        if os.path.exists(self.archivo):
+            with open(self.archivo, "r") as f:
+                for linea in f:
+                    try:
+                        registro = json.loads(linea)
+                    except ValueError:
+                        break  # última línea a medio escribir
+                    if "ok" in registro:
+                        self.pendientes.pop(registro["ok"], None)
+                    else:
+                        self.pendientes[registro["id"]] = registro
+                        self._siguiente = max(self._siguiente, registro["id"] + 1)
+        # reescribir sólo lo pendiente (y sin la posible línea cortada al final)
+        tmp = self.archivo + ".tmp"
         with open(tmp, "w") as f:
-            json.dump(data, f, indent=4)
-        os.replace(tmp, DB_FILE)
-    except Exception:
-        # fallback simple
-        with open(DB_FILE, "w") as f:
-            json.dump(data, f, indent=4)
-
-# === AUX: asegurarse de que el usuario tiene todas las claves necesarias ===
-def asegurar_usuario(datos, user_id, nombre=None):
-    if user_id not in datos["usuarios"]:
-        datos["usuarios"][user_id] = {
-            "nombre": nombre or "Jugador",
-            "xp": 0,
-            "monedas": 50,
-            "referidos": [],
-            "codigo": user_id[-5:],
-            "inventario": {},
-            "ultimo_sueno": None,
-            "is_sleeping": False,
-            "sleep_until": None,
-            "ultimo_checkin": None,
-            "ultimo_rango": None,
-            "energia": 100,
-            "daily": {
-                "date": None,
-                "alimentar": 0,
-                "jugar": 0
-            }
+            f.writelines(json.dumps(aviso) + "\n" for aviso in self.pendientes.values())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.archivo)
+        return list(self.pendientes.values())
+
+    def agregar(self, chat_id, texto, **kwargs):
+        aviso = {"id": self._siguiente, "chat_id": str(chat_id), "texto": texto, "kw": kwargs}
+        self._siguiente += 1
+        with open(self.archivo, "a") as f:
+            f.write(json.dumps(aviso) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.pendientes[aviso["id"]] = aviso
+        return aviso
+
+    def agregar_varios(self, chat_ids, texto, **kwargs):
+        """El mismo aviso para muchos chats con una sola escritura y un solo fsync."""
+        avisos = []
+        for chat_id in chat_ids:
+            avisos.append({"id": self._siguiente, "chat_id": str(chat_id), "texto": texto, "kw": kwargs})
+            self._siguiente += 1
+        with open(self.archivo, "a") as f:
+            f.write("".join(json.dumps(aviso) + "\n" for aviso in avisos))
+            f.flush()
+            os.fsync(f.fileno())
+        for aviso in avisos:
+            self.pendientes[aviso["id"]] = aviso
+        return avisos
+
+    def confirmar(self, aviso_id):
+        self.pendientes.pop(aviso_id, None)
+        if not self.pendientes:
+            # nada pendiente: empezar de cero en vez de acumular confirmaciones
+            open(self.archivo, "w").close()
+            return
+        # sin fsync: si se pierde, el aviso sólo se repite al reiniciar
+        with open(self.archivo, "a") as f:
+            f.write(json.dumps({"ok": aviso_id}) + "\n")
+
+class Despachador:
+    """Todos los envíos a Telegram pasan por aquí.
+
+    Hay una cubeta global y una por chat; los mensajes de un mismo chat salen
+    en orden. RetryAfter pausa todos los envíos el tiempo que pide Telegram.
+    Un error de red abre el circuito: se pausan todos los envíos con backoff
+    exponencial y el primer envío que vuelve a salir lo cierra. `enviar()`
+    espera el resultado (handlers, con ENVIO_MAX_INTENTOS); `notificar()` no
+    espera (tareas de fondo), pasa por la bandeja de salida y se reintenta
+    hasta que sale.
+    """
+
+    def __init__(self, bandeja):
+        self.bandeja = bandeja
+        self._bot = None
+        self._colas = {}      # chat_id -> deque de envíos [funcion, args, kwargs, futuro, intentos, aviso_id]
+        self._listos = asyncio.Queue()
+        self._cubetas = {}
+        self._global = Cubeta(ENVIO_GLOBAL_POR_SEG, ENVIO_GLOBAL_POR_SEG)
+        self._en_vuelo = asyncio.Semaphore(ENVIO_EN_VUELO)
+        self._pausa_hasta = 0.0
+        self._circuito_hasta = 0.0
+        self._backoff = Backoff(RED_BACKOFF_BASE, RED_BACKOFF_MAX)
+        self.sin_red = False
+        self._tarea = None
+        self.pendientes = 0
+        self.enviados = 0
+        self.reintentos = 0
+        self.descartados = 0
+
+    def estadisticas(self):
+        return {
+            "pendientes": self.pendientes,
+            "enviados": self.enviados,
+            "reintentos": self.reintentos,
+            "descartados": self.descartados,
+            "bandeja": len(self.bandeja.pendientes),
+            "sin_red": self.sin_red,
         }
-    user = datos["usuarios"][user_id]
-    # asegurar claves en DB antigua
-    user.setdefault("monedas", 50)
-    user.setdefault("inventario", {})
-    user.setdefault("ultimo_sueno", None)
-    user.setdefault("is_sleeping", False)
-    user.setdefault("sleep_until", None)
-    user.setdefault("ultimo_checkin", None)
-    user.setdefault("ultimo_rango", obtener_rango(user.get("xp", 0)))
-    user.setdefault("energia", 100)
-    user.setdefault("daily", {"date": None, "alimentar": 0, "jugar": 0})
-    # si falta alguna subclave, setearla
-    daily = user["daily"]
-    daily.setdefault("date", None)
-    daily.setdefault("alimentar", 0)
-    daily.setdefault("jugar", 0)
-    return user
 
-# === RANGOS / IMAGENES ===
+    def iniciar(self, bot):
+        self._bot = bot
+        avisos = self.bandeja.cargar()
+        if avisos:
+            print(f"📬 Reenviando {len(avisos)} avisos pendientes de la bandeja de salida")
+        for aviso in avisos:
+            self._encolar_aviso(aviso)
+        self._tarea = asyncio.create_task(self._bucle())
+
+    async def detener(self, timeout=10):
+        # dar tiempo a que salga lo pendiente antes de cortar
+        limite = time.monotonic() + timeout
+        while self.pendientes and time.monotonic() < limite:
+            await asyncio.sleep(0.1)
+        if self._tarea:
+            self._tarea.cancel()
+
+    def _agregar(self, chat_id, envio):
+        chat_id = str(chat_id)
+        self.pendientes += 1
+        cola = self._colas.get(chat_id)
+        if cola is None:
+            self._colas[chat_id] = deque([envio])
+            self._listos.put_nowait(chat_id)
+        else:
+            cola.append(envio)
+
+    async def enviar(self, chat_id, funcion, *args, **kwargs):
+        futuro = asyncio.get_running_loop().create_future()
+        self._agregar(chat_id, [funcion, args, kwargs, futuro, 0, None])
+        return await futuro
+
+    def notificar(self, chat_id, texto, **kwargs):
+        self._encolar_aviso(self.bandeja.agregar(chat_id, texto, **kwargs))
+
+    def difundir(self, chat_ids, texto, **kwargs):
+        for aviso in self.bandeja.agregar_varios(chat_ids, texto, **kwargs):
+            self._encolar_aviso(aviso)
+
+    def _encolar_aviso(self, aviso):
+        envio = [self._bot.send_message, (), {"chat_id": aviso["chat_id"], "text": aviso["texto"], **aviso["kw"]},
+                 None, 0, aviso["id"]]
+        self._agregar(aviso["chat_id"], envio)
+
+    # --- circuito: abierto mientras no hay red ---
+    def red_caida(self):
+        ahora = time.monotonic()
+        if self._circuito_hasta > ahora:
+            return  # ya en pausa; los demás envíos en vuelo fallan por lo mismo
+        espera = self._backoff.siguiente()
+        self._circuito_hasta = ahora + espera
+        if not self.sin_red:
+            self.sin_red = True
+            print("🔌 Sin conexión con Telegram: envíos en pausa")
+
+    def red_ok(self):
+        if self.sin_red:
+            self.sin_red = False
+            print(f"🔌 Conexión recuperada: enviando {self.pendientes} mensajes pendientes")
+        self._backoff.reiniciar()
+        self._circuito_hasta = 0.0
+
+    def _cubeta(self, chat_id, ahora):
+        cubeta = self._cubetas.get(chat_id)
+        if cubeta is None:
+            if len(self._cubetas) > 10000:
+                # olvidar las cubetas de chats sin mensajes pendientes que ya se llenaron
+                self._cubetas = {
+                    c: b for c, b in self._cubetas.items() if c in self._colas or not b.llena(ahora)
+                }
+            cubeta = self._cubetas[chat_id] = Cubeta(ENVIO_CHAT_POR_SEG, ENVIO_CHAT_RAFAGA)
+        return cubeta
+
+    async def _bucle(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            chat_id = await self._listos.get()
+            # por RetryAfter o circuito abierto; en tramos cortos por si la red vuelve antes
+            while (pausa := max(self._pausa_hasta, self._circuito_hasta) - time.monotonic()) > 0:
+                await asyncio.sleep(min(pausa, 1))
+            ahora = time.monotonic()
+            espera = self._cubeta(chat_id, ahora).espera(ahora)
+            if espera:
+                loop.call_later(espera, self._listos.put_nowait, chat_id)
+                continue
+            while espera := self._global.espera(time.monotonic()):
+                await asyncio.sleep(espera)
+            await self._en_vuelo.acquire()
+            envio = self._colas[chat_id].popleft()
+            asyncio.create_task(self._enviar(chat_id, envio))
+
+    async def _enviar(self, chat_id, envio):
+        funcion, args, kwargs, futuro, intentos, aviso_id = envio
+        metodo = getattr(funcion, "__name__", "otro")
+        reintentar_en = None
+        t = time.perf_counter()
+        try:
+            resultado = await funcion(*args, **kwargs)
+        except RetryAfter as e:
+            metricas.contar("pepegotchi_envios_total", metodo=metodo, resultado="retry_after")
+            # Telegram pide parar: pausar todos los envíos, no sólo este chat
+            segundos = e.retry_after
+            if isinstance(segundos, timedelta):
+                segundos = segundos.total_seconds()
+            self._pausa_hasta = max(self._pausa_hasta, time.monotonic() + segundos)
+            reintentar_en = segundos
+        except (BadRequest, Forbidden) as e:
+            metricas.contar("pepegotchi_envios_total", metodo=metodo, resultado="rechazado")
+            self._fallar(chat_id, envio, e)
+        except NetworkError as e:
+            metricas.contar("pepegotchi_envios_total", metodo=metodo, resultado="red")
+            # el bucle espera a que se cierre el circuito antes de reintentar
+            self.red_caida()
+            if aviso_id is not None or intentos + 1 < ENVIO_MAX_INTENTOS:
+                reintentar_en = 0
+            else:
+                self._fallar(chat_id, envio, e)
+        except Exception as e:
+            metricas.contar("pepegotchi_envios_total", metodo=metodo, resultado="error")
+            self._fallar(chat_id, envio, e)
+        else:
+            metricas.contar("pepegotchi_envios_total", metodo=metodo, resultado="ok")
+            metricas.observar("pepegotchi_envio_segundos", time.perf_counter() - t, metodo=metodo)
+            self.red_ok()
+            self.enviados += 1
+            if futuro is not None and not futuro.done():
+                futuro.set_result(resultado)
+            if aviso_id is not None:
+                self.bandeja.confirmar(aviso_id)
+        finally:
+            self._en_vuelo.release()
+
+        cola = self._colas[chat_id]
+        if reintentar_en is not None:
+            self.reintentos += 1
+            envio[4] += 1
+            cola.appendleft(envio)
+            asyncio.get_running_loop().call_later(reintentar_en, self._listos.put_nowait, chat_id)
+            return
+        self.pendientes -= 1
+        if cola:
+            self._listos.put_nowait(chat_id)
+        else:
+            del self._colas[chat_id]
+
+    def _fallar(self, chat_id, envio, error):
+        self.descartados += 1
+        if envio[5] is not None:
+            self.bandeja.confirmar(envio[5])
+        futuro = envio[3]
+        if futuro is not None:
+            if not futuro.done():
+                futuro.set_exception(error)
+        else:
+            print(f"⚠️ Mensaje a {chat_id} descartado: {error}")
+
+despachador = Despachador(BandejaSalida(OUTBOX_FILE))
+
+async def difundir(ids, texto, **kwargs):
+    """Manda el mismo `texto` a los chats `ids` por la bandeja de salida, de a
+    LOTE_DIFUSION por escritura (un fsync por lote), cediendo el event loop entre lotes."""
+    ids = list(ids)
+    for i in range(0, len(ids), LOTE_DIFUSION):
+        despachador.difundir(ids[i:i + LOTE_DIFUSION], texto, **kwargs)
+        await asyncio.sleep(0)
+    return len(ids)
+
+async def responder(update, texto, **kwargs):
+    respuesta = respuesta_actual.get()
+    if respuesta is not None and respuesta.update is update:
+        respuesta.agregar(texto, **kwargs)
+        return None
+    return await despachador.enviar(update.effective_chat.id, update.message.reply_text, texto, **kwargs)
+
+async def editar(update, texto, **kwargs):
+    return await despachador.enviar(update.effective_chat.id, update.callback_query.edit_message_text, texto, **kwargs)
+
+# === RESPUESTA AGRUPADA: lo que responde un comando sale en un solo mensaje ===
+# Telegram no acepta captions más largos
+LIMITE_CAPTION = 1024
+
+class Respuesta:
+    """Junta los responder() de un update y los manda al final en un mensaje.
+
+    Si el handler pidió la foto de rango, todo va como su caption (si cabe).
+    Los textos con Markdown y sin él se combinan escapando los que no lo usan.
+    """
+    __slots__ = ("update", "partes", "foto", "kwargs")
+
+    def __init__(self, update):
+        self.update = update
+        self.partes = []   # (texto, parse_mode)
+        self.foto = None   # (ruta, texto propio de la foto)
+        self.kwargs = {}   # reply_markup y demás; gana el último
+
+    def agregar(self, texto, parse_mode=None, **kwargs):
+        self.partes.append((texto, parse_mode))
+        self.kwargs.update(kwargs)
+
+    @staticmethod
+    def combinar(partes):
+        if all(parse_mode is None for _, parse_mode in partes):
+            return "\n\n".join(texto for texto, _ in partes), None
+        return "\n\n".join(
+            texto if parse_mode == "Markdown" else escape_markdown(texto) for texto, parse_mode in partes
+        ), "Markdown"
+
+    async def enviar(self):
+        if not self.partes:
+            return
+        texto, parse_mode = self.combinar(self.partes)
+        kwargs = dict(self.kwargs)
+        if parse_mode:
+            kwargs["parse_mode"] = parse_mode
+        if self.foto is None:
+            await despachador.enviar(self.update.effective_chat.id, self.update.message.reply_text, texto, **kwargs)
+            return
+        ruta, texto_foto = self.foto
+        if len(texto) <= LIMITE_CAPTION:
+            await _enviar_foto_rango(self.update, ruta, texto, **kwargs)
+            return
+        # no cabe: la foto con su texto y el resto aparte
+        await _enviar_foto_rango(self.update, ruta, texto_foto, parse_mode="Markdown")
+        resto = [parte for parte in self.partes if parte != (texto_foto, "Markdown")]
+        if resto:
+            texto, parse_mode = self.combinar(resto)
+            await despachador.enviar(
+                self.update.effective_chat.id, self.update.message.reply_text, texto,
+                **{**self.kwargs, **({"parse_mode": parse_mode} if parse_mode else {})}
+            )
+
+respuesta_actual = contextvars.ContextVar("respuesta_actual", default=None)
+
+def agrupado(handler):
+    """Envuelve un comando para que todas sus respuestas salgan juntas al terminar."""
+    @functools.wraps(handler)
+    async def envuelto(update, context):
+        if update.message is None:
+            return await handler(update, context)
+        respuesta = Respuesta(update)
+        token = respuesta_actual.set(respuesta)
+        try:
+            return await handler(update, context)
+        finally:
+            respuesta_actual.reset(token)
+            await respuesta.enviar()
+    return envuelto
+
+# === RANGOS / IMAGENES (tabla en RANGOS_FILE) ===
+@dataclass(frozen=True, slots=True)
+class Rango:
+    xp: int        # xp mínima para alcanzarlo
+    nombre: str
+    imagen: str    # dentro de IMAGES_PATH
+    bono: int      # monedas al alcanzarlo
+
+def cargar_rangos(archivo):
+    with open(archivo, "r", encoding="utf-8") as f:
+        rangos = [Rango(**r) for r in json.load(f)]
+    umbrales = [r.xp for r in rangos]
+    if not rangos or umbrales[0] != 0 or umbrales != sorted(set(umbrales)):
+        raise ValueError(f"{archivo}: los rangos deben empezar en 0 xp y tener umbrales crecientes")
+    return rangos
+
+RANGOS = cargar_rangos(RANGOS_FILE)
+UMBRALES_RANGO = [r.xp for r in RANGOS]
+
+def indice_rango(exp):
+    return max(bisect.bisect_right(UMBRALES_RANGO, exp) - 1, 0)
+
 def obtener_rango(exp):
-    if exp < 1000:
-        return "🐸 Bebé"
-    elif exp < 5000:
-        return "🐢 Joven"
-    elif exp < 10000:
-        return "🐊 Adulto"
-    elif exp < 20000:
-        return "🐉 Legendario"
-    elif exp < 40000:
-        return "🔥 Legendario Supremo"
-    elif exp < 60000:
-        return "🌀 Maestro"
-    else:
-        return "👑 Divino"
+    return RANGOS[indice_rango(exp)].nombre
 
 def imagen_por_rango(exp):
-    if exp < 1000:
-        return f"{IMAGES_PATH}/bebe.png"
-    elif exp < 5000:
-        return f"{IMAGES_PATH}/joven.png"
-    elif exp < 10000:
-        return f"{IMAGES_PATH}/adulto.png"
-    elif exp < 20000:
-        return f"{IMAGES_PATH}/legendario.png"
-    elif exp < 40000:
-        return f"{IMAGES_PATH}/legendario_supremo.png"
-    elif exp < 60000:
-        return f"{IMAGES_PATH}/maestro.png"
-    else:
-        return f"{IMAGES_PATH}/divino.png"
+    return f"{IMAGES_PATH}/{RANGOS[indice_rango(exp)].imagen}"
+
+def rangos_cruzados(xp_antes, xp_despues):
+    """Índices de los rangos alcanzados al pasar de xp_antes a xp_despues (en orden)."""
+    return range(indice_rango(xp_antes) + 1, indice_rango(xp_despues) + 1)
+
+# todas las imágenes de rango (para precargarlas)
+IMAGENES_RANGO = [f"{IMAGES_PATH}/{r.imagen}" for r in RANGOS]
+
+# === CACHE DE file_id: cada imagen se sube a Telegram una sola vez ===
+class CacheImagenes:
+    """Guarda el file_id que Telegram devolvió al subir cada imagen.
+
+    Se invalida si cambia el contenido del archivo (sha256); el hash sólo se
+    recalcula cuando cambia el mtime o el tamaño.
+    """
 
-# === AUX: manejo de día local (YYYY-MM-DD) ===
-def fecha_local_hoy():
-    return datetime.now(TZ).strftime("%Y-%m-%d")
+    def __init__(self, archivo):
+        self.archivo = archivo
+        self._entradas = {}  # ruta -> {"sha256": ..., "file_id": ...}
+        self._firmas = {}    # ruta -> ((mtime, tamaño), sha256) ya calculados
+
+    def cargar(self):
+        try:
+            with open(self.archivo, "r") as f:
+                self._entradas = json.load(f)
+        except (OSError, ValueError):
+            self._entradas = {}
+
+    def _guardar(self):
+        tmp = self.archivo + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self._entradas, f, indent=4)
+        os.replace(tmp, self.archivo)
+
+    def _sha256(self, ruta):
+        st = os.stat(ruta)
+        firma = (st.st_mtime_ns, st.st_size)
+        previa = self._firmas.get(ruta)
+        if previa and previa[0] == firma:
+            return previa[1]
+        with open(ruta, "rb") as f:
+            sha = hashlib.sha256(f.read()).hexdigest()
+        self._firmas[ruta] = (firma, sha)
+        return sha
+
+    def file_id(self, ruta):
+        entrada = self._entradas.get(ruta)
+        if not entrada:
+            return None
+        if entrada["sha256"] != self._sha256(ruta):
+            self.olvidar(ruta)
+            return None
+        return entrada["file_id"]
+
+    def registrar(self, ruta, file_id):
+        self._entradas[ruta] = {"sha256": self._sha256(ruta), "file_id": file_id}
+        self._guardar()
+
+    def olvidar(self, ruta):
+        if self._entradas.pop(ruta, None) is not None:
+            self._guardar()
+
+cache_imagenes = CacheImagenes(IMAGES_CACHE)
+
+def file_id_rechazado(error):
+    mensaje = error.message.lower()
+    return "file identifier" in mensaje or "file_id" in mensaje
+
+async def enviar_foto(enviar, ruta, **kwargs):
+    """Envía `ruta` con `enviar` (reply_photo o send_photo) usando el file_id si ya se subió."""
+    file_id = cache_imagenes.file_id(ruta)
+    if file_id:
+        try:
+            return await enviar(file_id, **kwargs)
+        except BadRequest as e:
+            # sólo si Telegram ya no reconoce ese file_id hay que volver a subir; un caption
+            # mal formado o un chat inexistente fallarían igual con la imagen
+            if not file_id_rechazado(e):
+                raise
+            cache_imagenes.olvidar(ruta)
+    with open(ruta, "rb") as f:
+        mensaje = await enviar(InputFile(f), **kwargs)
+    cache_imagenes.registrar(ruta, mensaje.photo[-1].file_id)
+    return mensaje
+
+async def enviar_foto_rango(update, xp, texto):
+    imagen = imagen_por_rango(xp)
+    respuesta = respuesta_actual.get()
+    if respuesta is not None and respuesta.update is update:
+        # sale al final con el resto de la respuesta como caption
+        respuesta.foto = (imagen, texto)
+        respuesta.agregar(texto, parse_mode="Markdown")
+        return
+    await _enviar_foto_rango(update, imagen, texto, parse_mode="Markdown")
+
+async def _enviar_foto_rango(update, imagen, texto, **kwargs):
+    try:
+        enviar = functools.partial(despachador.enviar, update.effective_chat.id, update.message.reply_photo)
+        await enviar_foto(enviar, imagen, caption=texto, **kwargs)
+    except (OSError, TelegramError) as e:
+        print(f"⚠️ No se pudo enviar {imagen}: {e}")
+        await despachador.enviar(update.effective_chat.id, update.message.reply_text, texto, **kwargs)
+
+async def precargar_imagenes(bot):
+    # sube al chat de admin las imágenes que aún no tienen file_id
+    for ruta in IMAGENES_RANGO:
+        if not os.path.exists(ruta) or cache_imagenes.file_id(ruta):
+            continue
+        try:
+            enviar = functools.partial(despachador.enviar, ADMIN_CHAT_ID, bot.send_photo)
+            await enviar_foto(enviar, ruta, chat_id=ADMIN_CHAT_ID, disable_notification=True)
+        except TelegramError as e:
+            print(f"⚠️ No se pudo precargar {ruta}: {e}")
+
+# === RANKING: índice ordenado por XP, se actualiza en cada cambio de xp ===
+class IndiceXP:
+    """Lista ordenada de (-xp, user_id); actualizar() usa bisect (O(log n) para buscar).
+
+    `version` cambia con cada modificación y sirve para invalidar los textos
+    del ranking ya armados.
+    """
+
+    def __init__(self):
+        self._orden = []
+        self._xp = {}
+        self.version = 0
+
+    def reconstruir(self, usuarios):
+        self._xp = {user_id: user.xp for user_id, user in usuarios.items()}
+        self._orden = sorted((-xp, user_id) for user_id, xp in self._xp.items())
+        self.version += 1
+
+    def actualizar(self, user_id, xp):
+        viejo = self._xp.get(user_id)
+        if viejo == xp:
+            return
+        if viejo is not None:
+            del self._orden[bisect.bisect_left(self._orden, (-viejo, user_id))]
+        bisect.insort(self._orden, (-xp, user_id))
+        self._xp[user_id] = xp
+        self.version += 1
+
+    def top(self, n):
+        return [(user_id, -xp) for xp, user_id in self._orden[:n]]
+
+    def posicion(self, user_id):
+        xp = self._xp.get(user_id)
+        if xp is None:
+            return None
+        return bisect.bisect_left(self._orden, (-xp, user_id)) + 1
+
+    def __len__(self):
+        return len(self._orden)
+
+    def nombre(self, user_id):
+        user = almacen.usuario(user_id)
+        return user.nombre if user else "Jugador"
+
+class RankingCompartido(IndiceXP):
+    """Ranking de todos los procesos, leído de la DB compartida (modo multiproceso).
+
+    El índice local sigue al día sólo con los usuarios propios; el top y el
+    total se piden a la DB como mucho cada RANKING_TTL segundos y ven lo que
+    cada proceso ya guardó (hasta FLUSH_INTERVAL de atraso).
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._top = []       # [(user_id, nombre, xp)] del último refresco
+        self._total = 0
+        self._leido = float("-inf")
+
+    def _refrescar(self, n):
+        ahora = time.monotonic()
+        if ahora - self._leido < RANKING_TTL and n <= len(self._top):
+            return
+        top = backend.top(max(n, TOP_RANKING))
+        self._total = backend.contar()
+        self._leido = ahora
+        if top != self._top:
+            self._top = top
+            self.version += 1
+
+    def top(self, n):
+        self._refrescar(n)
+        return [(user_id, xp) for user_id, _, xp in self._top[:n]]
+
+    def posicion(self, user_id):
+        xp = self._xp.get(user_id)
+        if xp is None:
+            return None
+        return backend.posicion(user_id, xp)
+
+    def __len__(self):
+        self._refrescar(0)
+        return self._total
+
+    def nombre(self, user_id):
+        user = almacen.usuario(user_id)
+        if user:
+            return user.nombre
+        return next((nombre for uid, nombre, _ in self._top if uid == user_id), None) or "Jugador"
+
+indice_xp = RankingCompartido() if PROCESO is not None else IndiceXP()
+
+def sumar_xp(user_id, user, cantidad):
+    user.xp += cantidad
+    indice_xp.actualizar(user_id, user.xp)
+
+# textos del top ya armados: {n: (version del índice, texto)}
+_cache_ranking = {}
+
+def texto_top(n):
+    # top() primero: en el ranking compartido es lo que refresca (y cambia la versión)
+    top = indice_xp.top(n)
+    cache = _cache_ranking.get(n)
+    if cache and cache[0] == indice_xp.version:
+        return cache[1]
+    medallas = {1: "🥇", 2: "🥈", 3: "🥉"}
+    lineas = ["🏆 *Ranking Pepegotchi*\n"]
+    for pos, (user_id, xp) in enumerate(top, start=1):
+        nombre = escape_markdown(indice_xp.nombre(user_id))
+        lineas.append(f"{medallas.get(pos, f'{pos}.')} {nombre} — ⭐ {xp} XP")
+    texto = "\n".join(lineas)
+    _cache_ranking[n] = (indice_xp.version, texto)
+    return texto
+
+# === REFERIDOS: índice codigo -> user_id ===
+BONO_REFERIDO = 100   # para quien usa el código
+BONO_REFERENTE = 150  # para el dueño del código
+# sin 0/O ni 1/I para que los códigos se puedan dictar
+ALFABETO_CODIGOS = "23456789ABCDEFGHJKLMNPQRSTUVWXYZ"
+
+indice_codigos = {}
+
+def nuevo_codigo(user_id):
+    codigo = user_id[-5:]
+    # con varios procesos el índice local sólo tiene los propios: reservar en la DB compartida
+    while not codigo or codigo in indice_codigos or (PROCESO is not None and backend.reservar_codigos({user_id: codigo})):
+        codigo = "".join(secrets.choice(ALFABETO_CODIGOS) for _ in range(6))
+    return codigo
+
+def buscar_referente(codigo):
+    referente_id = indice_codigos.get(codigo)
+    if referente_id is None and PROCESO is not None:
+        # el dueño puede ser de otro proceso (el índice local sólo tiene los propios)
+        referente_id = backend.buscar_codigo(codigo)
+    return referente_id
+
+def reconstruir_codigos(usuarios):
+    """Arma el índice al arrancar; a los duplicados (sufijos de 5 dígitos repetidos) les da un código nuevo."""
+    indice_codigos.clear()
+    repetidos = []
+    for user_id, user in usuarios.items():
+        if user.codigo and user.codigo not in indice_codigos:
+            indice_codigos[user.codigo] = user_id
+        else:
+            repetidos.append(user_id)
+    if PROCESO is not None:
+        # repetidos con usuarios de otros procesos: el código queda para el primero que lo reservó
+        for user_id in backend.reservar_codigos({user_id: codigo for codigo, user_id in indice_codigos.items()}):
+            del indice_codigos[usuarios[user_id].codigo]
+            repetidos.append(user_id)
+    for user_id in repetidos:
+        user = usuarios[user_id]
+        user.codigo = nuevo_codigo(user_id)
+        indice_codigos[user.codigo] = user_id
+        almacen.marcar(user_id)
+
+# === RELOJ: hora y día local (YYYY-MM-DD) de todo el bot, ver reloj.py ===
+# El benchmark y las pruebas lo reemplazan por un reloj.RelojFalso para adelantar días.
+reloj = Reloj(TZ)
+
+def texto_espera(segundos):
+    horas, minutos = divmod(max(0, int(segundos)) // 60, 60)
+    if horas >= 48:
+        return f"{horas // 24} días {horas % 24} h"
+    return f"{horas} h {minutos} min" if horas else f"{minutos} min"
 
 # === AUX: reiniciar contadores diarios de un usuario ===
 def reiniciar_contadores_diarios(user):
-    user["daily"]["date"] = fecha_local_hoy()
-    user["daily"]["alimentar"] = 0
-    user["daily"]["jugar"] = 0
+    user.daily["date"] = reloj.hoy()
+    user.daily["alimentar"] = 0
+    user.daily["jugar"] = 0
+
+# === AUX: contadores de hoy; se reinician solos la primera vez que se usan en un día nuevo ===
+def contadores_de_hoy(user):
+    if user.daily["date"] != reloj.hoy():
+        reiniciar_contadores_diarios(user)
+    return user.daily
 
 # === AUX: revisar si hay subida de rango ===
-async def revisar_rango(update_or_bot, user_id, datos, via_update=True):
-    user = datos["usuarios"][user_id]
-    xp = user.get("xp", 0)
-    nuevo_rango = obtener_rango(xp)
-    if user.get("ultimo_rango") != nuevo_rango:
-        # animación corta si es via_update (un Update); si es bot (background) usaremos send_message
-        try:
-            if via_update:
-                await update_or_bot.message.reply_text("✨ Evolucionando...")
-            else:
-                await update_or_bot.send_message(chat_id=int(user_id), text="✨ Evolucionando...")
-        except Exception:
-            pass
-        user["ultimo_rango"] = nuevo_rango
-        bonus_monedas = 100
-        user["monedas"] = user.get("monedas", 0) + bonus_monedas
-        guardar_datos(datos)
+async def revisar_rango(update, user_id, user):
+    if user.ultimo_rango is None:
+        # nunca se le anunció un rango: el primero (Bebé) también cuenta
+        cruzados = range(0, indice_rango(user.xp) + 1)
+    else:
+        # (si la tabla se acortó, el último rango guardado puede no existir ya)
+        cruzados = rangos_cruzados(RANGOS[min(user.ultimo_rango, len(RANGOS) - 1)].xp, user.xp)
+    if cruzados:
+        await responder(update, "✨ Evolucionando...")
+        # cada rango alcanzado da su bono, aunque se salten varios de golpe
+        user.ultimo_rango = cruzados[-1]
+        bonus_monedas = sum(RANGOS[i].bono for i in cruzados)
+        user.monedas += bonus_monedas
+        almacen.marcar(user_id)
         texto = (
-            f"🌟 ¡Tu Pepegotchi ha subido al rango *{nuevo_rango}*! 🎉\n"
+            f"🌟 ¡Tu Pepegotchi ha subido al rango *{RANGOS[cruzados[-1]].nombre}*! 🎉\n"
             f"🎁 Has ganado +{bonus_monedas} monedas"
         )
-        try:
-            if via_update:
-                await update_or_bot.message.reply_text(texto, parse_mode="Markdown")
-            else:
-                await update_or_bot.send_message(chat_id=int(user_id), text=texto, parse_mode="Markdown")
-        except Exception:
-            pass
+        if len(cruzados) > 1:
+            texto += f"\n📈 Rangos alcanzados: {', '.join(RANGOS[i].nombre for i in cruzados)}"
+        await responder(update, texto, parse_mode="Markdown")
 # - Comandos principales y funciones de interacción
 
 # === COMANDO /start ===
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    datos = cargar_datos()
     user_id = str(update.effective_user.id)
     nombre = update.effective_user.first_name
-    user = asegurar_usuario(datos, user_id, nombre)
-    guardar_datos(datos)
+    async with almacen.bloqueo(user_id):
+        user = asegurar_usuario(user_id, nombre)
+        almacen.marcar(user_id)
 
-    imagen = imagen_por_rango(user["xp"])
-    texto = (
-        f"🐸 ¡Hola {nombre}! Bienvenido a *Pepegotchi Bot* 💚\n\n"
-        f"✨ Cuida, alimenta y haz crecer a tu Pepegotchi.\n"
-        f"💰 Monedas: {user['monedas']}\n"
-        f"⭐ XP: {user['xp']}\n"
-        f"🏅 Rango: {obtener_rango(user['xp'])}\n\n"
-        f"Usa /ayuda para ver todos los comandos disponibles."
-    )
+        texto = (
+            f"🐸 ¡Hola {escape_markdown(nombre)}! Bienvenido a *Pepegotchi Bot* 💚\n\n"
+            f"✨ Cuida, alimenta y haz crecer a tu Pepegotchi.\n"
+            f"💰 Monedas: {user.monedas}\n"
+            f"⭐ XP: {user.xp}\n"
+            f"🏅 Rango: {obtener_rango(user.xp)}\n\n"
+            f"Usa /ayuda para ver todos los comandos disponibles."
+        )
 
-    try:
-        await update.message.reply_photo(InputFile(imagen), caption=texto, parse_mode="Markdown")
-    except:
-        await update.message.reply_text(texto, parse_mode="Markdown")
+    await enviar_foto_rango(update, user.xp, texto)
 
 # === COMANDO /ayuda ===
 async def ayuda(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -271,450 +1502,1123 @@ async def ayuda(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "🛒 /tienda - Muestra la tienda con ítems\n"
         "💰 /comprar <ítem> - Compra un ítem de la tienda\n"
         "🎒 /usar <ítem> - Usa un ítem de tu inventario\n"
+        "🧺 /inventario - Ver los ítems que tienes\n"
         "🎁 /checkin - Reclama tu recompensa diaria\n"
-        "🎉 /evento - Muestra los eventos y sorpresas (¡próximamente!)\n"
+        "🎉 /evento - Eventos activos y próximos\n"
         "📊 /estado - Ver estadísticas de tu Pepegotchi\n"
+        "🏆 /ranking - Los Pepegotchis con más XP\n"
+        "🤝 /referir <código> - Usa el código de un amigo (sin código: ver el tuyo)\n"
     )
-    await update.message.reply_text(texto, parse_mode="Markdown")
+    await responder(update, texto, parse_mode="Markdown")
 
 # === COMANDO /evento ===
-async def evento(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(
-        "🎉 Próximamente tendremos *eventos y sorpresas* para ti 💚\n"
-        "¡Mantente atento a las novedades!",
-        parse_mode="Markdown"
-    )
-
-# === COMANDO /checkin ===
-async def checkin(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    datos = cargar_datos()
-    user_id = str(update.effective_user.id)
-    user = asegurar_usuario(datos, user_id)
-    hoy = fecha_local_hoy()
+def efectos_evento(e):
+    efectos = []
+    if e.xp != 1:
+        efectos.append(f"⭐ XP ×{e.xp:g}")
+    if e.monedas != 1:
+        efectos.append(f"💰 Monedas ×{e.monedas:g}")
+    if e.descuento:
+        efectos.append(f"🏷️ {e.descuento:.0%} de descuento en la tienda")
+    if e.articulos:
+        efectos.append("🛒 En la tienda: " + ", ".join(i["nombre"] for i in e.articulos.values()))
+    return efectos
+
+def texto_evento(e, cuando):
+    texto = f"*{escape_markdown(e.nombre)}* — {cuando}"
+    if e.descripcion:
+        texto += f"\n{escape_markdown(e.descripcion)}"
+    return "\n".join([texto] + [f"  {efecto}" for efecto in efectos_evento(e)])
 
-    if user["ultimo_checkin"] == hoy:
-        await update.message.reply_text("🎁 Ya has hecho tu *check-in* de hoy. ¡Vuelve mañana!")
-        return
-
-    user["ultimo_checkin"] = hoy
-    user["xp"] += 50
-    guardar_datos(datos)
-    await update.message.reply_text("✅ *Check-in diario completado!* +50 XP 🎉", parse_mode="Markdown")
-    await revisar_rango(update, user_id, datos)
-
-# === COMANDO /estado ===
-async def estado(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    datos = cargar_datos()
-    user_id = str(update.effective_user.id)
-    user = asegurar_usuario(datos, user_id)
-
-    imagen = imagen_por_rango(user["xp"])
-    texto = (
-        f"📊 *Estado de tu Pepegotchi:*\n\n"
-        f"💰 Monedas: {user['monedas']}\n"
-        f"⭐ XP: {user['xp']}\n"
-        f"🏅 Rango: {obtener_rango(user['xp'])}\n"
-        f"⚡ Energía: {user['energia']}%\n"
-        f"💤 Durmiendo: {'Sí 😴' if user['is_sleeping'] else 'No 🐸'}"
-    )
-
-    try:
-        await update.message.reply_photo(InputFile(imagen), caption=texto, parse_mode="Markdown")
-    except:
-        await update.message.reply_text(texto, parse_mode="Markdown")
-
-# === BLOQUEO GENERAL: si está dormido, no puede usar comandos ===
-async def verificar_sueño(update: Update, context: ContextTypes.DEFAULT_TYPE, user):
-    if user.get("is_sleeping", False):
-        sleep_until = datetime.fromisoformat(user["sleep_until"])
-        ahora = datetime.now(TZ)
-        if ahora < sleep_until:
-            restante = sleep_until - ahora
-            horas = int(restante.total_seconds() // 3600)
-            minutos = int((restante.total_seconds() % 3600) // 60)
-            await update.message.reply_text(
-                f"🤫 Shhh... tu Pepegotchi está dormido 💤\n"
-                f"⏰ Despertará en {horas}h {minutos}min."
-            )
-            return True
-        else:
-            # Se despertó
-            user["is_sleeping"] = False
-            user["sleep_until"] = None
-            guardar_datos(cargar_datos())
-            await update.message.reply_text("☀️ Tu Pepegotchi ha despertado, ¡es hora de jugar y comer! 🐸")
-            return False
-    return False
-# - Comandos de interacción (alimentar, jugar, dormir)
-
-# === COMANDO /alimentar ===
-async def alimentar(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    datos = cargar_datos()
-    user_id = str(update.effective_user.id)
-    user = asegurar_usuario(datos, user_id)
-
-    if await verificar_sueño(update, context, user):
-        return
-
-    hoy = fecha_local_hoy()
-    contador = user["acciones_hoy"].get("alimentar", 0)
-
-    if contador == 0:
-        # Primera alimentación gratuita
-        user["xp"] += 30
-        await update.message.reply_text("🍽️ Tu Pepegotchi ha comido una deliciosa mosca 🪰 +30 XP 💚")
-    elif contador < 4:
-        if user["monedas"] >= 30:
-            user["monedas"] -= 30
-            user["xp"] += 30
-            await update.message.reply_text("🍽️ Tu Pepegotchi ha comido una mosca 🪰 +30 XP (costó 30 monedas)")
-        else:
-            await update.message.reply_text("💰 No tienes suficientes monedas para alimentar a tu Pepegotchi.")
-            return
-    else:
-        await update.message.reply_text("🚫 Ya alimentaste a tu Pepegotchi el máximo de 4 veces hoy.")
-        return
-
-    user["acciones_hoy"]["alimentar"] = contador + 1
-    guardar_datos(datos)
-    await revisar_rango(update, user_id, datos)
-
-# === COMANDO /jugar ===
-async def jugar(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    datos = cargar_datos()
-    user_id = str(update.effective_user.id)
-    user = asegurar_usuario(datos, user_id)
-
-    if await verificar_sueño(update, context, user):
+async def evento(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    ahora = reloj.ahora()
+    activos = agenda.activos(ahora).eventos
+    proximos = agenda.proximos(ahora)
+    if not activos and not proximos:
+        await responder(
+            update,
+            "🎉 Por ahora no hay eventos. ¡Mantente atento a las novedades! 💚",
+        )
         return
-
-    contador = user["acciones_hoy"].get("jugar", 0)
-
-    if contador == 0:
-        user["xp"] += 25
-        await update.message.reply_text("🎮 Tu Pepegotchi jugó por primera vez hoy 🐸 +25 XP 🎉")
-    elif contador < 4:
-        if user["monedas"] >= 25:
-            user["monedas"] -= 25
-            user["xp"] += 25
-            await update.message.reply_text("🎮 Tu Pepegotchi jugó alegremente 🐸 +25 XP (costó 25 monedas)")
-        else:
-            await update.message.reply_text("💰 No tienes suficientes monedas para jugar.")
-            return
-    else:
-        await update.message.reply_text("🚫 Ya jugaste el máximo de 4 veces hoy.")
+    partes = []
+    if activos:
+        partes.append("🎉 *Eventos activos*")
+        partes += [texto_evento(e, f"termina en {texto_espera(e.fin - ahora)}") for e in activos]
+    if proximos:
+        partes.append("📅 *Próximos eventos*")
+        partes += [texto_evento(e, f"empieza en {texto_espera(e.inicio - ahora)}") for e in proximos]
+    await responder(update, "\n\n".join(partes), parse_mode="Markdown")
+
+# === ANUNCIOS DE EVENTOS: a todos los usuarios al empezar y al terminar ===
+async def anunciar_eventos(context: ContextTypes.DEFAULT_TYPE):
+    agenda.revisar()
+    ahora = reloj.ahora()
+    activos = {e.id: e for e in agenda.activos(ahora).eventos}
+    empezaron = [e for id_, e in activos.items() if id_ not in agenda.anunciados]
+    terminaron = [e for id_, e in agenda.anunciados.items() if id_ not in activos]
+    agenda.anunciados = activos
+    if not empezaron and not terminaron:
         return
+    # lo que cambió en esta vuelta va en un solo mensaje por usuario
+    partes = [f"⏰ Terminó *{escape_markdown(e.nombre)}*. ¡Gracias por participar! 💚" for e in terminaron]
+    if empezaron:
+        partes.append("🎉 ¡Empezó un evento!" if len(empezaron) == 1 else "🎉 ¡Empezaron eventos!")
+        partes += [texto_evento(e, f"termina en {texto_espera(e.fin - ahora)}") for e in empezaron]
+    n = await difundir(almacen.usuarios, "\n\n".join(partes), parse_mode="Markdown")
+    cambios = [f"+{e.id}" for e in empezaron] + [f"-{e.id}" for e in terminaron]
+    print(f"🎉 Eventos {' '.join(cambios)} anunciados a {n} usuarios")
 
-    user["acciones_hoy"]["jugar"] = contador + 1
-    guardar_datos(datos)
-    await revisar_rango(update, user_id, datos)
-
-# === COMANDO /dormir ===
-async def dormir(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    datos = cargar_datos()
-    user_id = str(update.effective_user.id)
-    user = asegurar_usuario(datos, user_id)
-
-    ahora = datetime.now(TZ)
-
-    if user.get("is_sleeping", False):
-        sleep_until = datetime.fromisoformat(user["sleep_until"])
-        if ahora < sleep_until:
-            restante = sleep_until - ahora
-            horas = int(restante.total_seconds() // 3600)
-            minutos = int((restante.total_seconds() % 3600) // 60)
-            await update.message.reply_text(
-                f"😴 Tu Pepegotchi ya está durmiendo... 💤\nDespertará en {horas}h {minutos}min."
-            )
-            return
-
-    sleep_until = ahora + timedelta(hours=6)
-    user["is_sleeping"] = True
-    user["sleep_until"] = sleep_until.isoformat()
-    user["xp"] += 50
-    guardar_datos(datos)
-
-    await update.message.reply_text("💤 Tu Pepegotchi se ha dormido bajo la luna 🌙 +50 XP\nVolverá en 6 horas 🕓")
-
-    # Tarea en segundo plano para avisar cuando despierte
-    async def despertar_mensaje():
-        await asyncio.sleep(6 * 3600)
-        user["is_sleeping"] = False
-        user["sleep_until"] = None
-        guardar_datos(datos)
-        try:
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text="☀️ Tu Pepegotchi ha despertado, ¡es hora de comer y jugar! 🐸"
-            )
-        except:
-            pass
-
-    asyncio.create_task(despertar_mensaje())
 # - Recompensas, tienda y eventos
 
 # === COMANDO /checkin ===
 async def checkin(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    datos = cargar_datos()
     user_id = str(update.effective_user.id)
-    user = asegurar_usuario(datos, user_id)
-
-    hoy = fecha_local_hoy()
-    ultimo = user.get("ultimo_checkin")
-
-    if ultimo == hoy:
-        await update.message.reply_text("⏰ Ya hiciste tu check-in diario. ¡Vuelve mañana! 🌞")
-        return
-
-    user["ultimo_checkin"] = hoy
-    user["xp"] += 50
-    user["monedas"] += 200
-    guardar_datos(datos)
-    await revisar_rango(update, user_id, datos)
-    await update.message.reply_text("🎁 ¡Recompensa diaria reclamada! +50 XP y +200 monedas 💰")
-
-# === COMANDO /evento ===
-async def evento(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(
-        "🎉 *Próximamente tendremos eventos y sorpresas para ti* 🌟",
-        parse_mode="Markdown"
-    )
+    async with almacen.bloqueo(user_id):
+        user = asegurar_usuario(user_id)
 
+        hoy = reloj.hoy()
+        ultimo = user.ultimo_checkin
 
+        if ultimo == hoy:
+            anotar(resultado="repetido")
+            await responder(
+                update,
+                f"⏰ Ya hiciste tu check-in diario. ¡Vuelve en {texto_espera(reloj.segundos_para_reinicio())}! 🌞"
+            )
+            return
 
-    await update.message.reply_text(f"✅ Compraste {TIENDA_ITEMS[key]['nombre']} por {precio} monedas.")
+        mod = agenda.activos()
+        xp, monedas = mod.con_xp(50), mod.con_monedas(200)
+        user.ultimo_checkin = hoy
+        sumar_xp(user_id, user, xp)
+        user.monedas += monedas
+        almacen.marcar(user_id)
+        await revisar_rango(update, user_id, user)
+    await responder(update, f"🎁 ¡Recompensa diaria reclamada! +{xp} XP y +{monedas} monedas 💰")
 
 # === COMANDO /usar ===
 async def usar(update: Update, context: ContextTypes.DEFAULT_TYPE):
     args = context.args
     if not args:
-        await update.message.reply_text("❗ Usa `/usar <nombre>`. Ejemplo: `/usar mosca`")
+        await responder(update, "❗ Usa `/usar <nombre>`. Ejemplo: `/usar mosca`")
         return
 
-    elegido = " ".join(args).lower().replace(" ", "")
-    if elegido not in TIENDA_ITEMS:
-        await update.message.reply_text("❌ Ese objeto no existe.")
+    cat = catalogo.actual()
+    texto = " ".join(args)
+    elegido = cat.buscar(texto) or agenda.buscar(texto)
+    if elegido is None:
+        await responder(update, "❌ Ese objeto no existe.")
         return
 
-    datos = cargar_datos()
     user_id = str(update.effective_user.id)
-    user = asegurar_usuario(datos, user_id)
+    async with almacen.bloqueo(user_id):
+        user = asegurar_usuario(user_id)
 
-    inv = user["inventario"]
-    if inv.get(elegido, 0) <= 0:
-        await update.message.reply_text("🧺 No tienes ese objeto en tu inventario.")
-        return
+        inv = user.inventario
+        if inv.get(elegido, 0) <= 0:
+            await responder(update, "🧺 No tienes ese objeto en tu inventario.")
+            return
 
-    item = TIENDA_ITEMS[elegido]
-    inv[elegido] -= 1
-    if inv[elegido] == 0:
-        del inv[elegido]
+        item = datos_articulo(elegido, cat)
+        inv[elegido] -= 1
+        if inv[elegido] == 0:
+            del inv[elegido]
 
-    if elegido == "pocion":
-        user["energia"] = 100
-        await update.message.reply_text("🧪 Tu Pepegotchi recuperó toda su energía 💪")
-    else:
-        user["xp"] += item["xp"]
-        await update.message.reply_text(f"✨ Usaste {item['nombre']} y ganaste +{item['xp']} XP")
+        sumar_xp(user_id, user, item["xp"])
+        user.energia = min(100, user.energia + item["energia"])
+        efectos = [f"+{item['xp']} XP ✨"] if item["xp"] else []
+        if item["energia"]:
+            efectos.append(f"+{item['energia']} ⚡ energía")
+        await responder(update, f"✨ Usaste {item['nombre']}: {', '.join(efectos) or 'sin efecto'}")
 
-    guardar_datos(datos)
-    await revisar_rango(update, user_id, datos)
+        almacen.marcar(user_id)
+        await revisar_rango(update, user_id, user)
 
 # === COMANDO /inventario ===
 async def inventario(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    datos = cargar_datos()
     user_id = str(update.effective_user.id)
-    user = asegurar_usuario(datos, user_id)
-    inv = user.get("inventario", {})
+    user = almacen.usuario(user_id)
+    inv = user.inventario if user else {}
 
     if not inv:
-        await update.message.reply_text("🧺 Tu inventario está vacío.")
+        await responder(update, "🧺 Tu inventario está vacío.")
         return
 
+    cat = catalogo.actual()
     texto = "🧺 *Inventario Pepegotchi:*\n\n"
     for key, cantidad in inv.items():
-        item = TIENDA_ITEMS.get(key, {"nombre": key})
+        item = datos_articulo(key, cat) or {"nombre": key}
         texto += f"{item['nombre']} — {cantidad}\n"
 
-    await update.message.reply_text(texto, parse_mode="Markdown")
+    await responder(update, texto, parse_mode="Markdown")
 # - Sistema de sueño, reinicio diario y tareas automáticas
 
 # === COMANDO /dormir ===
 async def dormir(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    datos = cargar_datos()
     user_id = str(update.effective_user.id)
-    user = asegurar_usuario(datos, user_id)
-
-    if user.get("durmiendo", False):
-        await update.message.reply_text("😴 Tu Pepegotchi ya está dormido.")
-        return
-
-    user["durmiendo"] = True
-    user["hora_dormir"] = datetime.now(pytz.timezone("America/Guatemala")).isoformat()
-    guardar_datos(datos)
+    async with almacen.bloqueo(user_id):
+        user = asegurar_usuario(user_id)
 
-    await update.message.reply_text("💤 Tu Pepegotchi se ha ido a dormir. Volverá en 6 horas. 🌙")
+        hasta = hora_despertar(user)
+        if hasta is not None and reloj.ahora() < hasta:
+            await responder(update, "😴 Tu Pepegotchi ya está dormido.")
+            return
 
-    # Esperar 6 horas y despertar automáticamente
-    async def despertar_automatico():
-        await asyncio.sleep(6 * 3600)
-        datos = cargar_datos()
-        user = asegurar_usuario(datos, user_id)
-        user["durmiendo"] = False
-        guardar_datos(datos)
-        try:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text="🌞 ¡He despertado! Es hora de comer y jugar 🍽️🎮"
-            )
-        except Exception:
-            pass
+        ahora = reloj.ahora_local()
+        user.durmiendo = True
+        user.hora_dormir = ahora.isoformat()
+        user.sleep_until = (ahora + DURACION_SUEÑO).isoformat()
+        almacen.marcar(user_id)
+        despertador.programar(user_id, hora_despertar(user))
+
+    await responder(update, "💤 Tu Pepegotchi se ha ido a dormir. Volverá en 6 horas. 🌙")
+
+# === DESPERTADOR: un solo heap (hora, user_id) para todas las mascotas dormidas ===
+def hora_despertar(user):
+    """Timestamp en que despierta la mascota, o None si no está dormida."""
+    if user.durmiendo and user.sleep_until:
+        return datetime.fromisoformat(user.sleep_until).timestamp()
+    return None
+
+def despertar(user):
+    # cerrar el tramo dormido antes de olvidar la ventana de sueño
+    actualizar_stats(user)
+    user.durmiendo = False
+    user.sleep_until = None
+
+class Despertador:
+    """Cola de despertares; se reconstruye desde la DB al arrancar.
+
+    Las entradas viejas (la mascota ya despertó o volvió a dormirse) no se
+    borran del heap: se descartan al salir comparando con `hora_despertar`.
+    """
+
+    def __init__(self):
+        self._heap = []
+
+    def reconstruir(self, usuarios):
+        self._heap = []
+        ahora = reloj.ahora()
+        atrasados = 0
+        for user_id, user in usuarios.items():
+            hasta = hora_despertar(user)
+            if hasta is None:
+                continue
+            if ahora - hasta > DURACION_SUEÑO.total_seconds():
+                # despertó hace mucho (p. ej. un registro migrado de hace meses): sin aviso;
+                # sólo se avisa lo que venció durante una caída corta
+                despertar(user)
+                almacen.marcar(user_id)
+                atrasados += 1
+                continue
+            self._heap.append((hasta, user_id))
+        heapq.heapify(self._heap)
+        if atrasados:
+            print(f"🌞 {atrasados} mascotas despertadas sin aviso (vencidas hace más de {DURACION_SUEÑO})")
+
+    def programar(self, user_id, hasta):
+        heapq.heappush(self._heap, (hasta, user_id))
+
+    def vencidos(self, ahora, limite):
+        lote = []
+        while self._heap and self._heap[0][0] <= ahora and len(lote) < limite:
+            lote.append(heapq.heappop(self._heap)[1])
+        return lote
+
+    def __len__(self):
+        return len(self._heap)
+
+despertador = Despertador()
+
+async def despertar_mascotas(context: ContextTypes.DEFAULT_TYPE):
+    ahora = reloj.ahora()
+    while lote := despertador.vencidos(ahora, LOTE_DESPERTAR):
+        despiertos = []
+        for user_id in lote:
+            async with almacen.bloqueo(user_id):
+                user = almacen.usuario(user_id)
+                hasta = hora_despertar(user) if user else None
+                if hasta is None or hasta > ahora:
+                    continue
+                despertar(user)
+                almacen.marcar(user_id)
+                despiertos.append(user_id)
+
+        await difundir(despiertos, "🌞 ¡He despertado! Es hora de comer y jugar 🍽️🎮")
+
+# === SIMULACIÓN PASIVA: energía y felicidad cambian con el tiempo ===
+# Cada usuario guarda sus valores y `stats_ts`, el momento en que se calcularon;
+# al leerlo se proyectan hasta ahora (actualizar_stats). El sueño siempre
+# empieza con los valores al día (dormir pasa por asegurar_usuario), así que
+# entre stats_ts y ahora hay, como mucho, un tramo dormido seguido de uno despierto.
+def proyectar(energia, felicidad, ts, inicio_sueño, fin_sueño, ahora, minimo=min, maximo=max):
+    """Valores a `ahora`; sirve para números sueltos o, con np.minimum/np.maximum, para arrays."""
+    dormido = maximo(minimo(fin_sueño, ahora) - maximo(ts, inicio_sueño), 0)
+    despierto = maximo(ahora - ts, 0) - dormido
+    energia = minimo(maximo(energia + dormido * ENERGIA_DORMIDO_POR_HORA / 3600, 0), 100)
+    energia = minimo(maximo(energia + despierto * ENERGIA_POR_HORA / 3600, 0), 100)
+    felicidad = minimo(maximo(felicidad + despierto * FELICIDAD_POR_HORA / 3600, 0), 100)
+    return energia, felicidad
+
+def ventana_sueño(user):
+    hasta = hora_despertar(user)
+    if hasta is None or not user.hora_dormir:
+        return 0.0, 0.0
+    return datetime.fromisoformat(user.hora_dormir).timestamp(), hasta
+
+def actualizar_stats(user, ahora=None):
+    ahora = reloj.ahora() if ahora is None else ahora
+    if user.stats_ts is not None:
+        energia, felicidad = proyectar(user.energia, user.felicidad, user.stats_ts, *ventana_sueño(user), ahora)
+        user.energia = round(energia, 2)
+        user.felicidad = round(felicidad, 2)
+    user.stats_ts = ahora
+    return user
 
-    asyncio.create_task(despertar_automatico())
+class TablaMascotas:
+    """Arrays de NumPy con lo necesario para proyectar a todas las mascotas de una vez.
+
+    Sólo se copian (en Python) los usuarios modificados desde el último tick;
+    la proyección y la búsqueda de cruces de umbral son vectoriales.
+    """
+    CAMPOS = ("energia", "felicidad", "ts", "inicio_sueño", "fin_sueño")
+
+    def __init__(self, capacidad=1024):
+        self.ids = []
+        self.posicion = {}
+        self.columnas = {campo: np.zeros(capacidad) for campo in self.CAMPOS}
+        # bit 1: ya avisado de cansancio, bit 2: de tristeza
+        self.avisado = np.zeros(capacidad, dtype=np.uint8)
+
+    def _crecer(self):
+        capacidad = 2 * len(self.avisado)
+        for campo, columna in self.columnas.items():
+            self.columnas[campo] = np.resize(columna, capacidad)
+        self.avisado = np.resize(self.avisado, capacidad)
+        self.avisado[len(self.ids):] = 0
+
+    def poner(self, user_id, user):
+        i = self.posicion.get(user_id)
+        if i is None:
+            if len(self.ids) == len(self.avisado):
+                self._crecer()
+            i = self.posicion[user_id] = len(self.ids)
+            self.ids.append(user_id)
+        inicio, fin = ventana_sueño(user)
+        # sin stats_ts no hay desde cuándo proyectar: NaN no cruza ningún umbral (como el
+        # `continue` de TablaMascotasSinNumpy) hasta que actualizar_stats le ponga uno
+        ts = user.stats_ts if user.stats_ts is not None else np.nan
+        valores = (user.energia, user.felicidad, ts, inicio, fin)
+        for campo, valor in zip(self.CAMPOS, valores):
+            self.columnas[campo][i] = valor
+
+    def reconstruir(self, usuarios):
+        self.__init__(max(1024, len(usuarios)))
+        for user_id, user in usuarios.items():
+            self.poner(user_id, user)
+        # los avisos no se guardan: quien ya está bajo el umbral se avisó antes del
+        # reinicio, así que cuenta como avisado (igual que agenda.anunciados)
+        energia, felicidad, _ = self._proyectar(reloj.ahora())
+        avisado = self.avisado[:len(self.ids)]
+        avisado[energia < UMBRAL_CANSADO] |= 1
+        avisado[felicidad < UMBRAL_TRISTE] |= 2
+
+    def _proyectar(self, ahora):
+        n = len(self.ids)
+        c = {campo: columna[:n] for campo, columna in self.columnas.items()}
+        energia, felicidad = proyectar(
+            c["energia"], c["felicidad"], c["ts"], c["inicio_sueño"], c["fin_sueño"], ahora,
+            minimo=np.minimum, maximo=np.maximum,
+        )
+        despierto = ~((c["inicio_sueño"] <= ahora) & (ahora < c["fin_sueño"]))
+        return energia, felicidad, despierto
+
+    def cruces(self, ahora):
+        """user_ids que acaban de bajar de UMBRAL_CANSADO y de UMBRAL_TRISTE (despiertos)."""
+        energia, felicidad, despierto = self._proyectar(ahora)
+        avisado = self.avisado[:len(self.ids)]
+        resultado = []
+        for bit, valores, umbral in ((1, energia, UMBRAL_CANSADO), (2, felicidad, UMBRAL_TRISTE)):
+            # volver a avisar sólo después de que se recupere un poco
+            avisado[valores >= umbral + 5] &= ~np.uint8(bit)
+            nuevos = np.flatnonzero((valores < umbral) & despierto & ((avisado & bit) == 0))
+            avisado[nuevos] |= bit
+            resultado.append([self.ids[i] for i in nuevos])
+        return resultado
+
+class TablaMascotasSinNumpy:
+    """Lo mismo que TablaMascotas recorriendo los usuarios en Python (si no hay NumPy)."""
+
+    def __init__(self):
+        self.usuarios = {}
+        self.avisado = {}
+
+    def poner(self, user_id, user):
+        pass  # lee directo de los usuarios en cada tick
+
+    def reconstruir(self, usuarios):
+        self.usuarios = usuarios
+        self.avisado = {}
+        ahora = reloj.ahora()
+        for user_id, user in usuarios.items():
+            if user.stats_ts is None:
+                continue
+            energia, felicidad = proyectar(user.energia, user.felicidad, user.stats_ts, *ventana_sueño(user), ahora)
+            self.avisado[user_id] = (energia < UMBRAL_CANSADO) | (felicidad < UMBRAL_TRISTE) << 1
+
+    def cruces(self, ahora):
+        resultado = ([], [])
+        for user_id, user in self.usuarios.items():
+            if user.stats_ts is None:
+                continue
+            inicio, fin = ventana_sueño(user)
+            valores = proyectar(user.energia, user.felicidad, user.stats_ts, inicio, fin, ahora)
+            bits = self.avisado.get(user_id, 0)
+            for n, (bit, valor, umbral) in enumerate(((1, valores[0], UMBRAL_CANSADO), (2, valores[1], UMBRAL_TRISTE))):
+                if valor >= umbral + 5:
+                    bits &= ~bit
+                elif valor < umbral and not bits & bit and not inicio <= ahora < fin:
+                    bits |= bit
+                    resultado[n].append(user_id)
+            self.avisado[user_id] = bits
+        return resultado
+
+tabla_mascotas = TablaMascotas() if np is not None else TablaMascotasSinNumpy()
+
+async def simular_mascotas(context: ContextTypes.DEFAULT_TYPE):
+    for user_id in almacen.tomar_tocados():
+        user = almacen.usuario(user_id)
+        if user is not None:
+            tabla_mascotas.poner(user_id, user)
+    cansados, tristes = tabla_mascotas.cruces(reloj.ahora())
+    await difundir(cansados, "🥱 Tu Pepegotchi está muy cansado. Usa /alimentar o déjalo /dormir 💤")
+    await difundir(tristes, "🥺 Tu Pepegotchi está triste y aburrido. ¡Usa /jugar con él! 🎮")
 
 # === Bloquear acciones mientras duerme ===
-async def verificar_sueño(update: Update):
-    datos = cargar_datos()
-    user_id = str(update.effective_user.id)
-    user = asegurar_usuario(datos, user_id)
-    if user.get("durmiendo", False):
-        await update.message.reply_text("🤫 Shhhh... tu Pepegotchi está dormido 💤 volverá en 6 horas.")
-        return True
-    return False
+async def verificar_sueño(update: Update, user):
+    hasta = hora_despertar(user)
+    if hasta is None:
+        return False
+    ahora = reloj.ahora()
+    if ahora >= hasta:
+        # ya le tocaba despertar; el despertador lo descartará al pasar
+        despertar(user)
+        almacen.marcar(str(update.effective_user.id))
+        return False
+    anotar(resultado="dormido")
+    await responder(update, f"🤫 Shhhh... tu Pepegotchi está dormido 💤 volverá en {texto_espera(hasta - ahora)}.")
+    return True
 
 # Modificar alimentar y jugar para incluir la verificación de sueño
 async def alimentar(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if await verificar_sueño(update):
-        return
-    datos = cargar_datos()
     user_id = str(update.effective_user.id)
-    user = asegurar_usuario(datos, user_id)
-    hoy = fecha_local_hoy()
-
-    # Verificar límite diario
-    if user.get("veces_alimento", {}).get(hoy, 0) >= 4:
-        await update.message.reply_text("🍽️ Ya alimentaste 4 veces hoy. Espera hasta mañana.")
-        return
+    async with almacen.bloqueo(user_id):
+        user = asegurar_usuario(user_id)
+        if await verificar_sueño(update, user):
+            return
+        daily = contadores_de_hoy(user)
+
+        # Verificar límite diario
+        veces = daily["alimentar"]
+        if veces >= 4:
+            anotar(resultado="limite_diario")
+            await responder(
+                update,
+                f"🍽️ Ya alimentaste 4 veces hoy. Vuelve en {texto_espera(reloj.segundos_para_reinicio())}."
+            )
+            return
 
-    # Primera vez gratis
-    veces = user.get("veces_alimento", {}).get(hoy, 0)
-    costo = 0 if veces == 0 else 100
+        # Primera vez gratis
+        costo = 0 if veces == 0 else 100
 
-    if user["monedas"] < costo:
-        await update.message.reply_text("💸 No tienes suficientes monedas para alimentar.")
-        return
+        if user.monedas < costo:
+            anotar(resultado="sin_monedas")
+            await responder(update, "💸 No tienes suficientes monedas para alimentar.")
+            return
 
-    user["monedas"] -= costo
-    user["energia"] = min(100, user["energia"] + 20)
-    user["xp"] += 10
-    user.setdefault("veces_alimento", {})[hoy] = veces + 1
-    guardar_datos(datos)
-    await revisar_rango(update, user_id, datos)
+        xp = agenda.activos().con_xp(10)
+        user.monedas -= costo
+        user.energia = min(100, user.energia + 20)
+        sumar_xp(user_id, user, xp)
+        daily["alimentar"] = veces + 1
+        almacen.marcar(user_id)
+        await revisar_rango(update, user_id, user)
 
     if costo == 0:
-        await update.message.reply_text("🍎 Alimentaste a tu Pepegotchi gratis por hoy 💕 (+10 XP)")
+        await responder(update, f"🍎 Alimentaste a tu Pepegotchi gratis por hoy 💕 (+{xp} XP)")
     else:
-        await update.message.reply_text(f"🍔 Alimentaste a tu Pepegotchi pagando {costo} monedas 💰 (+10 XP)")
+        await responder(update, f"🍔 Alimentaste a tu Pepegotchi pagando {costo} monedas 💰 (+{xp} XP)")
 
 async def jugar(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if await verificar_sueño(update):
-        return
-    datos = cargar_datos()
     user_id = str(update.effective_user.id)
-    user = asegurar_usuario(datos, user_id)
-    hoy = fecha_local_hoy()
-
-    # Verificar límite diario
-    if user.get("veces_juego", {}).get(hoy, 0) >= 4:
-        await update.message.reply_text("🎮 Ya jugaste 4 veces hoy. Espera hasta mañana.")
-        return
+    async with almacen.bloqueo(user_id):
+        user = asegurar_usuario(user_id)
+        if await verificar_sueño(update, user):
+            return
+        daily = contadores_de_hoy(user)
+
+        # Verificar límite diario
+        veces = daily["jugar"]
+        if veces >= 4:
+            anotar(resultado="limite_diario")
+            await responder(
+                update,
+                f"🎮 Ya jugaste 4 veces hoy. Vuelve en {texto_espera(reloj.segundos_para_reinicio())}."
+            )
+            return
 
-    veces = user.get("veces_juego", {}).get(hoy, 0)
-    costo = 0 if veces == 0 else 150
+        costo = 0 if veces == 0 else 150
 
-    if user["monedas"] < costo:
-        await update.message.reply_text("💸 No tienes suficientes monedas para jugar.")
-        return
+        if user.monedas < costo:
+            anotar(resultado="sin_monedas")
+            await responder(update, "💸 No tienes suficientes monedas para jugar.")
+            return
 
-    user["monedas"] -= costo
-    user["xp"] += 15
-    user["felicidad"] = min(100, user["felicidad"] + 15)
-    user.setdefault("veces_juego", {})[hoy] = veces + 1
-    guardar_datos(datos)
-    await revisar_rango(update, user_id, datos)
+        xp = agenda.activos().con_xp(15)
+        user.monedas -= costo
+        sumar_xp(user_id, user, xp)
+        user.felicidad = min(100, user.felicidad + 15)
+        daily["jugar"] = veces + 1
+        almacen.marcar(user_id)
+        await revisar_rango(update, user_id, user)
 
     if costo == 0:
-        await update.message.reply_text("🎲 Jugaste gratis con tu Pepegotchi por hoy 🎉 (+15 XP)")
+        await responder(update, f"🎲 Jugaste gratis con tu Pepegotchi por hoy 🎉 (+{xp} XP)")
     else:
-        await update.message.reply_text(f"🎯 Jugaste pagando {costo} monedas 💰 (+15 XP)")
+        await responder(update, f"🎯 Jugaste pagando {costo} monedas 💰 (+{xp} XP)")
 
 # === Reinicio diario a las 00:00 ===
-async def reinicio_diario():
-    while True:
-        ahora = datetime.now(pytz.timezone("America/Guatemala"))
-        siguiente = (ahora + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
-        espera = (siguiente - ahora).total_seconds()
-        await asyncio.sleep(espera)
-
-        datos = cargar_datos()
-        for user in datos["usuarios"].values():
-            user["veces_alimento"] = {}
-            user["veces_juego"] = {}
-        guardar_datos(datos)
-        print("🔄 Reinicio diario completado.")
+# Los contadores se reinician por usuario en contadores_de_hoy(); aquí no se
+# recorre la DB.
+async def reinicio_diario(context: ContextTypes.DEFAULT_TYPE):
+    print(f"🔄 Nuevo día {reloj.hoy()}: los contadores se reinician al primer uso.")
 # - Arranque del bot
 
 # === COMANDO /estado ===
 async def estado(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if await verificar_sueño(update):
-        return
-    datos = cargar_datos()
     user_id = str(update.effective_user.id)
-    user = asegurar_usuario(datos, user_id)
-
-    msg = (
-        f"📊 **Estado de tu Pepegotchi**\n\n"
-        f"🪙 Monedas: {user['monedas']}\n"
-        f"⭐ Experiencia: {user['xp']}\n"
-        f"🏅 Nivel: {user['nivel']}\n"
-        f"😊 Felicidad: {user['felicidad']}%\n"
-        f"⚡ Energía: {user['energia']}%\n"
+    async with almacen.bloqueo(user_id):
+        user = asegurar_usuario(user_id)
+        almacen.marcar(user_id)
+        if await verificar_sueño(update, user):
+            return
+
+        msg = (
+            f"📊 **Estado de tu Pepegotchi**\n\n"
+            f"🪙 Monedas: {user.monedas}\n"
+            f"⭐ Experiencia: {user.xp}\n"
+            f"🏅 Rango: {obtener_rango(user.xp)}\n"
+            f"😊 Felicidad: {round(user.felicidad)}%\n"
+            f"⚡ Energía: {round(user.energia)}%\n"
+        )
+    await enviar_foto_rango(update, user.xp, msg)
+
+# === COMANDO /referir ===
+async def referir(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = str(update.effective_user.id)
+
+    if not context.args:
+        async with almacen.bloqueo(user_id):
+            user = asegurar_usuario(user_id, update.effective_user.first_name)
+        await responder(
+            update,
+            f"🤝 Tu código de referido es *{user.codigo}* ({len(user.referidos)} referidos)\n"
+            f"Tus amigos lo usan con `/referir {user.codigo}` y ambos ganan monedas 💰",
+            parse_mode="Markdown"
+        )
+        return
+
+    codigo = context.args[0].strip().upper()
+    referente_id = buscar_referente(codigo)
+    if referente_id is None:
+        await responder(update, "❌ Ese código de referido no existe.")
+        return
+    if referente_id == user_id:
+        await responder(update, "🙃 No puedes usar tu propio código.")
+        return
+
+    # siempre en el mismo orden para que dos /referir cruzados no se bloqueen entre sí
+    primero, segundo = sorted((user_id, referente_id))
+    async with almacen.bloqueo(primero), almacen.bloqueo(segundo):
+        user = asegurar_usuario(user_id, update.effective_user.first_name)
+        if es_propio(referente_id):
+            referente = almacen.usuario(referente_id)
+            referido_por = referente.referido_por
+        else:
+            # vive en otro proceso: se lee lo que guardó y el bono le llega por su buzón
+            referente = None
+            referido_por = (backend.leer_usuario(referente_id) or {}).get("referido_por")
+        if user.referido_por or referido_por == user_id:
+            await responder(update, "🤝 Ya usaste un código de referido.")
+            return
+
+        user.referido_por = referente_id
+        user.monedas += BONO_REFERIDO
+        almacen.marcar(user_id)
+        if referente is not None:
+            referente.referidos.append(user_id)
+            referente.monedas += BONO_REFERENTE
+            almacen.marcar(referente_id)
+        else:
+            backend.enviar_cambio(referente_id, {"monedas": BONO_REFERENTE, "referido": user_id})
+        # el delta del evento es sólo el de quien usa el código
+        anotar(referente=referente_id, monedas_referente=BONO_REFERENTE)
+
+    await responder(update, f"🎉 ¡Código aceptado! +{BONO_REFERIDO} monedas 💰")
+    despachador.notificar(
+        referente_id,
+        f"🤝 {user.nombre} usó tu código de referido. +{BONO_REFERENTE} monedas 💰"
     )
-    await update.message.reply_text(msg, parse_mode="Markdown")
 
-if __name__ == "__main__":
-    from dotenv import load_dotenv
-    import os
+# === COMANDO /ranking ===
+TOP_RANKING = 10
 
-    load_dotenv()
-    TOKEN = os.getenv("TOKEN")
+async def ranking(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = str(update.effective_user.id)
+    texto = texto_top(TOP_RANKING)
+    posicion = indice_xp.posicion(user_id)
+    if posicion is not None:
+        texto += f"\n\n📍 Tu posición: #{posicion} de {len(indice_xp)}"
+    await responder(update, texto, parse_mode="Markdown")
+
+# === MÉTRICAS: tiempos de handlers, DB y envíos (ver metricas.py) ===
+def medido(nombre, handler):
+    """Envuelve un handler para medir su duración y contar sus errores."""
+    cronometrado = metricas.cronometrado("pepegotchi_handler_segundos", handler=nombre)(handler)
+
+    @functools.wraps(handler)
+    async def envuelto(update, context):
+        try:
+            return await cronometrado(update, context)
+        except Exception:
+            metricas.contar("pepegotchi_handler_errores_total", handler=nombre)
+            raise
+    return envuelto
+
+metricas.describir("pepegotchi_handler_segundos", "Duración de cada handler")
+metricas.describir("pepegotchi_db_segundos", "Duración de las operaciones de la DB")
+metricas.describir("pepegotchi_envios_total", "Llamadas a la Bot API por método y resultado")
+metricas.describir("pepegotchi_limitados_total", "Updates descartados por el limitador por usuario")
+metricas.describir("pepegotchi_callbacks_repetidos_total", "Callbacks descartados por id repetido")
+metricas.describir("pepegotchi_envio_segundos", "Duración de las llamadas a la Bot API que salieron bien")
+metricas.medidor("pepegotchi_usuarios", lambda: len(almacen.usuarios))
+metricas.medidor("pepegotchi_usuarios_sucios", lambda: len(almacen._sucios))
+metricas.medidor("pepegotchi_db_bytes", lambda: backend.tamano())
+metricas.medidor("pepegotchi_db_diario_bytes", lambda: backend.tamano_diario())
+metricas.medidor("pepegotchi_envios_pendientes", lambda: despachador.pendientes)
+metricas.medidor("pepegotchi_bandeja_pendientes", lambda: len(despachador.bandeja.pendientes))
+metricas.medidor("pepegotchi_sin_red", lambda: int(despachador.sin_red))
+
+# === BITÁCORA DE EVENTOS: un registro por comando para las analíticas (ver bitacora.py) ===
+bitacora = Bitacora(
+    EVENTOS_DIR, EVENTOS_MAX_BYTES, EVENTOS_LOTE, EVENTOS_FLUSH,
+    sufijo=f"-p{PROCESO}" if PROCESO is not None else "",
+) if EVENTOS_DIR else None
+evento_actual = contextvars.ContextVar("evento_actual", default=None)
+
+def anotar(**campos):
+    """Agrega campos (resultado, artículo...) al evento del comando en curso."""
+    evento = evento_actual.get()
+    if evento is not None:
+        evento.update(campos)
+
+def con_bitacora(nombre, handler):
+    """Envuelve un handler para registrar quién lo usó, cuánto tardó y cuánto
+    cambiaron su xp y sus monedas (los updates de un usuario van en orden, así
+    que la diferencia es la de este comando)."""
+    @functools.wraps(handler)
+    async def envuelto(update, context):
+        if bitacora is None or update.effective_user is None:
+            return await handler(update, context)
+        user_id = str(update.effective_user.id)
+        antes = almacen.usuario(user_id)
+        xp, monedas = (antes.xp, antes.monedas) if antes else (0, 0)
+        evento = {"ts": round(reloj.ahora(), 3), "dia": reloj.hoy(), "usuario": user_id, "comando": nombre}
+        token = evento_actual.set(evento)
+        t = time.perf_counter()
+        try:
+            return await handler(update, context)
+        except Exception:
+            evento["resultado"] = "error"
+            raise
+        finally:
+            evento_actual.reset(token)
+            evento["ms"] = round((time.perf_counter() - t) * 1000, 2)
+            despues = almacen.usuario(user_id)
+            if despues is not None:
+                evento["xp"] = despues.xp - xp
+                evento["monedas"] = despues.monedas - monedas
+            bitacora.registrar(evento)
+    return envuelto
+
+if bitacora is not None:
+    metricas.medidor("pepegotchi_bitacora_pendientes", lambda: bitacora.pendientes)
+    metricas.medidor("pepegotchi_bitacora_descartados", lambda: bitacora.descartados)
+
+# === COMANDO /stats (sólo admin) ===
+def lineas_histograma(nombre, etiqueta):
+    serie = metricas.histogramas.get(nombre, {})
+    for etiquetas, h in sorted(serie.items(), key=lambda par: -par[1].cuenta):
+        yield f"  {dict(etiquetas)[etiqueta]}: {h.cuenta} · {h.cuantil(0.5) * 1000:.1f} · {h.cuantil(0.95) * 1000:.1f}"
+
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not ADMIN_CHAT_ID or str(update.effective_user.id) != str(ADMIN_CHAT_ID):
+        return
+
+    lineas = [
+        "📊 Estadísticas",
+        f"👥 Usuarios: {len(almacen.usuarios)} (sin guardar: {len(almacen._sucios)})",
+        f"💾 DB: {backend.tamano() // 1024} KB, "
+        f"diario {backend.tamano_diario() // 1024} KB",
+        "",
+        "⏱ Handlers (veces · p50 · p95 ms):",
+        *lineas_histograma("pepegotchi_handler_segundos", "handler"),
+        "",
+        "💾 DB (veces · p50 · p95 ms):",
+        *lineas_histograma("pepegotchi_db_segundos", "operacion"),
+    ]
+
+    envios = {}
+    for etiquetas, n in metricas.contadores.get("pepegotchi_envios_total", {}).items():
+        resultado = dict(etiquetas)["resultado"]
+        envios[resultado] = envios.get(resultado, 0) + n
+    cola = despachador.estadisticas()
+    limitados = sum(metricas.contadores.get("pepegotchi_limitados_total", {}).values())
+    repetidos = sum(metricas.contadores.get("pepegotchi_callbacks_repetidos_total", {}).values())
+    lineas += [
+        "",
+        "📤 Envíos: " + (", ".join(f"{r} {n}" for r, n in sorted(envios.items())) or "ninguno"),
+        f"📬 En cola: {cola['pendientes']} · bandeja: {cola['bandeja']} · sin red: {'sí' if cola['sin_red'] else 'no'}",
+        f"🐢 Limitados: {limitados} · callbacks repetidos: {repetidos}",
+    ]
+    await responder(update, "\n".join(lineas))
+
+# === LIMITADOR: token bucket por usuario, antes de que el update haga fila ===
+class Limitador:
+    """Decide si un update de un usuario pasa a los handlers.
+
+    Cada usuario tiene una Cubeta de LIMITE_POR_SEG comandos/s con ráfagas de
+    LIMITE_RAFAGA. Los callbacks con un id ya visto (reintentos de Telegram,
+    dobles toques que llegan repetidos) se descartan. Al que se pasa se le
+    avisa con AVISO_LENTO como mucho una vez cada AVISO_LENTO_CADA segundos.
+    """
+
+    def __init__(self, tasa, rafaga, max_callbacks=10000):
+        self.tasa = tasa
+        self.rafaga = rafaga
+        self.max_callbacks = max_callbacks
+        self._cubetas = {}
+        self._avisado = {}               # user_id -> monotonic del último aviso
+        self._callbacks = OrderedDict()  # ids de callback recientes, el más viejo primero
+
+    def permitir(self, user_id, ahora):
+        cubeta = self._cubetas.get(user_id)
+        if cubeta is None:
+            if len(self._cubetas) > 10000:
+                # olvidar a los que ya tienen la cubeta llena (equivale a no tenerla)
+                self._cubetas = {u: c for u, c in self._cubetas.items() if not c.llena(ahora)}
+                self._avisado = {u: t for u, t in self._avisado.items() if u in self._cubetas}
+            cubeta = self._cubetas[user_id] = Cubeta(self.tasa, self.rafaga)
+        return cubeta.espera(ahora) == 0
+
+    def avisar(self, user_id, ahora):
+        if ahora - self._avisado.get(user_id, float("-inf")) < AVISO_LENTO_CADA:
+            return False
+        self._avisado[user_id] = ahora
+        return True
+
+    def callback_repetido(self, query_id):
+        if query_id in self._callbacks:
+            return True
+        self._callbacks[query_id] = None
+        if len(self._callbacks) > self.max_callbacks:
+            self._callbacks.popitem(last=False)
+        return False
+
+limitador = Limitador(LIMITE_POR_SEG, LIMITE_RAFAGA)
+
+async def limitar(update):
+    """True si `update` sigue a los handlers. Lo llama ProcesadorPorUsuario
+    antes de la fila del usuario: lo que se pasa del límite se descarta sin
+    esperar turno ni ocupar un trabajador."""
+    user = update.effective_user
+    if user is None:
+        return True
+    query = update.callback_query
+    if query is not None and limitador.callback_repetido(query.id):
+        metricas.contar("pepegotchi_callbacks_repetidos_total")
+        return False
+
+    ahora = time.monotonic()
+    if limitador.permitir(user.id, ahora):
+        return True
+    metricas.contar("pepegotchi_limitados_total", tipo="callback" if query else "mensaje")
+    # sin tocar la DB: sólo el aviso fijo, y no a cada mensaje
+    avisar = limitador.avisar(user.id, ahora)
+    try:
+        if query is not None:
+            # el callback se responde siempre (si no, el botón queda girando); el texto no siempre
+            await query.answer(AVISO_LENTO if avisar else None)
+        elif avisar and update.message is not None:
+            await despachador.enviar(update.effective_chat.id, update.message.reply_text, AVISO_LENTO)
+    except TelegramError:
+        pass
+    return False
+
+# === ARRANQUE / APAGADO: cargar la DB una vez y vaciar lo pendiente al salir ===
+async def al_iniciar(app):
+    t = time.perf_counter()
+    almacen.cargar()
+    restauracion = time.perf_counter() - t
+    metricas.medidor("pepegotchi_db_restauracion_segundos", lambda: restauracion)
+    despertador.reconstruir(almacen.usuarios)
+    tabla_mascotas.reconstruir(almacen.usuarios)
+    indice_xp.reconstruir(almacen.usuarios)
+    reconstruir_codigos(almacen.usuarios)
+    cache_imagenes.cargar()
+    despachador.iniciar(app.bot)
+    if PRECARGAR_IMAGENES and ADMIN_CHAT_ID:
+        await precargar_imagenes(app.bot)
+    app.job_queue.run_repeating(guardar_pendientes, interval=FLUSH_INTERVAL, name="guardar_pendientes")
+    app.job_queue.run_repeating(despertar_mascotas, interval=BACKGROUND_SLEEP, first=1, name="despertar_mascotas")
+    app.job_queue.run_repeating(simular_mascotas, interval=STATS_TICK, first=STATS_TICK, name="simular_mascotas")
+    # lo que ya estaba activo al arrancar no se vuelve a anunciar
+    agenda.anunciados = {e.id: e for e in agenda.activos().eventos}
+    app.job_queue.run_repeating(anunciar_eventos, interval=AGENDA_REVISAR, name="anunciar_eventos")
+    if METRICAS_PORT:
+        app.bot_data["servidor_metricas"] = await metricas.servir_http(METRICAS_HOST, METRICAS_PORT)
+        print(f"📈 Métricas en http://{METRICAS_HOST}:{METRICAS_PORT}/metrics")
+    print(f"📂 {len(almacen.usuarios)} usuarios cargados en memoria en {restauracion:.2f} s.")
+
+async def al_apagar(app):
+    if servidor := app.bot_data.pop("servidor_metricas", None):
+        servidor.close()
+    await mostrar_compras_pendientes()
+    await despachador.detener()
+    await almacen.esperar_compactacion()
+    almacen.compactar()
+    backend.cerrar()
+    if bitacora is not None:
+        bitacora.cerrar()
+
+# === PROCESAMIENTO CONCURRENTE: varios usuarios a la vez, cada usuario en orden ===
+class ProcesadorPorUsuario(BaseUpdateProcessor):
+    """Procesa hasta `trabajadores` updates en paralelo, pero nunca dos del mismo usuario.
+
+    Así el leer-modificar-escribir de un usuario no se mezcla con otro update
+    suyo, mientras los demás usuarios siguen avanzando. El límite de PTB
+    (que se toma antes de llegar aquí) queda muy alto a propósito: el cupo de
+    `trabajadores` se pide recién después del lock del usuario, así que los
+    updates en fila detrás de su propio usuario no ocupan lugar y uno que
+    manda muchos no frena a los demás. `filtro` (el limitador) decide antes
+    de la fila qué updates se descartan.
+    """
+
+    SIN_LIMITE = 1_000_000
+
+    def __init__(self, trabajadores, filtro=None):
+        super().__init__(self.SIN_LIMITE)
+        self._trabajando = asyncio.Semaphore(trabajadores)
+        self._filtro = filtro
+        self._bloqueos = {}  # user_id -> [Lock, updates usándolo]
+
+    async def do_process_update(self, update, coroutine):
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            async with self._trabajando:
+                await coroutine
+            return
+        if self._filtro is not None and not await self._filtro(update):
+            coroutine.close()  # descartado: Application.process_update no llega a correr
+            return
+        entrada = self._bloqueos.setdefault(user.id, [asyncio.Lock(), 0])
+        entrada[1] += 1
+        try:
+            async with entrada[0], self._trabajando:
+                await coroutine
+        finally:
+            entrada[1] -= 1
+            if not entrada[1]:
+                del self._bloqueos[user.id]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+# === MODO WEBHOOK: servidor HTTP local que mete los updates en la cola del bot ===
+# Prueba local (sin WEBHOOK_URL no se registra nada en Telegram):
+#   curl -X POST localhost:8443/webhook -H 'Content-Type: application/json' -d @update.json
+async def atender_webhook(app, metodo, ruta, cabeceras, cuerpo):
+    if metodo != "POST" or ruta != "/" + WEBHOOK_PATH:
+        return 404, b""
+    if WEBHOOK_SECRET and cabeceras.get("x-telegram-bot-api-secret-token") != WEBHOOK_SECRET:
+        return 403, b""
+    try:
+        datos = json.loads(cuerpo)
+        if not isinstance(datos, dict):
+            raise ValueError("el cuerpo no es un Update")
+        update = Update.de_json(datos, app.bot)
+    except (ValueError, TypeError, KeyError, AttributeError):
+        # no es JSON, o es JSON válido pero no un Update ({} sin update_id, campos de otro tipo...)
+        return 400, b""
+    await app.update_queue.put(update)
+    return 200, b""
+
+# === POLLING PROPIO: reconecta con backoff en vez de morir por NetworkError ===
+async def con_reintentos(funcion, *args, **kwargs):
+    backoff = Backoff(RED_BACKOFF_BASE, RED_BACKOFF_MAX)
+    while True:
+        try:
+            return await funcion(*args, **kwargs)
+        except NetworkError as e:
+            espera = backoff.siguiente()
+            print(f"🔌 {e}; reintentando en {espera:.1f}s")
+            await asyncio.sleep(espera)
+
+async def recibir_polling(app):
+    await con_reintentos(app.bot.delete_webhook)
+    backoff = Backoff(RED_BACKOFF_BASE, RED_BACKOFF_MAX)
+    offset = None
+    while True:
+        try:
+            updates = await app.bot.get_updates(
+                offset=offset, timeout=POLL_TIMEOUT, allowed_updates=Update.ALL_TYPES
+            )
+        except NetworkError as e:
+            # la misma caída que ve el polling pausa también los envíos
+            despachador.red_caida()
+            espera = backoff.siguiente()
+            if backoff.fallos == 1:
+                print(f"🔌 Polling sin conexión ({e}); reintentando con backoff")
+            await asyncio.sleep(espera)
+            continue
+        except TelegramError as e:
+            # p.ej. Conflict: otra instancia haciendo polling
+            espera = backoff.siguiente()
+            print(f"⚠️ getUpdates falló: {e}; reintentando en {espera:.1f}s")
+            await asyncio.sleep(espera)
+            continue
+        if backoff.fallos:
+            print("🔌 Polling reconectado")
+            backoff.reiniciar()
+            despachador.red_ok()
+        for update in updates:
+            await app.update_queue.put(update)
+            offset = update.update_id + 1
+
+async def correr(app, recibir=None):
+    """Corre la app hasta SIGINT/SIGTERM. Los updates llegan por webhook o
+    polling según MODO, o por `recibir(app)` si se da (trabajador multiproceso)."""
+    await con_reintentos(app.initialize)
+    if app.post_init:
+        await app.post_init(app)
+    servidor = polling = None
+    if recibir is not None:
+        polling = asyncio.create_task(recibir(app))
+    elif MODO == "webhook":
+        servidor = await servidor_http.servir(
+            functools.partial(atender_webhook, app), WEBHOOK_LISTEN, WEBHOOK_PORT, max_cuerpo=WEBHOOK_MAX_BYTES
+        )
+        if WEBHOOK_URL:
+            await con_reintentos(
+                app.bot.set_webhook,
+                f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES,
+            )
+        print(f"🌐 Webhook escuchando en {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}")
+    else:
+        polling = asyncio.create_task(recibir_polling(app))
+    await app.start()
 
-    app = ApplicationBuilder().token(TOKEN).build()
+    detener = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for senal in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(senal, detener.set)
+        except NotImplementedError:
+            pass
+    try:
+        await detener.wait()
+    finally:
+        if servidor:
+            servidor.close()
+        if polling:
+            polling.cancel()
+        await app.stop()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+        await app.shutdown()
+
+# === MULTIPROCESO: un receptor reparte los updates por user_id entre PROCESOS trabajadores ===
+# Cada trabajador es el bot completo (crear_app) sobre sus usuarios: los carga, los
+# modifica y los guarda sólo él, así que no hacen falta locks entre procesos. Lo
+# compartido va por la DB SQLite (WAL): ranking (RankingCompartido), códigos de
+# referido (buscar_referente) y cambios a usuarios ajenos (buzón). El catálogo ya
+# es un archivo que cada proceso recarga solo.
+def proceso_de(user_id, procesos=None):
+    return fragmento_de(str(user_id), procesos or PROCESOS)
+
+def es_propio(user_id):
+    return PROCESO is None or proceso_de(user_id) == PROCESO
+
+async def aplicar_buzon():
+    """Aplica los cambios que otros procesos dejaron para usuarios propios."""
+    for user_id, cambio in backend.tomar_cambios():
+        async with almacen.bloqueo(user_id):
+            user = almacen.usuario(user_id)
+            if user is None:
+                continue
+            user.monedas += cambio.get("monedas", 0)
+            if cambio.get("referido"):
+                user.referidos.append(cambio["referido"])
+            almacen.marcar(user_id)
+
+async def recibir_de_cola(cola, app):
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            # con timeout: el hilo no debe quedar colgado de la cola al apagar
+            lote = [await loop.run_in_executor(None, cola.get, True, 1)]
+        except queue.Empty:
+            continue
+        try:
+            while len(lote) < 100:
+                lote.append(cola.get_nowait())
+        except queue.Empty:
+            pass
+        for datos in lote:
+            await app.update_queue.put(Update.de_json(datos, app.bot))
+
+def trabajar(token, cola):
+    # proceso nuevo (spawn): main ya se importó con PROCESO puesto, ver Repartidor.lanzar
+    print(f"🧵 Trabajador {PROCESO} de {PROCESOS} (pid {os.getpid()})")
+    asyncio.run(correr(crear_app(token), functools.partial(recibir_de_cola, cola)))
+
+class Repartidor:
+    """Lanza los trabajadores y les pasa a cada uno los updates de sus usuarios."""
+
+    def __init__(self, procesos):
+        # spawn y no fork: cada trabajador arranca limpio (sin el event loop ni los
+        # hilos del receptor) y abre su propia conexión a SQLite
+        self._ctx = multiprocessing.get_context("spawn")
+        self.colas = [self._ctx.Queue() for _ in range(procesos)]
+        self.procesos = [None] * procesos
+        self.token = None
+
+    def lanzar(self, i):
+        # el trabajador lee PROCESO del entorno al importar main
+        os.environ["PROCESO"] = str(i)
+        try:
+            proceso = self._ctx.Process(
+                target=trabajar, args=(self.token, self.colas[i]), name=f"pepegotchi-{i}"
+            )
+            proceso.start()
+        finally:
+            del os.environ["PROCESO"]
+        self.procesos[i] = proceso
+
+    async def iniciar(self, app):
+        self.token = app.bot.token
+        for i in range(len(self.colas)):
+            self.lanzar(i)
+        app.job_queue.run_repeating(self.vigilar, interval=PROCESOS_REVISAR, name="vigilar_procesos")
+        if METRICAS_PORT:
+            app.bot_data["servidor_metricas"] = await metricas.servir_http(METRICAS_HOST, METRICAS_PORT)
+        print(f"🔀 Repartiendo updates entre {len(self.colas)} procesos")
+
+    async def repartir(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        # los updates sin usuario (p.ej. de canales) van todos al primero
+        user = update.effective_user
+        i = proceso_de(user.id, len(self.colas)) if user else 0
+        self.colas[i].put(update.to_dict())
+        metricas.contar("pepegotchi_repartidos_total", proceso=i)
+
+    async def vigilar(self, context: ContextTypes.DEFAULT_TYPE):
+        for i, proceso in enumerate(self.procesos):
+            if not proceso.is_alive():
+                print(f"⚠️ El trabajador {i} terminó (código {proceso.exitcode}); relanzándolo")
+                self.lanzar(i)
+
+    async def detener(self, app):
+        if servidor := app.bot_data.pop("servidor_metricas", None):
+            servidor.close()
+        # SIGTERM: cada trabajador vacía lo pendiente y guarda como al apagar el bot
+        for proceso in self.procesos:
+            if proceso.is_alive():
+                proceso.terminate()
+        for i, proceso in enumerate(self.procesos):
+            proceso.join(30)
+            if proceso.is_alive():
+                print(f"⚠️ El trabajador {i} no terminó a tiempo; forzando")
+                proceso.kill()
+
+metricas.describir("pepegotchi_repartidos_total", "Updates pasados por el receptor a cada proceso")
+
+# === CONSTRUCCIÓN DE LA APP ===
+def crear_app(token, request=None):
+    builder = (
+        ApplicationBuilder()
+        .token(token)
+        .concurrent_updates(ProcesadorPorUsuario(WORKERS, limitar if LIMITE_POR_SEG else None))
+        .post_init(al_iniciar)
+        .post_shutdown(al_apagar)
+    )
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+    app = builder.build()
 
     # ------------------ HANDLERS ------------------
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("ayuda", ayuda))
-    app.add_handler(CommandHandler("tienda", tienda))
-    app.add_handler(CommandHandler("checkin", checkin))
-    app.add_handler(CommandHandler("evento", evento))
-    app.add_handler(CommandHandler("usar", usar))
-    app.add_handler(CommandHandler("alimentar", alimentar))
-    app.add_handler(CommandHandler("jugar", jugar))
-    app.add_handler(CommandHandler("dormir", dormir))
-    app.add_handler(CommandHandler("estado", estado))
+    comandos = (
+        ("start", start), ("ayuda", ayuda), ("tienda", tienda), ("checkin", checkin),
+        ("evento", evento), ("usar", usar), ("inventario", inventario), ("alimentar", alimentar),
+        ("jugar", jugar), ("dormir", dormir), ("estado", estado), ("ranking", ranking),
+        ("referir", referir), ("stats", stats),
+    )
+    for nombre, handler in comandos:
+        app.add_handler(CommandHandler(nombre, medido(nombre, con_bitacora(nombre, agrupado(handler)))))
 
     # Callback tienda
-    app.add_handler(CallbackQueryHandler(comprar_callback))
+    app.add_handler(CallbackQueryHandler(medido("comprar", con_bitacora("comprar", comprar_callback))))
 
     # --------------- REINICIO DIARIO ---------------
-    from datetime import time
     job_queue = app.job_queue
 
     job_queue.run_daily(
         reinicio_diario,
-        time=time(hour=0, minute=0, second=0),
+        time=dt_time(hour=0, minute=0, second=0, tzinfo=TZ),
         name="reinicio_diario"
     )
+    return app
+
+def crear_receptor(token, request=None):
+    """App del proceso receptor (PROCESOS > 1): recibe como siempre (polling o
+    webhook, ver correr) pero no atiende comandos, sólo los reparte."""
+    if DB_BACKEND != "sqlite":
+        raise SystemExit("❌ PROCESOS > 1 necesita DB_BACKEND=sqlite (la DB compartida)")
+    repartidor = Repartidor(PROCESOS)
+    builder = (
+        ApplicationBuilder()
+        .token(token)
+        .post_init(repartidor.iniciar)
+        .post_shutdown(repartidor.detener)
+    )
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+    app = builder.build()
+    app.add_handler(TypeHandler(Update, repartidor.repartir))
+    return app
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    import os
+
+    load_dotenv()
+    TOKEN = os.getenv("TOKEN")
+
+    app = crear_receptor(TOKEN) if PROCESOS > 1 else crear_app(TOKEN)
 
     print("🤖 Bot iniciado correctamente. Esperando comandos...")
-    app.run_polling()
+    asyncio.run(correr(app))
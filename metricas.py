@@ -0,0 +1,143 @@
+# === MÉTRICAS: contadores, histogramas y medidores en memoria ===
+# Pensado para dejarlo siempre activo: registrar una observación es un
+# perf_counter, un bisect y dos sumas. Se exponen en formato Prometheus
+# (servir_http) y resumidos en /stats.
+import time
+import bisect
+import asyncio
+import functools
+
+from servidor_http import servir
+
+# segundos; cubren desde un acceso a memoria hasta una llamada lenta a Telegram
+CUBETAS_SEGUNDOS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histograma:
+    __slots__ = ("cubetas", "conteos", "cuenta", "suma")
+
+    def __init__(self, cubetas=CUBETAS_SEGUNDOS):
+        self.cubetas = cubetas
+        self.conteos = [0] * (len(cubetas) + 1)  # la última es +Inf
+        self.cuenta = 0
+        self.suma = 0.0
+
+    def observar(self, valor):
+        self.conteos[bisect.bisect_left(self.cubetas, valor)] += 1
+        self.cuenta += 1
+        self.suma += valor
+
+    def cuantil(self, q):
+        """Estimación interpolando dentro de la cubeta (como histogram_quantile)."""
+        if not self.cuenta:
+            return 0.0
+        objetivo = q * self.cuenta
+        acumulado = 0
+        for i, conteo in enumerate(self.conteos):
+            if acumulado + conteo >= objetivo and conteo:
+                if i == len(self.cubetas):
+                    return self.cubetas[-1]
+                inferior = self.cubetas[i - 1] if i else 0.0
+                return inferior + (self.cubetas[i] - inferior) * (objetivo - acumulado) / conteo
+            acumulado += conteo
+        return self.cubetas[-1]
+
+
+class Metricas:
+    """Registro de métricas por nombre y etiquetas (tupla de pares ordenados)."""
+
+    def __init__(self):
+        self.contadores = {}   # nombre -> {etiquetas: valor}
+        self.histogramas = {}  # nombre -> {etiquetas: Histograma}
+        self.medidores = {}    # nombre -> función que devuelve el valor actual
+        self.ayuda = {}
+
+    def describir(self, nombre, texto):
+        self.ayuda[nombre] = texto
+
+    def contar(self, nombre, n=1, **etiquetas):
+        serie = self.contadores.setdefault(nombre, {})
+        clave = tuple(sorted(etiquetas.items()))
+        serie[clave] = serie.get(clave, 0) + n
+
+    def observar(self, nombre, valor, **etiquetas):
+        serie = self.histogramas.setdefault(nombre, {})
+        clave = tuple(sorted(etiquetas.items()))
+        histograma = serie.get(clave)
+        if histograma is None:
+            histograma = serie[clave] = Histograma()
+        histograma.observar(valor)
+
+    def medidor(self, nombre, funcion):
+        self.medidores[nombre] = funcion
+
+    def cronometrado(self, nombre, **etiquetas):
+        """Decorador: observa en `nombre` la duración de cada llamada (async o no)."""
+        def decorador(funcion):
+            if asyncio.iscoroutinefunction(funcion):
+                @functools.wraps(funcion)
+                async def envuelta(*args, **kwargs):
+                    t = time.perf_counter()
+                    try:
+                        return await funcion(*args, **kwargs)
+                    finally:
+                        self.observar(nombre, time.perf_counter() - t, **etiquetas)
+            else:
+                @functools.wraps(funcion)
+                def envuelta(*args, **kwargs):
+                    t = time.perf_counter()
+                    try:
+                        return funcion(*args, **kwargs)
+                    finally:
+                        self.observar(nombre, time.perf_counter() - t, **etiquetas)
+            return envuelta
+        return decorador
+
+    # --- exportar ---
+    def texto_prometheus(self):
+        lineas = []
+
+        def cabecera(nombre, tipo):
+            if nombre in self.ayuda:
+                lineas.append(f"# HELP {nombre} {self.ayuda[nombre]}")
+            lineas.append(f"# TYPE {nombre} {tipo}")
+
+        for nombre, serie in self.contadores.items():
+            cabecera(nombre, "counter")
+            for etiquetas, valor in serie.items():
+                lineas.append(f"{nombre}{_etiquetas(etiquetas)} {valor}")
+        for nombre, serie in self.histogramas.items():
+            cabecera(nombre, "histogram")
+            for etiquetas, h in serie.items():
+                acumulado = 0
+                for limite, conteo in zip((*h.cubetas, "+Inf"), h.conteos):
+                    acumulado += conteo
+                    lineas.append(f"{nombre}_bucket{_etiquetas(etiquetas + (('le', limite),))} {acumulado}")
+                lineas.append(f"{nombre}_sum{_etiquetas(etiquetas)} {h.suma}")
+                lineas.append(f"{nombre}_count{_etiquetas(etiquetas)} {h.cuenta}")
+        for nombre, funcion in self.medidores.items():
+            try:
+                valor = funcion()
+            except Exception:
+                continue
+            cabecera(nombre, "gauge")
+            lineas.append(f"{nombre} {valor}")
+        return "\n".join(lineas) + "\n"
+
+    async def servir_http(self, host, puerto):
+        """Servidor mínimo para que Prometheus lea GET /metrics."""
+        async def manejar(metodo, ruta, cabeceras, cuerpo):
+            if metodo == "GET" and ruta == "/metrics":
+                return 200, self.texto_prometheus().encode()
+            return 404, b""
+
+        return await servir(manejar, host, puerto, tipo="text/plain; version=0.0.4")
+
+
+def _etiquetas(pares):
+    if not pares:
+        return ""
+    return "{" + ",".join(f'{clave}="{valor}"' for clave, valor in pares) + "}"
+
+
+metricas = Metricas()
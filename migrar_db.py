@@ -0,0 +1,35 @@
+# === MIGRADOR: pepegotchi_db.json (+ diario) -> SQLite ===
+# Uso: python migrar_db.py [origen.json] [destino.db]
+# Después arrancar el bot con DB_BACKEND=sqlite.
+import os
+import sys
+
+from almacenamiento import AlmacenJSON, AlmacenSQLite
+
+ORIGEN = "pepegotchi_db.json"
+DIARIO = "pepegotchi_db.journal.jsonl"
+DESTINO = "pepegotchi.db"
+
+
+def migrar(origen=ORIGEN, destino=DESTINO, diario=DIARIO):
+    if not os.path.exists(origen):
+        raise SystemExit(f"❌ No existe {origen}")
+    datos = AlmacenJSON(origen, diario).cargar()
+
+    sqlite = AlmacenSQLite(destino)
+    previos = len(sqlite.cargar()["usuarios"])
+    if previos:
+        raise SystemExit(f"❌ {destino} ya tiene {previos} usuarios; bórralo para migrar de nuevo.")
+    sqlite.guardar_todo(datos)
+    sqlite.compactar(lambda: datos)
+
+    # verificar que lo que se lee de SQLite coincide con el JSON
+    migrados = sqlite.cargar()["usuarios"]
+    sqlite.cerrar()
+    if set(migrados) != set(datos["usuarios"]):
+        raise SystemExit("❌ La migración no coincide con el origen.")
+    print(f"✅ {len(migrados)} usuarios migrados de {origen} a {destino}")
+
+
+if __name__ == "__main__":
+    migrar(*sys.argv[1:3])
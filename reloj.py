@@ -0,0 +1,63 @@
+# === RELOJ: la hora del juego en un solo lugar ===
+# Los handlers y jobs piden la hora y el día local aquí en vez de llamar a
+# datetime.now()/time.time() cada uno. El día ("YYYY-MM-DD") y la próxima
+# medianoche se calculan una vez y se reutilizan hasta cruzarla, así que hoy()
+# cuesta una comparación. RelojFalso permite adelantar días sin esperar
+# (benchmark y pruebas).
+import time
+from datetime import datetime, timedelta, time as dt_time
+
+
+class Reloj:
+    def __init__(self, tz, fuente=time.time):
+        self.tz = tz
+        self._fuente = fuente
+        self._hoy = None
+        self._inicio_dia = float("inf")   # fuerza el cálculo en la primera llamada
+        self._medianoche = float("-inf")
+
+    def ahora(self):
+        """Segundos epoch (como time.time())."""
+        return self._fuente()
+
+    def ahora_local(self):
+        return datetime.fromtimestamp(self._fuente(), self.tz)
+
+    def _medianoche_de(self, fecha):
+        # localize y no replace(tzinfo=): con pytz replace usa el offset histórico (LMT)
+        return self.tz.localize(datetime.combine(fecha, dt_time())).timestamp()
+
+    def _recalcular(self, ahora):
+        local = datetime.fromtimestamp(ahora, self.tz)
+        self._hoy = local.strftime("%Y-%m-%d")
+        self._inicio_dia = self._medianoche_de(local.date())
+        self._medianoche = self._medianoche_de(local.date() + timedelta(days=1))
+
+    def hoy(self):
+        """Día local "YYYY-MM-DD"; sólo se recalcula al cruzar la medianoche."""
+        ahora = self._fuente()
+        if not self._inicio_dia <= ahora < self._medianoche:
+            self._recalcular(ahora)
+        return self._hoy
+
+    def proxima_medianoche(self):
+        self.hoy()
+        return self._medianoche
+
+    def segundos_para_reinicio(self):
+        """Lo que falta para que cambie el día (y se reinicien los contadores diarios)."""
+        return self.proxima_medianoche() - self._fuente()
+
+
+class RelojFalso(Reloj):
+    """Reloj que sólo avanza cuando se le pide."""
+
+    def __init__(self, tz, inicio=None):
+        self.t = time.time() if inicio is None else inicio
+        super().__init__(tz, lambda: self.t)
+
+    def avanzar(self, segundos):
+        self.t += segundos
+
+    def pasar_al_dia_siguiente(self):
+        self.t = self.proxima_medianoche()
@@ -0,0 +1,65 @@
+# === SERVIDOR HTTP MÍNIMO: lo justo para /metrics y el webhook ===
+# Un pedido por conexión (Connection: close), sin chunked ni keep-alive. El
+# cuerpo se lee sólo si Content-Length no pasa de `max_cuerpo`; si pasa se
+# responde 413 sin leerlo, así un cliente no puede hacer reservar lo que quiera.
+import asyncio
+
+MAX_CABECERAS = 100
+
+ESTADOS = {
+    200: "200 OK",
+    400: "400 Bad Request",
+    403: "403 Forbidden",
+    404: "404 Not Found",
+    413: "413 Payload Too Large",
+}
+
+
+class ErrorHTTP(Exception):
+    def __init__(self, estado):
+        super().__init__(ESTADOS[estado])
+        self.estado = estado
+
+
+async def leer_pedido(reader, max_cuerpo):
+    """(metodo, ruta sin query, cabeceras en minúsculas, cuerpo); ErrorHTTP si no sirve."""
+    try:
+        metodo, ruta, _ = (await reader.readline()).decode("latin-1").split(" ", 2)
+        cabeceras = {}
+        while (linea := await reader.readline()) not in (b"\r\n", b"\n", b""):
+            if len(cabeceras) >= MAX_CABECERAS:
+                raise ErrorHTTP(400)
+            clave, _, valor = linea.decode("latin-1").partition(":")
+            cabeceras[clave.strip().lower()] = valor.strip()
+        largo = int(cabeceras.get("content-length", 0))
+    except ValueError:
+        # línea de pedido rota, línea más larga que el límite del StreamReader o largo no numérico
+        raise ErrorHTTP(400) from None
+    if largo < 0:
+        raise ErrorHTTP(400)
+    if largo > max_cuerpo:
+        raise ErrorHTTP(413)
+    try:
+        cuerpo = await reader.readexactly(largo)
+    except asyncio.IncompleteReadError:
+        raise ErrorHTTP(400) from None
+    return metodo, ruta.split("?")[0], cabeceras, cuerpo
+
+
+async def servir(manejar, host, puerto, max_cuerpo=0, tipo="text/plain"):
+    """Atiende con `await manejar(metodo, ruta, cabeceras, cuerpo)` -> (estado, cuerpo)."""
+    async def atender(reader, writer):
+        try:
+            try:
+                estado, cuerpo = await manejar(*await leer_pedido(reader, max_cuerpo))
+            except ErrorHTTP as e:
+                estado, cuerpo = e.estado, b""
+            writer.write(
+                f"HTTP/1.1 {ESTADOS[estado]}\r\nContent-Type: {tipo}\r\n"
+                f"Content-Length: {len(cuerpo)}\r\nConnection: close\r\n\r\n".encode() + cuerpo
+            )
+            await writer.drain()
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(atender, host, puerto)
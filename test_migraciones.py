@@ -0,0 +1,81 @@
+# === PRUEBAS: migraciones de esquema de los registros de usuario (main.py) ===
+# python -m pytest -q
+import os
+import importlib
+
+import pytest
+
+RAIZ = os.path.dirname(os.path.abspath(__file__))
+
+
+@pytest.fixture(scope="module")
+def main():
+    # main carga rangos.json y tienda.json del directorio actual al importarse
+    os.environ.setdefault("EVENTOS_DIR", "")
+    os.environ.setdefault("METRICAS_PORT", "0")
+    previo = os.getcwd()
+    os.chdir(RAIZ)
+    try:
+        return importlib.import_module("main")
+    finally:
+        os.chdir(previo)
+
+
+def test_migracion_v1_unifica_campos_viejos(main):
+    user = main.Usuario.desde_dict("123456789", {
+        "xp": 0,
+        "is_sleeping": True,
+        "sleep_until": "2024-05-02T04:00:00+00:00",
+        "veces_alimento": {"2024-05-01": 3, "2024-04-30": 4},
+        "veces_juego": {"2024-05-01": 1},
+        "acciones_hoy": 2,
+        "nivel": 4,
+    })
+
+    assert user.durmiendo is True
+    assert user.sleep_until == "2024-05-02T04:00:00+00:00"
+    assert user.daily == {"date": "2024-05-01", "alimentar": 3, "jugar": 1}
+    assert user.codigo == "56789"
+    assert user.felicidad == 100
+    assert user.extra is None  # nivel, acciones_hoy y los contadores viejos no sobreviven
+    assert user.ultimo_rango == 0
+
+
+def test_migracion_v1_hora_de_despertar(main):
+    # dormido sin sleep_until: se calcula desde hora_dormir
+    user = main.Usuario.desde_dict("1", {"durmiendo": True, "hora_dormir": "2024-05-01T22:00:00+00:00"})
+    assert user.sleep_until == (main.datetime.fromisoformat("2024-05-01T22:00:00+00:00") + main.DURACION_SUEÑO).isoformat()
+
+    # despierto: no queda un sleep_until viejo
+    user = main.Usuario.desde_dict("1", {"is_sleeping": True, "sleep_until": None})
+    assert user.durmiendo is False
+    assert user.sleep_until is None
+
+
+def test_migracion_v1_no_pisa_un_daily_mas_nuevo(main):
+    user = main.Usuario.desde_dict("1", {
+        "veces_alimento": {"2024-05-01": 3},
+        "daily": {"date": "2024-05-02", "alimentar": 1, "jugar": 2},
+    })
+
+    assert user.daily == {"date": "2024-05-02", "alimentar": 1, "jugar": 2}
+
+
+def test_migracion_v2_rango_por_nombre_a_indice(main):
+    ultimo = len(main.RANGOS) - 1
+    user = main.Usuario.desde_dict("1", {"schema_version": 1, "xp": 0, "ultimo_rango": main.RANGOS[ultimo].nombre})
+    assert user.ultimo_rango == ultimo
+
+    # un nombre que ya no existe cuenta como el rango de su xp
+    xp = main.RANGOS[1].xp
+    user = main.Usuario.desde_dict("1", {"schema_version": 1, "xp": xp, "ultimo_rango": "🐉 Dragón"})
+    assert user.ultimo_rango == 1
+
+
+def test_registro_migrado_se_guarda_con_la_version_actual_y_conserva_lo_desconocido(main):
+    user = main.Usuario.desde_dict("1", {"xp": 3, "campo_futuro": [1, 2]})
+    d = user.a_dict()
+
+    assert d["schema_version"] == main.ESQUEMA_VERSION
+    assert d["campo_futuro"] == [1, 2]
+    assert main.Usuario.desde_dict("1", d) == user
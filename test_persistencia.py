@@ -0,0 +1,144 @@
+# === PRUEBAS: caminos de recuperación de la DB ===
+# python -m pytest -q
+import os
+import json
+
+import pytest
+
+from almacenamiento import AlmacenJSON, AlmacenSQLite
+
+
+def almacen_json(directorio, generaciones=3):
+    return AlmacenJSON(str(directorio / "db.json"), str(directorio / "db.journal"), generaciones)
+
+
+def con_usuarios(*ids, xp=0):
+    return {"usuarios": {user_id: {"xp": xp, "monedas": 50} for user_id in ids}}
+
+
+# --- snapshots JSON ---
+def test_snapshot_corrupto_usa_la_generacion_anterior(tmp_path):
+    db = almacen_json(tmp_path)
+    db.guardar_todo(con_usuarios("1", xp=10))
+    db.guardar_todo(con_usuarios("1", "2", xp=20))
+    # se corrompe el cuerpo del más nuevo: el checksum ya no coincide
+    with open(db.archivo, "r+b") as f:
+        f.seek(-5, os.SEEK_END)
+        f.write(b"XXXXX")
+
+    datos = almacen_json(tmp_path).cargar()
+    assert datos == con_usuarios("1", xp=10)
+
+
+def test_tmp_completo_se_usa_si_el_snapshot_no_sirve(tmp_path):
+    db = almacen_json(tmp_path)
+    db.guardar_todo(con_usuarios("1", xp=10))
+    db.guardar_todo(con_usuarios("1", "2", xp=20))
+    # corte entre el os.replace del actual a .gen y el del .tmp: sólo quedó el .tmp
+    os.replace(db.archivo, db.archivo + ".tmp")
+
+    nuevo = almacen_json(tmp_path)
+    assert nuevo.cargar() == con_usuarios("1", "2", xp=20)
+    assert nuevo.generacion == 2
+
+
+def test_tmp_cortado_se_ignora(tmp_path):
+    db = almacen_json(tmp_path)
+    db.guardar_todo(con_usuarios("1", xp=10))
+    with open(db.archivo + ".tmp", "w") as f:
+        f.write('{"usuarios": {"1": {"xp"')
+
+    assert almacen_json(tmp_path).cargar() == con_usuarios("1", xp=10)
+
+
+def test_sin_ningun_snapshot_valido_falla_en_vez_de_arrancar_vacio(tmp_path):
+    db = almacen_json(tmp_path, generaciones=1)
+    db.guardar_todo(con_usuarios("1"))
+    db.guardar_todo(con_usuarios("1", "2"))
+    for _, ruta in db._candidatos():
+        with open(ruta, "w") as f:
+            f.write("basura")
+
+    with pytest.raises(ValueError):
+        almacen_json(tmp_path).cargar()
+
+
+def test_snapshot_viejo_sin_cabecera(tmp_path):
+    with open(tmp_path / "db.json", "w") as f:
+        json.dump(con_usuarios("1", xp=7), f, indent=4)
+
+    db = almacen_json(tmp_path)
+    assert db.cargar() == con_usuarios("1", xp=7)
+    assert db.generacion == 0
+
+
+def test_generaciones_guardadas_se_limitan(tmp_path):
+    db = almacen_json(tmp_path, generaciones=2)
+    for xp in range(5):
+        db.guardar_todo(con_usuarios("1", xp=xp))
+
+    assert [n for n, _ in db._generaciones_guardadas()] == [4, 3]
+
+
+# --- diario ---
+def test_diario_se_reaplica_y_descarta_la_ultima_linea_cortada(tmp_path):
+    db = almacen_json(tmp_path)
+    db.guardar_todo(con_usuarios("1"))
+    db.registrar({"1": {"xp": 5, "monedas": 50}, "2": {"xp": 1}}, ["1", "2"])
+    with open(db.diario, "a") as f:
+        f.write('{"u": "1", "c": {"xp": 9')
+
+    assert almacen_json(tmp_path).cargar() == {"usuarios": {"1": {"xp": 5, "monedas": 50}, "2": {"xp": 1}}}
+
+
+def test_registrar_fallido_se_reintenta_completo(tmp_path, monkeypatch):
+    db = almacen_json(tmp_path)
+    db.cargar()
+
+    def sin_espacio(fd):
+        raise OSError(28, "No space left on device")
+
+    with monkeypatch.context() as m:
+        m.setattr(os, "fsync", sin_espacio)
+        with pytest.raises(OSError):
+            db.registrar({"1": {"xp": 5}}, ["1"])
+    assert os.path.getsize(db.diario) == 0
+
+    db.registrar({"1": {"xp": 5}}, ["1"])
+    assert almacen_json(tmp_path).cargar() == {"usuarios": {"1": {"xp": 5}}}
+
+
+def test_compactacion_de_fondo_conserva_lo_registrado_mientras_tanto(tmp_path):
+    db = almacen_json(tmp_path)
+    usuarios = {"1": {"xp": 1, "inventario": {"mosca": 1}}}
+    db.registrar(usuarios, ["1"])
+    escribir, terminar = db.empezar_compactacion(lambda: {"usuarios": usuarios})
+    usuarios["1"]["inventario"]["araña"] = 2
+    usuarios["2"] = {"xp": 3}
+    db.registrar(usuarios, ["1", "2"])
+    escribir()
+    esperado = {"usuarios": {"1": {"xp": 1, "inventario": {"mosca": 1, "araña": 2}}, "2": {"xp": 3}}}
+    # un corte antes de recortar el diario sólo lo reaplica de más
+    assert almacen_json(tmp_path).cargar() == esperado
+
+    terminar()
+    assert almacen_json(tmp_path).cargar() == esperado
+
+
+# --- nunca pisar una DB con usuarios con una vacía ---
+def test_json_rechaza_guardar_vacio(tmp_path):
+    almacen_json(tmp_path).guardar_todo(con_usuarios("1"))
+
+    db = almacen_json(tmp_path)
+    with pytest.raises(ValueError):
+        db.guardar_todo({"usuarios": {}})
+    assert almacen_json(tmp_path).cargar() == con_usuarios("1")
+
+
+def test_sqlite_rechaza_guardar_vacio(tmp_path):
+    db = AlmacenSQLite(str(tmp_path / "db.sqlite"))
+    db.guardar_todo(con_usuarios("1"))
+    with pytest.raises(ValueError):
+        db.guardar_todo({"usuarios": {}})
+    assert db.contar() == 1
+    db.cerrar()